@@ -0,0 +1,12 @@
+"""
+Асинхронный прием событий VK Callback API.
+
+Запуск (один процесс держит тысячи событий в обработке):
+    uvicorn asgi:app --host 0.0.0.0 --port 5001
+
+Админка остается на Flask: при установленном asgiref ее запросы обслуживаются этим же процессом,
+иначе ее нужно запускать отдельно через gunicorn run:app.
+"""
+from server.asgi import create_asgi_app
+
+app = create_asgi_app()
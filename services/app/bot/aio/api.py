@@ -0,0 +1,79 @@
+import time
+
+import aiohttp
+
+from ..api import VK_API_VERSION, VK_API_URL
+from server.metrics import observe_vk_call
+from server.serialization import loads
+
+
+class AsyncVkAPIError(Exception):
+    """
+    Ошибка, которую вернул VK API
+    Attributes:
+        code: int - Код ошибки VK
+        message: str - Описание ошибки
+    """
+    def __init__(self, code: int, message: str):
+        super().__init__('{}. {}'.format(code, message))
+        self.code = code
+        self.message = message
+
+
+class AsyncVkAPI(object):
+    """
+    Асинхронный клиент VK API на aiohttp с общим пулом keep-alive соединений
+    Attributes:
+        token: str - Access токен сообщества
+        pool_size: int - Максимальное количество одновременных соединений с API
+        timeout: float - Таймаут запроса в секундах
+        api_url: str - Адрес методов API
+        session: aiohttp.ClientSession - Сессия, создается в start
+    """
+    def __init__(self, token: str, pool_size: int = 100, timeout: float = 10, api_url: str = VK_API_URL):
+        self.token = token
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.api_url = api_url
+        self.session = None
+
+    async def start(self):
+        """
+        Создание сессии. Вызывается из запущенного цикла событий
+        :return: None
+        """
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size),
+                                             timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def close(self):
+        """
+        Закрытие сессии и соединений
+        :return: None
+        """
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def call(self, method: str, **params):
+        """
+        Вызов метода API
+        :param method: str - Название метода, например 'messages.send'
+        :param params: Параметры метода
+        :return: Поле response ответа
+        """
+        data = dict(params, access_token=self.token, v=VK_API_VERSION)
+
+        started_at = time.perf_counter()
+        try:
+            async with self.session.post(self.api_url + method, data=data) as response:
+                body = loads(await response.read())
+        except Exception:
+            observe_vk_call(method, time.perf_counter() - started_at, 'network')
+            raise
+
+        error = body.get('error')
+        observe_vk_call(method, time.perf_counter() - started_at, None if error is None else error.get('error_code'))
+        if error is not None:
+            raise AsyncVkAPIError(error.get('error_code'), error.get('error_msg'))
+
+        return body.get('response')
@@ -0,0 +1,95 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import asyncpg
+
+from ..sessions import ConversationState
+from server import app
+
+
+class AsyncDatabase(object):
+    """
+    Асинхронный доступ к БД для обработки событий бота: чтение состояний диалогов и дедупликация событий.
+    Остальные запросы (сборка графа, запись состояний и подписчиков пачками) выполняются синхронно в потоках.
+    Устаревшие события удаляются фоновой задачей, а не при регистрации события
+    Attributes:
+        dsn: str - URL базы данных
+        min_size: int - Минимальное количество соединений в пуле
+        max_size: int - Максимальное количество соединений в пуле
+        events_ttl: float - Сколько секунд хранить ID обработанных событий
+        pool: asyncpg.Pool - Пул соединений, создается в start
+    """
+    # Как часто (в секундах) удалять устаревшие события
+    CLEANUP_INTERVAL = 60
+
+    def __init__(self, dsn: str, min_size: int = 1, max_size: int = 10, events_ttl: float = 600):
+        # asyncpg не понимает указание драйвера SQLAlchemy в схеме URL
+        self.dsn = dsn.replace('postgresql+psycopg2://', 'postgresql://', 1)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.events_ttl = events_ttl
+        self.pool = None
+        self.cleanup_task = None
+
+    async def start(self):
+        """
+        Создание пула соединений
+        :return: None
+        """
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size)
+        self.cleanup_task = asyncio.ensure_future(self.__cleanup())
+
+    async def __cleanup(self):
+        while True:
+            await asyncio.sleep(self.CLEANUP_INTERVAL)
+            try:
+                await self.pool.execute("DELETE FROM processed_events WHERE created_at < $1",
+                                        datetime.utcnow() - timedelta(seconds=self.events_ttl))
+            except Exception as e:
+                app.logger.exception(e)
+
+    async def close(self):
+        """
+        Закрытие пула соединений
+        :return: None
+        """
+        if self.cleanup_task is not None:
+            self.cleanup_task.cancel()
+            self.cleanup_task = None
+
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def get_conversation(self, user_id: int):
+        """
+        Получение состояния диалога пользователя
+        :param user_id: int - ID пользователя ВК
+        :return: ConversationState - Состояние (step_id = None, если пользователь еще не общался с ботом)
+        """
+        row = await self.pool.fetchrow(
+            "SELECT step_id, keyboard, created_at, updated_at FROM conversations WHERE user_id = $1", user_id)
+        if row is None:
+            return ConversationState(user_id, None, None, None, None)
+
+        return ConversationState(user_id, row['step_id'], row['keyboard'], row['created_at'], row['updated_at'])
+
+    async def register_event(self, event_id: str):
+        """
+        Регистрация события VK Callback API как обработанного
+        :param event_id: str - ID события
+        :return: bool - True, если событие зарегистрировано впервые
+        """
+        inserted = await self.pool.fetchval(
+            "INSERT INTO processed_events (event_id, created_at) VALUES ($1, $2) "
+            "ON CONFLICT (event_id) DO NOTHING RETURNING event_id", event_id, datetime.utcnow())
+
+        return inserted is not None
+
+    async def forget_event(self, event_id: str):
+        """
+        Удаление отметки об обработке события, чтобы повторная доставка была обработана
+        :param event_id: str - ID события
+        :return: None
+        """
+        await self.pool.execute("DELETE FROM processed_events WHERE event_id = $1", event_id)
@@ -0,0 +1,182 @@
+import asyncio
+
+from ..handlers import parse_new_message, needs_conversation, reply_to_message, reply_to_join
+from ..router import BotEventType
+from database import get_graph, get_cached_graph
+from server import app, db
+from server.log import log_request_id
+from server.metrics import track_bot_event
+from server.serialization import loads
+
+
+class CallbackIngress(object):
+    """
+    Асинхронный прием событий VK Callback API.
+    Событие подтверждается сразу и обрабатывается в отдельной задаче цикла событий, поэтому один процесс держит
+    тысячи событий в обработке, пока они ждут VK API или БД
+    Attributes:
+        sender: AsyncMessageSender - Асинхронная отправка сообщений
+        database: AsyncDatabase - Асинхронный доступ к БД
+        deduplicator: EventDeduplicator - Дедупликация событий в памяти процесса
+        subscribers: SubscriberRegistry - Реестр подписчиков бота
+        conversations: ConversationStore - Состояния диалогов пользователей
+        confirmation_token: str - Код подтверждения сервера
+        max_in_flight: int - Максимальное количество событий в обработке. Сверх него события не подтверждаются
+        use_database_dedup: bool - Проверять повторные события также в таблице processed_events
+        tasks: set - Задачи обработки событий
+    """
+    def __init__(self, sender, database, deduplicator, subscribers, conversations, confirmation_token: str,
+                 max_in_flight: int = 5000, use_database_dedup: bool = False):
+        self.sender = sender
+        self.database = database
+        self.deduplicator = deduplicator
+        self.subscribers = subscribers
+        self.conversations = conversations
+        self.confirmation_token = confirmation_token
+        self.max_in_flight = max_in_flight
+        self.use_database_dedup = use_database_dedup
+        self.tasks = set()
+        self.handlers = {
+            BotEventType.MESSAGE_NEW: self.__handle_new_message,
+            BotEventType.GROUP_JOIN: self.__handle_join_group
+        }
+
+    async def __is_duplicate(self, event_id):
+        if self.deduplicator.is_duplicate(event_id):
+            return True
+
+        if event_id is None or not self.use_database_dedup:
+            return False
+
+        try:
+            return not await self.database.register_event(event_id)
+        except Exception as e:
+            # Если БД недоступна, лучше обработать событие повторно, чем потерять его
+            app.logger.exception(e)
+            return False
+
+    async def __forget(self, event_id):
+        self.deduplicator.forget(event_id)
+        if event_id is not None and self.use_database_dedup:
+            try:
+                await self.database.forget_event(event_id)
+            except Exception as e:
+                app.logger.exception(e)
+
+    async def accept(self, body: bytes):
+        """
+        Прием тела запроса VK Callback API
+        :param body: bytes - Тело запроса
+        :return: (str, int) - Тело ответа, HTTP статус
+        """
+        try:
+            data = loads(body)
+        except (ValueError, TypeError):
+            return 'denied', 200
+
+        # Запрос от VK Callback API всегда содержит поле type
+        if not isinstance(data, dict) or 'type' not in data:
+            return 'denied', 200
+
+        # Подтверждение сервера
+        if data['type'] == 'confirmation':
+            return self.confirmation_token, 200
+
+        # Повторно доставленное VK событие уже принято в обработку
+        event_id = data.get('event_id')
+        if await self.__is_duplicate(event_id):
+            return 'ok', 200
+
+        # Не подтверждаем событие сверх лимита - VK доставит его повторно
+        if len(self.tasks) >= self.max_in_flight:
+            await self.__forget(event_id)
+            return 'busy', 503
+
+        task = asyncio.ensure_future(self.__handle(data))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+        return 'ok', 200
+
+    async def __handle(self, data):
+        try:
+            handler = self.handlers.get(BotEventType(data['type']))
+        except ValueError:
+            return
+
+        if handler is None:
+            return
+
+        try:
+            with log_request_id(data.get('event_id')), track_bot_event(data['type']):
+                await handler(data)
+        except Exception as e:
+            app.logger.exception(e)
+
+    def __load_graph(self):
+        with app.app_context():
+            try:
+                return get_graph()
+            finally:
+                db.session.remove()
+
+    async def __get_graph(self):
+        graph = get_cached_graph()
+        if graph is not None:
+            return graph
+
+        # Граф пересобирается только после изменений, синхронный запрос выполняется в потоке
+        return await asyncio.get_event_loop().run_in_executor(None, self.__load_graph)
+
+    async def __get_conversation(self, user_id):
+        state = self.conversations.get_cached(user_id)
+        if state is not None:
+            return state
+
+        return self.conversations.put_loaded(await self.database.get_conversation(user_id))
+
+    # Выбор шага и клавиатуры общий с синхронными обработчиками (bot/handlers.py), здесь только ввод-вывод
+
+    async def __handle_new_message(self, data):
+        user_id, payload = parse_new_message(data)
+
+        self.subscribers.touch(user_id)
+
+        conversation = await self.__get_conversation(user_id) if needs_conversation(payload) else None
+
+        reply = reply_to_message(await self.__get_graph(), conversation, payload)
+        if reply is None:
+            return
+
+        await self.sender.send(user_id=str(user_id), message=reply.message, keyboard=reply.keyboard)
+
+        self.conversations.set(user_id, reply.step.id, reply.keyboard)
+
+    async def __handle_join_group(self, data):
+        user_id = data['object']['user_id']
+
+        self.subscribers.touch(user_id, joined=True)
+
+        reply = reply_to_join(await self.__get_graph())
+        if reply is None:
+            return
+
+        await self.sender.send(user_id=str(user_id), message=reply.message, keyboard=reply.keyboard)
+
+        self.conversations.set(user_id, reply.step.id, reply.keyboard)
+
+    async def drain(self, timeout: float = 10):
+        """
+        Ожидание обработки принятых событий при остановке
+        :param timeout: float - Максимальное время ожидания в секундах
+        :return: None
+        """
+        if len(self.tasks) != 0:
+            await asyncio.wait(list(self.tasks), timeout=timeout)
+
+    def stats(self):
+        """
+        Счетчики приема событий
+        :return: dict
+        """
+        return dict(self.deduplicator.stats(), in_flight=len(self.tasks), **self.sender.stats())
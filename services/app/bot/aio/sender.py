@@ -0,0 +1,114 @@
+import asyncio
+import random
+
+from .api import AsyncVkAPIError
+from server import app
+
+
+class AsyncTokenBucket(object):
+    """
+    Ожидание токенов общего ограничителя частоты запросов в цикле событий.
+    Токены берутся из того же TokenBucket, что и у MessageSender процесса (ответы админки и рассылки),
+    поэтому все отправки процесса укладываются в один лимит сообщества. Ожидающие получают токены в порядке очереди
+    Attributes:
+        bucket: TokenBucket - Общий ограничитель частоты запросов
+    """
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.lock = None
+
+    async def acquire(self):
+        """
+        Получение токена
+        :return: None
+        """
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+
+        async with self.lock:
+            while True:
+                wait = self.bucket.try_acquire()
+                if wait == 0:
+                    return
+
+                await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        """
+        Приостановка выдачи токенов, например после ответа VK о превышении лимита
+        :param seconds: float - Длительность паузы в секундах
+        :return: None
+        """
+        self.bucket.pause(seconds)
+
+
+class AsyncMessageSender(object):
+    """
+    Асинхронная отправка сообщений с ограничением частоты и повтором при ошибках VK о превышении лимита
+    Attributes:
+        api: AsyncVkAPI - Клиент VK API
+        bucket: AsyncTokenBucket - Ожидание токенов общего ограничителя частоты вызовов messages.send
+        max_retries: int - Количество повторов при ошибках 6 и 9
+        retry_delay: float - Начальная задержка повтора в секундах, удваивается с каждым повтором
+        sent: int - Количество отправленных сообщений
+        failed: int - Количество неотправленных сообщений
+        retried: int - Количество повторов
+    """
+    # Коды ошибок VK API, после которых запрос нужно повторить позже
+    ERROR_TOO_MANY_REQUESTS = 6
+    ERROR_FLOOD_CONTROL = 9
+
+    def __init__(self, api, bucket, max_retries: int = 5, retry_delay: float = 1):
+        self.api = api
+        self.bucket = AsyncTokenBucket(bucket)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    async def send(self, **params):
+        """
+        Вызов messages.send. random_id фиксируется до первой попытки, поэтому повтор не дублирует сообщение
+        :param params: Параметры метода messages.send (user_id, message, keyboard, ...)
+        :return: bool - True, если сообщение отправлено
+        """
+        params.setdefault('random_id', random.getrandbits(64))
+
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+
+            try:
+                await self.api.call('messages.send', **params)
+            except AsyncVkAPIError as e:
+                if e.code in (self.ERROR_TOO_MANY_REQUESTS, self.ERROR_FLOOD_CONTROL) and attempt < self.max_retries:
+                    retry_after = self.retry_delay * 2 ** attempt
+                    app.logger.warning("VK rate limit (code %s), retry in %s seconds", e.code, retry_after)
+
+                    self.bucket.pause(retry_after)
+                    self.retried += 1
+                    await asyncio.sleep(retry_after)
+                    continue
+
+                app.logger.exception(e)
+                break
+            except Exception as e:
+                app.logger.exception(e)
+                break
+
+            self.sent += 1
+            return True
+
+        self.failed += 1
+        return False
+
+    def stats(self):
+        """
+        Счетчики отправки
+        :return: dict
+        """
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried
+        }
@@ -0,0 +1,54 @@
+import threading
+import vk
+from requests.adapters import HTTPAdapter
+
+
+VK_API_VERSION = '5.122'
+
+VK_API_URL = 'https://api.vk.com/method/'
+
+
+def create_api(token: str, pool_size: int = 10, timeout: float = 10, api_url: str = VK_API_URL):
+    """
+    Создание клиента vk api с пулом keep-alive соединений
+    :param token: str - Access токен сообщества
+    :param pool_size: int - Максимальное количество соединений с api.vk.com в пуле
+    :param timeout: float - Таймаут запроса к API в секундах
+    :param api_url: str - Адрес методов API (для нагрузочного тестирования - адрес заглушки VK API)
+    :return: vk.API
+    """
+    session = vk.Session(access_token=token)
+    session.API_URL = api_url
+
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+    session.requests_session.mount('https://', adapter)
+    session.requests_session.mount('http://', adapter)
+
+    return vk.API(session, timeout=timeout, v=VK_API_VERSION)
+
+
+_lock = threading.Lock()
+_apis = {}
+
+
+def get_api(token: str, pool_size: int = 10, timeout: float = 10, api_url: str = VK_API_URL):
+    """
+    Получение общего для процесса клиента vk api.
+    Клиент создается один раз на токен и переиспользуется всеми обработчиками
+    :param token: str - Access токен сообщества
+    :param pool_size: int - Максимальное количество соединений с api.vk.com в пуле
+    :param timeout: float - Таймаут запроса к API в секундах
+    :param api_url: str - Адрес методов API
+    :return: vk.API
+    """
+    api = _apis.get(token)
+    if api is not None:
+        return api
+
+    with _lock:
+        api = _apis.get(token)
+        if api is None:
+            api = create_api(token, pool_size=pool_size, timeout=timeout, api_url=api_url)
+            _apis[token] = api
+
+    return api
@@ -0,0 +1,144 @@
+import functools
+import threading
+import time
+
+from database import get_graph, get_broadcast, update_broadcast, get_subscriber_ids
+from server import app, db
+from .handlers import keyboard_cache
+from .sender import MessagePriority
+
+
+class BroadcastProgress(object):
+    """
+    Прогресс выполняющейся рассылки, обновляется из потоков отправки сообщений
+    Attributes:
+        queued: int - Количество подписчиков, сообщения которым поставлены в очередь отправки
+        sent: int - Количество подписчиков, которым отправлено сообщение
+        failed: int - Количество подписчиков, которым не удалось отправить сообщение
+    """
+    def __init__(self):
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def add(self, count: int):
+        with self.lock:
+            self.queued += count
+
+    def done(self, count: int, success: bool, response=None):
+        """
+        Учет результата отправки сообщения count получателям
+        :param count: int - Количество получателей сообщения
+        :param success: bool - Вызов messages.send выполнен
+        :param response: list - Ответ messages.send с peer_ids: результат по каждому получателю,
+            получатели с полем error считаются неудачными
+        :return: None
+        """
+        failed = count
+        if success:
+            failed = 0
+            if isinstance(response, list):
+                failed = min(count, sum(1 for item in response if isinstance(item, dict) and 'error' in item))
+
+        with self.lock:
+            self.sent += count - failed
+            self.failed += failed
+
+    def in_flight(self):
+        with self.lock:
+            return self.queued - self.sent - self.failed
+
+
+class Broadcaster(object):
+    """
+    Рассылка шага подписчикам через messages.send с peer_ids.
+    Каждая рассылка выполняется в отдельном фоновом потоке, прогресс сохраняется в таблицу broadcasts
+    Attributes:
+        sender: MessageSender - Планировщик отправки сообщений
+        max_in_flight: int - Максимальное количество сообщений рассылки в очереди отправки
+        page_size: int - Сколько ID подписчиков загружать из БД за один запрос
+    """
+    # Максимальное количество получателей в одном вызове messages.send
+    PEERS_PER_MESSAGE = 100
+
+    # Как часто (в секундах) сохранять прогресс рассылки
+    PROGRESS_INTERVAL = 1
+
+    def __init__(self, sender, max_in_flight: int = 50, page_size: int = 1000):
+        self.sender = sender
+        self.max_in_flight = max_in_flight
+        self.page_size = page_size
+
+    def start(self, broadcast_id: int, step_id: int, filters: dict):
+        """
+        Запуск рассылки в фоновом потоке
+        :param broadcast_id: int - ID созданной рассылки
+        :param step_id: int - ID рассылаемого шага
+        :param filters: dict - Фильтры подписчиков (joined_after, active_after)
+        :return: None
+        """
+        thread = threading.Thread(target=self.__run, args=(broadcast_id, step_id, filters),
+                                  name='broadcast-{}'.format(broadcast_id), daemon=True)
+        thread.start()
+
+    def __save_progress(self, broadcast, progress, status=None):
+        broadcast.sent = progress.sent
+        broadcast.failed = progress.failed
+        if status is not None:
+            broadcast.status = status
+        update_broadcast(broadcast)
+
+    def __wait(self, broadcast, progress, max_in_flight):
+        last_saved_at = time.monotonic()
+        while progress.in_flight() > max_in_flight:
+            time.sleep(0.05)
+            if time.monotonic() - last_saved_at >= self.PROGRESS_INTERVAL:
+                self.__save_progress(broadcast, progress)
+                last_saved_at = time.monotonic()
+
+    def __send(self, broadcast, progress, step, keyboard, user_ids):
+        for i in range(0, len(user_ids), self.PEERS_PER_MESSAGE):
+            peer_ids = user_ids[i:i + self.PEERS_PER_MESSAGE]
+
+            self.__wait(broadcast, progress, self.max_in_flight * self.PEERS_PER_MESSAGE)
+
+            progress.add(len(peer_ids))
+            queued = self.sender.send(priority=MessagePriority.BULK,
+                                      callback=functools.partial(progress.done, len(peer_ids)),
+                                      peer_ids=','.join(map(str, peer_ids)), message=step.text, keyboard=keyboard)
+            if not queued:
+                progress.done(len(peer_ids), False)
+
+    def __run(self, broadcast_id, step_id, filters):
+        with app.app_context():
+            broadcast = get_broadcast(broadcast_id)
+            progress = BroadcastProgress()
+
+            try:
+                graph = get_graph()
+                step = graph.get_step(step_id)
+                if step is None:
+                    self.__save_progress(broadcast, progress, status='failed')
+                    return
+
+                keyboard = keyboard_cache.get_keyboard(graph, step, with_back=step.parent_id is not None)
+
+                after_user_id = None
+                while True:
+                    user_ids = get_subscriber_ids(after_user_id, limit=self.page_size, **filters)
+                    if len(user_ids) == 0:
+                        break
+                    after_user_id = user_ids[-1]
+
+                    self.__send(broadcast, progress, step, keyboard, user_ids)
+                    self.__save_progress(broadcast, progress)
+
+                self.__wait(broadcast, progress, 0)
+                self.__save_progress(broadcast, progress, status='finished')
+            except Exception as e:
+                app.logger.exception(e)
+                db.session.rollback()
+                self.__save_progress(broadcast, progress, status='failed')
+            finally:
+                db.session.remove()
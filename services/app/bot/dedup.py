@@ -0,0 +1,139 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from database import register_event, forget_event, delete_processed_events
+from server import app, db
+
+
+class EventDeduplicator(object):
+    """
+    Отбрасывание повторных доставок событий VK Callback API по event_id.
+    ID событий хранятся в ограниченном по размеру и времени жизни LRU в памяти процесса
+    и, опционально, в таблице processed_events, общей для всех воркеров.
+    Устаревшие события удаляются из таблицы фоновым потоком, а не при проверке события
+    Attributes:
+        ttl: float - Сколько секунд помнить обработанное событие
+        max_size: int - Максимальное количество событий в памяти
+        use_database: bool - Проверять события также в БД
+        events: OrderedDict - ID событий и время истечения, в порядке получения
+        checked: int - Количество проверенных событий
+        duplicates: int - Количество отброшенных повторных событий
+    """
+    # Как часто (в секундах) удалять устаревшие события из БД
+    CLEANUP_INTERVAL = 60
+
+    def __init__(self, ttl: float = 600, max_size: int = 100000, use_database: bool = False):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.use_database = use_database
+        self.events = OrderedDict()
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.duplicates = 0
+        self.cleanup_thread = None
+
+    def __start_cleanup(self):
+        with self.lock:
+            if self.cleanup_thread is not None:
+                return
+
+            # Поток запускается при первой проверке события, уже после форка воркера gunicorn
+            self.cleanup_thread = threading.Thread(target=self.__cleanup, name='processed-events-cleanup',
+                                                   daemon=True)
+            self.cleanup_thread.start()
+
+    def __cleanup(self):
+        while True:
+            time.sleep(self.CLEANUP_INTERVAL)
+            with app.app_context():
+                try:
+                    delete_processed_events(datetime.utcnow() - timedelta(seconds=self.ttl))
+                except Exception as e:
+                    db.session.rollback()
+                    app.logger.exception(e)
+                finally:
+                    db.session.remove()
+
+    def __evict(self, now):
+        while len(self.events) != 0:
+            event_id, expires_at = next(iter(self.events.items()))
+            if expires_at > now and len(self.events) <= self.max_size:
+                break
+            self.events.popitem(last=False)
+
+    def __is_registered_in_database(self, event_id):
+        if self.cleanup_thread is None:
+            self.__start_cleanup()
+
+        try:
+            return not register_event(event_id)
+        except Exception as e:
+            # Если БД недоступна, лучше обработать событие повторно, чем потерять его
+            db.session.rollback()
+            app.logger.exception(e)
+            return False
+
+    def is_duplicate(self, event_id):
+        """
+        Проверка события на повторную доставку. Впервые полученное событие запоминается
+        :param event_id: str - ID события (None - событие не проверяется)
+        :return: bool - True, если событие уже было получено
+        """
+        if event_id is None:
+            return False
+
+        now = time.monotonic()
+
+        with self.lock:
+            self.checked += 1
+
+            expires_at = self.events.get(event_id)
+            is_duplicate = expires_at is not None and expires_at > now
+            if not is_duplicate:
+                self.events[event_id] = now + self.ttl
+                self.events.move_to_end(event_id)
+                self.__evict(now)
+
+        if not is_duplicate and self.use_database:
+            is_duplicate = self.__is_registered_in_database(event_id)
+
+        if is_duplicate:
+            with self.lock:
+                self.duplicates += 1
+            app.logger.debug("Duplicate event %s dropped", event_id)
+
+        return is_duplicate
+
+    def forget(self, event_id):
+        """
+        Удаление события, например если оно не было принято в обработку.
+        Повторная доставка такого события будет обработана
+        :param event_id: str - ID события
+        :return: None
+        """
+        if event_id is None:
+            return
+
+        with self.lock:
+            self.events.pop(event_id, None)
+
+        if self.use_database:
+            try:
+                forget_event(event_id)
+            except Exception as e:
+                db.session.rollback()
+                app.logger.exception(e)
+
+    def stats(self):
+        """
+        Счетчики дедупликации
+        :return: dict
+        """
+        with self.lock:
+            return {
+                'checked': self.checked,
+                'duplicates': self.duplicates,
+                'size': len(self.events)
+            }
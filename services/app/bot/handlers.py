@@ -1,104 +1,219 @@
-import vk
-from vk.exceptions import VkAPIError
-import json
-import random
+import threading
+from collections import namedtuple
 from .keyboard import BotKeyboard, BotKeyboardButton, BotKeyboardButtonType, BotKeyboardButtonColor
+from .sender import MessagePriority
 
-from database import get_first_step, get_button, get_step
+from database import get_graph
 
 from server import app
+from server.serialization import dumps, loads
 
 
-def _configure_keyboard(buttons: list):
+# Отладочные сообщения о событиях бота: записывается только доля LOG_DEBUG_SAMPLE_RATE
+events_logger = app.logger.getChild('events')
+
+# Приветствие, отправляемое вместе с первым шагом при вступлении в сообщество
+GREETING = "Привет, я Профбот"
+
+# Ответ бота: отправляемый шаг, текст сообщения и JSON клавиатуры
+Reply = namedtuple('Reply', ['step', 'message', 'keyboard'])
+
+
+def _configure_keyboard(step):
     """
-    Метод конфигурирования клавиатуры по полученным из БД кнопкам
-    :param buttons: [Button] - Список кнопок
+    Метод конфигурирования клавиатуры по шагу скомпилированного графа диалога
+    :param step: StepNode - Шаг, кнопки которого уже разложены по строкам
     :return: BotKeyboard
     """
-    buttons_matrix = []
+    keyboard = BotKeyboard(one_time=False, inline=False)
 
-    lines_sorted_buttons = sorted(buttons, key=lambda btn: btn.row)  # Сортировка кнопок по номеру строки
+    for buttons_line in step.rows:
+        keyboard.add_line()
+        for button in buttons_line:
+            keyboard.add_button(BotKeyboardButton(BotKeyboardButtonType(button.type), button.label,
+                                                  BotKeyboardButtonColor(button.color),
+                                                  dumps({'button_id': button.id})))
+
+    return keyboard
 
-    prev_line = -1
 
-    for button in lines_sorted_buttons:
-        if button.row <= prev_line:
-            continue
+def _serialize_keyboard(step, with_back: bool):
+    """
+    Получение JSON строки клавиатуры шага
+    :param step: StepNode - Шаг
+    :param with_back: bool - Добавить строку с кнопкой "Назад"
+    :return: str
+    """
+    keyboard = _configure_keyboard(step)
+
+    if with_back:
+        keyboard.add_line()
+        keyboard.add_button(BotKeyboardButton(BotKeyboardButtonType.TEXT, "Назад", BotKeyboardButtonColor.DEFAULT,
+                                              dumps({'button_id': -1, 'step_id': step.id})))
 
-        line_buttons = list(filter(lambda btn: btn.row == button.row, lines_sorted_buttons))
+    return dumps(keyboard.get_keyboard())
 
-        buttons_matrix.append([])
 
-        columns_sorted_buttons = sorted(line_buttons, key=lambda btn: btn.column)
+class KeyboardCache(object):
+    """
+    Кэш сериализованных клавиатур шагов.
+    При смене версии графа диалога из кэша удаляются только клавиатуры измененных шагов
+    Attributes:
+        version: int - Версия графа, для которой актуален кэш
+        keyboards: {(int, bool): (StepNode, str)} - Клавиатуры по (ID шага, есть ли кнопка "Назад")
+    """
+    def __init__(self):
+        self.version = None
+        self.keyboards = {}
+        self.lock = threading.Lock()
+
+    def __sync(self, graph):
+        with self.lock:
+            if self.version == graph.version:
+                return
+
+            # Клавиатуры неизмененных шагов переносятся на шаги новой версии графа
+            keyboards = {}
+            for key, (step, keyboard) in list(self.keyboards.items()):
+                new_step = graph.get_step(key[0])
+                if new_step == step:
+                    keyboards[key] = (new_step, keyboard)
+
+            self.keyboards = keyboards
+            self.version = graph.version
+
+    def get_keyboard(self, graph, step, with_back: bool):
+        """
+        Получение JSON строки клавиатуры шага
+        :param graph: DialogGraph - Граф диалога, из которого получен шаг
+        :param step: StepNode - Шаг
+        :param with_back: bool - Добавить строку с кнопкой "Назад"
+        :return: str
+        """
+        if self.version != graph.version:
+            self.__sync(graph)
 
-        for line_button in columns_sorted_buttons:
-            if line_button.next_step is not None:
-                buttons_matrix[-1].append(line_button)
+        key = (step.id, with_back)
+        cached = self.keyboards.get(key)
+        if cached is not None and cached[0] is step:
+            return cached[1]
 
-        prev_line = button.row
+        keyboard = _serialize_keyboard(step, with_back)
+        self.keyboards[key] = (step, keyboard)
 
-    keyboard = BotKeyboard(one_time=False, inline=False)
+        return keyboard
 
-    for buttons_line in buttons_matrix:
-        keyboard.add_line()
-        for button in buttons_line:
-            keyboard.add_button(BotKeyboardButton(BotKeyboardButtonType(button.type), button.label,
-                                                  BotKeyboardButtonColor(button.color),
-                                                  json.dumps({'button_id': button.id})))
 
-    return keyboard
+keyboard_cache = KeyboardCache()
 
 
-class NewMessageHandler(object):
+def needs_conversation(payload):
     """
-    Обработчик новых сообщений, нажатий на кнопки с типом отличным от `callback`
-    Attributes:
-        token: str - Access токен для отправки сообщений
-        api: vk.API - Обьект класса vk api для отправки сообщений
+    Нужно ли состояние диалога для выбора ответа: только на свободный текст и на кнопку "Назад" без шага в payload.
+    Нажатия остальных кнопок обрабатываются без чтения состояния (и без запроса к БД, если его нет в памяти воркера)
+    :param payload: dict - Payload нажатой кнопки (None - свободный текст)
+    :return: bool
     """
-    def __init__(self, token):
-        self.token = token
-        self.api = vk.API(vk.Session(access_token=token), v='5.122')
+    return payload is None or (payload.get('button_id') == -1 and payload.get('step_id') is None)
 
-    def __get_next_step(self, payload):
-        if payload is None:
-            return None
 
-        button_id = payload.get('button_id')
-        if button_id is None:
-            if payload.get('command') == 'start':
-                return get_first_step()
-            else:
+def get_next_step(graph, conversation, payload):
+    """
+    Определение шага, который нужно отправить пользователю в ответ на сообщение
+    :param graph: DialogGraph - Граф диалога
+    :param conversation: ConversationState - Состояние диалога пользователя (None, если needs_conversation ложно)
+    :param payload: dict - Payload нажатой кнопки (None - свободный текст)
+    :return: StepNode - None, если отвечать не нужно
+    """
+    if payload is None:
+        # На свободный текст бот повторяет текущий шаг пользователя
+        current_step = graph.get_step(conversation.step_id)
+        if current_step is None:
+            return graph.get_first_step()
+
+        return current_step
+
+    button_id = payload.get('button_id')
+    if button_id is None:
+        if payload.get('command') == 'start':
+            return graph.get_first_step()
+        else:
+            return None
+    else:
+        if button_id == -1:
+            # В клавиатурах, отправленных до появления состояний диалогов, шаг передается в payload
+            step_id = payload.get('step_id')
+            if step_id is None:
+                step_id = conversation.step_id
+            if step_id is None:
                 return None
+
+            prev_step = graph.get_prev_step(step_id)
+            if prev_step is None:
+                return graph.get_first_step()
+
+            return prev_step
         else:
-            if button_id == -1:
-                step_id = payload.get('step_id')
-                if step_id is None:
-                    return None
+            new_step = graph.get_next_step(button_id)
+            if new_step is None:
+                return graph.get_first_step()
+
+            return new_step
+
+
+def parse_new_message(data):
+    """
+    Получение отправителя и payload нажатой кнопки из события message_new
+    :param data: JSON - Данные, полученные в запросе к боту от Callback API
+    :return: (int, dict) - ID пользователя ВК и payload (None - свободный текст)
+    """
+    message = data['object']['message']
+    payload = message.get('payload')
+
+    return message['from_id'], None if payload is None else loads(payload)
+
+
+def reply_to_message(graph, conversation, payload):
+    """
+    Ответ на сообщение или нажатие кнопки
+    :param graph: DialogGraph - Граф диалога
+    :param conversation: ConversationState - Состояние диалога пользователя (None, если needs_conversation ложно)
+    :param payload: dict - Payload нажатой кнопки (None - свободный текст)
+    :return: Reply - None, если отвечать не нужно
+    """
+    new_step = get_next_step(graph, conversation, payload)
+    if new_step is None:
+        return None
 
-                curr_step = get_step(step_id)
-                if curr_step is None:
-                    return get_first_step()
+    return Reply(new_step, new_step.text,
+                 keyboard_cache.get_keyboard(graph, new_step, with_back=new_step.parent_id is not None))
 
-                from_button = curr_step.from_button
-                if from_button is None:
-                    return get_first_step()
 
-                prev_step = from_button.step
-                if prev_step is None:
-                    return get_first_step()
+def reply_to_join(graph):
+    """
+    Ответ на вступление в сообщество: приветствие с клавиатурой первого шага
+    :param graph: DialogGraph - Граф диалога
+    :return: Reply - None, если в графе нет шагов
+    """
+    first_step = graph.get_first_step()
+    if first_step is None:
+        return None
 
-                return prev_step
-            else:
-                clicked_button = get_button(button_id)
-                if clicked_button is None:
-                    return get_first_step()
+    return Reply(first_step, GREETING, keyboard_cache.get_keyboard(graph, first_step, with_back=False))
 
-                new_step = clicked_button.next_step
-                if new_step is None:
-                    return get_first_step()
 
-                return new_step
+class NewMessageHandler(object):
+    """
+    Обработчик новых сообщений, нажатий на кнопки с типом отличным от `callback`
+    Attributes:
+        sender: MessageSender - Планировщик отправки сообщений (общий для всех обработчиков)
+        subscribers: SubscriberRegistry - Реестр подписчиков бота
+        conversations: ConversationStore - Состояния диалогов пользователей
+    """
+    def __init__(self, sender, subscribers, conversations):
+        self.sender = sender
+        self.subscribers = subscribers
+        self.conversations = conversations
 
     def handle(self, data):
         """
@@ -106,47 +221,36 @@ class NewMessageHandler(object):
         :param data: JSON - Данные, полученные в запросе к боту от Callback API
         :return: None
         """
-        app.logger.debug(json.dumps(data))
-
-        user_id = data['object']['message']['from_id']
-        payload = data['object']['message'].get('payload')
+        events_logger.debug("Callback event %s", data)
 
-        if payload is None:
-            return
+        user_id, payload = parse_new_message(data)
 
-        payload_data = json.loads(payload)
+        self.subscribers.touch(user_id)
 
-        new_step = self.__get_next_step(payload_data)
+        conversation = self.conversations.get(user_id) if needs_conversation(payload) else None
 
-        if new_step is None:
+        reply = reply_to_message(get_graph(), conversation, payload)
+        if reply is None:
             return
 
-        new_buttons = new_step.buttons
-
-        keyboard = _configure_keyboard(new_buttons)
+        self.sender.send(priority=MessagePriority.INTERACTIVE, user_id=str(user_id), message=reply.message,
+                         keyboard=reply.keyboard)
 
-        if new_step.from_button is not None:
-            keyboard.add_line()
-            keyboard.add_button(BotKeyboardButton(BotKeyboardButtonType.TEXT, "Назад", BotKeyboardButtonColor.DEFAULT,
-                                                  json.dumps({'button_id': -1, 'step_id': new_step.id})))
-
-        try:
-            self.api.messages.send(access_token=self.token, user_id=str(user_id), message=new_step.text,
-                                   keyboard=json.dumps(keyboard.get_keyboard()), random_id=random.getrandbits(64))
-        except VkAPIError as e:
-            app.logger.exception(e)
+        self.conversations.set(user_id, reply.step.id, reply.keyboard)
 
 
 class JoinGroupHandler(object):
     """
     Обработчик события вступления в сообщество ВК
     Attributes:
-        token: str - Access токен для отправки сообщений
-        api: vk.API - Обьект класса vk api для отправки сообщений
+        sender: MessageSender - Планировщик отправки сообщений (общий для всех обработчиков)
+        subscribers: SubscriberRegistry - Реестр подписчиков бота
+        conversations: ConversationStore - Состояния диалогов пользователей
     """
-    def __init__(self, token):
-        self.token = token
-        self.api = vk.API(vk.Session(access_token=token), v='5.122')
+    def __init__(self, sender, subscribers, conversations):
+        self.sender = sender
+        self.subscribers = subscribers
+        self.conversations = conversations
 
     def handle(self, data):
         """
@@ -154,20 +258,20 @@ class JoinGroupHandler(object):
         :param data: JSON - Данные, полученные в запросе к боту от Callback API
         :return: None
         """
-        app.logger.debug(json.dumps(data))
+        events_logger.debug("Callback event %s", data)
 
         user_id = data['object']['user_id']
 
-        first_step = get_first_step()
-        step_buttons = first_step.buttons
+        self.subscribers.touch(user_id, joined=True)
+
+        reply = reply_to_join(get_graph())
+        if reply is None:
+            return
 
-        keyboard = _configure_keyboard(step_buttons)
+        self.sender.send(priority=MessagePriority.INTERACTIVE, user_id=str(user_id), message=reply.message,
+                         keyboard=reply.keyboard)
 
-        try:
-            self.api.messages.send(access_token=self.token, user_id=str(user_id), message="Привет, я Профбот",
-                                   keyboard=json.dumps(keyboard.get_keyboard()), random_id=random.getrandbits(64))
-        except VkAPIError as e:
-            app.logger.exception(e)
+        self.conversations.set(user_id, reply.step.id, reply.keyboard)
 
 
 class EventMessageHandler(object):
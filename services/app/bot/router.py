@@ -1,5 +1,11 @@
 from enum import Enum
 from .handlers import NewMessageHandler, JoinGroupHandler, EventMessageHandler
+from .api import get_api, VK_API_URL
+from .sender import MessageSender
+from .subscribers import SubscriberRegistry
+from .broadcast import Broadcaster
+from .sessions import ConversationStore
+from server.metrics import track_bot_event
 
 
 class BotEventType(Enum):
@@ -23,10 +29,28 @@ class Router(object):
 
     Attributes:
          token: str - Access токен сервера
+         api: vk.API - Общий для всех обработчиков клиент vk api
+         sender: MessageSender - Планировщик отправки сообщений с ограничением частоты
+         subscribers: SubscriberRegistry - Реестр подписчиков бота
+         broadcaster: Broadcaster - Рассылка шагов подписчикам
+         conversations: ConversationStore - Состояния диалогов пользователей
+         handlers: {BotEventType: object} - Обработчики событий, создаются один раз на процесс
 
     """
-    def __init__(self, token):
+    def __init__(self, token, pool_size: int = 10, timeout: float = 10, api_url: str = VK_API_URL,
+                 sender_options: dict = None, subscribers_options: dict = None, broadcast_options: dict = None,
+                 conversations_options: dict = None):
         self.token = token
+        self.api = get_api(token, pool_size=pool_size, timeout=timeout, api_url=api_url)
+        self.sender = MessageSender(self.api, token, **(sender_options or {}))
+        self.subscribers = SubscriberRegistry(**(subscribers_options or {}))
+        self.broadcaster = Broadcaster(self.sender, **(broadcast_options or {}))
+        self.conversations = ConversationStore(**(conversations_options or {}))
+        self.handlers = {
+            BotEventType.MESSAGE_NEW: NewMessageHandler(self.sender, self.subscribers, self.conversations),
+            BotEventType.MESSAGE_EVENT: EventMessageHandler(),
+            BotEventType.GROUP_JOIN: JoinGroupHandler(self.sender, self.subscribers, self.conversations)
+        }
 
     def __get_handler(self, event_type):
         """
@@ -37,14 +61,7 @@ class Router(object):
         :return: Обработчик запроса
 
         """
-        if event_type == BotEventType.MESSAGE_NEW:
-            return NewMessageHandler(self.token)
-        elif event_type == BotEventType.MESSAGE_EVENT:
-            return EventMessageHandler()
-        elif event_type == BotEventType.GROUP_JOIN:
-            return JoinGroupHandler(self.token)
-        else:
-            return None
+        return self.handlers.get(event_type)
 
     def route(self, data):
         """
@@ -59,4 +76,5 @@ class Router(object):
         handler = self.__get_handler(event_type)
 
         if handler is not None:
-            handler.handle(data)
+            with track_bot_event(event_type.value):
+                handler.handle(data)
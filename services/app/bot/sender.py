@@ -0,0 +1,314 @@
+import atexit
+import heapq
+import itertools
+import queue
+import random
+import threading
+import time
+from vk.exceptions import VkAPIError
+
+from server import app
+from server.metrics import observe_vk_call
+
+
+class MessagePriority(object):
+    """
+    Приоритеты исходящих сообщений. Меньшее значение отправляется раньше
+    """
+
+    # Ответ пользователю на нажатие кнопки или вступление в сообщество
+    INTERACTIVE = 0
+
+    # Массовые рассылки
+    BULK = 1
+
+
+class TokenBucket(object):
+    """
+    Ограничитель частоты запросов "token bucket"
+    Attributes:
+        rate: float - Скорость пополнения, токенов в секунду
+        capacity: float - Максимальное количество токенов (размер допустимого всплеска)
+        tokens: float - Текущее количество токенов
+    """
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = rate if capacity is None else capacity
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """
+        Получение токена без ожидания
+        :return: float - 0, если токен получен, иначе через сколько секунд появится следующий токен
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """
+        Получение токена. Блокирует поток, пока токен не станет доступен
+        :return: None
+        """
+        while True:
+            wait = self.try_acquire()
+            if wait == 0:
+                return
+
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """
+        Приостановка выдачи токенов, например после ответа VK о превышении лимита
+        :param seconds: float - Длительность паузы в секундах
+        :return: None
+        """
+        with self.lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class MessageSender(object):
+    """
+    Планировщик исходящих вызовов messages.send.
+    Запросы отправляются из фоновых потоков в порядке приоритета с ограничением частоты,
+    при ошибках VK о превышении лимитов (коды 6 и 9) запрос повторяется позже: до наступления времени повтора
+    он хранится отдельно от очереди и не занимает поток отправки
+    Attributes:
+        api: vk.API - Клиент vk api
+        token: str - Access токен сообщества
+        bucket: TokenBucket - Ограничитель частоты запросов
+        threads_count: int - Количество потоков отправки
+        max_retries: int - Максимальное количество повторов запроса
+        retry_delay: float - Начальная задержка перед повтором в секундах
+        drain_timeout: float - Сколько секунд ждать отправки оставшихся сообщений при остановке
+    """
+    # Too many requests per second
+    ERROR_TOO_MANY_REQUESTS = 6
+    # Flood control
+    ERROR_FLOOD_CONTROL = 9
+
+    def __init__(self, api, token: str, rate: float = 20, burst: float = None, threads_count: int = 2,
+                 max_size: int = 10000, max_retries: int = 5, retry_delay: float = 1, drain_timeout: float = 10):
+        self.api = api
+        self.token = token
+        self.bucket = TokenBucket(rate, burst)
+        self.threads_count = threads_count
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.drain_timeout = drain_timeout
+        self.messages = queue.PriorityQueue(maxsize=max_size)
+        # Отложенные повторы (время повтора, номер, сообщение), упорядоченные по времени повтора
+        self.delayed = []
+        self.counter = itertools.count()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.stopped = False
+
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.queue_delay_count = 0
+        self.queue_delay_sum = 0
+        self.queue_delay_max = 0
+
+        # Регистрируется при создании, чтобы при выходе остановиться после очереди событий бота
+        atexit.register(self.stop)
+
+    def __start(self):
+        with self.lock:
+            if len(self.threads) != 0 or self.stopped:
+                return
+
+            for i in range(self.threads_count):
+                thread = threading.Thread(target=self.__run, name='vk-sender-{}'.format(i), daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def __put(self, priority, params, attempt, callback, enqueued_at):
+        self.messages.put_nowait((priority, next(self.counter), enqueued_at, params, attempt, callback))
+
+    def __delay(self, priority, params, attempt, callback, enqueued_at, not_before):
+        with self.lock:
+            heapq.heappush(self.delayed, (not_before, next(self.counter),
+                                          (priority, params, attempt, callback, enqueued_at)))
+
+    def __release_delayed(self):
+        """
+        Перенос повторов, время которых наступило, в очередь отправки
+        :return: float - Через сколько секунд наступит время следующего повтора (None - повторов нет)
+        """
+        now = time.monotonic()
+        with self.lock:
+            due = []
+            while len(self.delayed) != 0 and self.delayed[0][0] <= now:
+                due.append(heapq.heappop(self.delayed)[2])
+            timeout = self.delayed[0][0] - now if len(self.delayed) != 0 else None
+
+        for priority, params, attempt, callback, enqueued_at in due:
+            try:
+                self.__put(priority, params, attempt, callback, enqueued_at)
+            except queue.Full:
+                app.logger.warning("VK send queue is full, message dropped")
+                self.__finish(False, callback)
+
+        return timeout
+
+    def __send(self, priority, params, attempt, enqueued_at, callback):
+        self.bucket.acquire()
+
+        delay = time.monotonic() - enqueued_at
+        with self.lock:
+            self.queue_delay_count += 1
+            self.queue_delay_sum += delay
+            self.queue_delay_max = max(self.queue_delay_max, delay)
+
+        started_at = time.perf_counter()
+        try:
+            response = self.api.messages.send(access_token=self.token, **params)
+        except VkAPIError as e:
+            observe_vk_call('messages.send', time.perf_counter() - started_at, e.code)
+            if e.code in (self.ERROR_TOO_MANY_REQUESTS, self.ERROR_FLOOD_CONTROL) and attempt < self.max_retries:
+                retry_after = self.retry_delay * 2 ** attempt
+                app.logger.warning("VK rate limit (code %s), retry in %s seconds", e.code, retry_after)
+
+                self.bucket.pause(retry_after)
+                # Задержка в очереди считается от первой постановки сообщения
+                self.__delay(priority, params, attempt + 1, callback, enqueued_at, time.monotonic() + retry_after)
+
+                with self.lock:
+                    self.retried += 1
+                return
+
+            app.logger.exception(e)
+            self.__finish(False, callback)
+            return
+        except Exception as e:
+            observe_vk_call('messages.send', time.perf_counter() - started_at, 'network')
+            app.logger.exception(e)
+            self.__finish(False, callback)
+            return
+
+        observe_vk_call('messages.send', time.perf_counter() - started_at)
+        self.__finish(True, callback, response)
+
+    def __finish(self, success, callback, response=None):
+        with self.lock:
+            if success:
+                self.sent += 1
+            else:
+                self.failed += 1
+
+        if callback is not None:
+            try:
+                callback(success, response)
+            except Exception as e:
+                app.logger.exception(e)
+
+    def __run(self):
+        while True:
+            # Ожидание очереди ограничено временем ближайшего повтора
+            timeout = self.__release_delayed()
+            try:
+                item = self.messages.get(timeout=timeout)
+            except queue.Empty:
+                continue
+
+            try:
+                priority, _, enqueued_at, params, attempt, callback = item
+                if params is None:
+                    with self.lock:
+                        wait = self.delayed[0][0] - time.monotonic() if len(self.delayed) != 0 else None
+                    if wait is None:
+                        return
+
+                    # При остановке сигнал возвращается в очередь, пока остаются отложенные повторы
+                    time.sleep(min(max(wait, 0), self.retry_delay))
+                    self.messages.put(item)
+                    continue
+
+                self.__send(priority, params, attempt, enqueued_at, callback)
+            finally:
+                self.messages.task_done()
+
+    def send(self, priority: int = MessagePriority.INTERACTIVE, callback=None, **params):
+        """
+        Постановка вызова messages.send в очередь
+        :param priority: int - Приоритет сообщения, см.:MessagePriority
+        :param callback: function(bool, response) - Вызывается из потока отправки с результатом отправки
+            и ответом messages.send (None, если отправить не удалось)
+        :param params: Параметры метода messages.send (user_id, peer_ids, message, keyboard, ...)
+        :return: bool - False, если очередь переполнена или остановлена
+        """
+        if self.stopped:
+            return False
+
+        if len(self.threads) == 0:
+            self.__start()
+
+        # random_id фиксируется при постановке в очередь, чтобы VK не доставил сообщение дважды при повторе
+        params.setdefault('random_id', random.getrandbits(64))
+
+        try:
+            self.__put(priority, params, 0, callback, time.monotonic())
+        except queue.Full:
+            app.logger.warning("VK send queue is full, message dropped")
+            return False
+
+        return True
+
+    def size(self):
+        """
+        Количество сообщений, ожидающих отправки, включая отложенные повторы
+        :return: int
+        """
+        return self.messages.qsize() + len(self.delayed)
+
+    def stats(self):
+        """
+        Счетчики отправки и задержки в очереди
+        :return: dict
+        """
+        with self.lock:
+            count = self.queue_delay_count
+            return {
+                'queued': self.messages.qsize() + len(self.delayed),
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried,
+                'queue_delay_avg': self.queue_delay_sum / count if count != 0 else 0,
+                'queue_delay_max': self.queue_delay_max
+            }
+
+    def stop(self):
+        """
+        Остановка отправки: новые сообщения не принимаются, уже принятые отправляются
+        в течение drain_timeout секунд
+        :return: None
+        """
+        with self.lock:
+            if self.stopped:
+                return
+            self.stopped = True
+
+        deadline = time.monotonic() + self.drain_timeout
+
+        try:
+            for _ in self.threads:
+                # Сигнал остановки имеет наименьший приоритет и обрабатывается после всех сообщений
+                self.messages.put((float('inf'), next(self.counter), 0, None, 0, None),
+                                  timeout=max(deadline - time.monotonic(), 0))
+        except queue.Full:
+            app.logger.warning("VK send queue was not drained in %s seconds", self.drain_timeout)
+            return
+
+        for thread in self.threads:
+            thread.join(max(deadline - time.monotonic(), 0))
@@ -0,0 +1,183 @@
+import atexit
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+
+from database import get_conversation, save_conversations
+from server import app, db
+
+
+# Состояние диалога пользователя: текущий шаг, последняя отправленная клавиатура и даты начала и последнего перехода
+ConversationState = namedtuple('ConversationState', ['user_id', 'step_id', 'keyboard', 'created_at', 'updated_at'])
+
+
+class ConversationStore(object):
+    """
+    Хранилище состояний диалогов пользователей.
+    Состояния хранятся в ограниченном LRU в памяти воркера, изменения записываются
+    в таблицу conversations пачками из фонового потока.
+    Состояние читается только для свободного текста и кнопки "Назад" без шага в payload (см. needs_conversation).
+    LRU не инвалидируется между воркерами: если события пользователя попадают в разные воркеры, воркер может
+    повторить на свободный текст устаревший шаг. Клавиатуры содержат шаг в payload кнопки "Назад", поэтому
+    переходы по кнопкам от этого не зависят
+    Attributes:
+        max_size: int - Максимальное количество состояний в памяти
+        flush_interval: float - Как часто (в секундах) записывать измененные состояния
+        batch_size: int - Количество измененных состояний, при котором запись начинается досрочно
+        states: OrderedDict - Состояния по ID пользователя ВК в порядке последнего обращения
+        dirty: {int: ConversationState} - Измененные и еще не записанные состояния
+    """
+    def __init__(self, max_size: int = 100000, flush_interval: float = 5, batch_size: int = 500):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.states = OrderedDict()
+        self.dirty = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.stopped = False
+
+        # Регистрируется при создании, чтобы при выходе записать состояния после обработки очереди событий бота
+        atexit.register(self.stop)
+
+    def __start(self):
+        with self.lock:
+            if self.thread is not None or self.stopped:
+                return
+
+            self.thread = threading.Thread(target=self.__run, name='conversations-writer', daemon=True)
+            self.thread.start()
+
+    def __run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def __remember(self, state):
+        self.states[state.user_id] = state
+        self.states.move_to_end(state.user_id)
+        while len(self.states) > self.max_size:
+            self.states.popitem(last=False)
+
+    def __load(self, user_id):
+        """
+        Загрузка состояния пользователя, которого нет в памяти воркера.
+        Выполняется один раз на пользователя, пока он не вытеснен из LRU
+        """
+        conversation = get_conversation(user_id)
+        if conversation is None:
+            return ConversationState(user_id, None, None, None, None)
+
+        return ConversationState(user_id, conversation.step_id, conversation.keyboard, conversation.created_at,
+                                 conversation.updated_at)
+
+    def get_cached(self, user_id: int):
+        """
+        Получение состояния диалога пользователя только из памяти воркера
+        :param user_id: int - ID пользователя ВК
+        :return: ConversationState - None, если состояния нет в памяти
+        """
+        with self.lock:
+            state = self.states.get(user_id)
+            if state is not None:
+                self.states.move_to_end(user_id)
+            return state
+
+    def put_loaded(self, state):
+        """
+        Сохранение в памяти состояния, загруженного из БД вне хранилища (например, асинхронным клиентом)
+        :param state: ConversationState - Загруженное состояние
+        :return: ConversationState - Актуальное состояние
+        """
+        with self.lock:
+            # Пока состояние загружалось, его мог изменить другой поток
+            current = self.states.get(state.user_id)
+            if current is not None:
+                return current
+            self.__remember(state)
+
+        return state
+
+    def get(self, user_id: int):
+        """
+        Получение состояния диалога пользователя
+        :param user_id: int - ID пользователя ВК
+        :return: ConversationState - Состояние (step_id = None, если пользователь еще не общался с ботом)
+        """
+        state = self.get_cached(user_id)
+        if state is not None:
+            return state
+
+        return self.put_loaded(self.__load(user_id))
+
+    def set(self, user_id: int, step_id: int, keyboard: str = None):
+        """
+        Сохранение перехода пользователя на шаг
+        :param user_id: int - ID пользователя ВК
+        :param step_id: int - ID шага, отправленного пользователю
+        :param keyboard: str - JSON отправленной клавиатуры
+        :return: ConversationState
+        """
+        if self.thread is None:
+            self.__start()
+
+        now = datetime.utcnow()
+
+        with self.lock:
+            previous = self.states.get(user_id)
+            created_at = now if previous is None or previous.created_at is None else previous.created_at
+            state = ConversationState(user_id, step_id, keyboard, created_at, now)
+
+            self.__remember(state)
+            self.dirty[user_id] = state
+            size = len(self.dirty)
+
+        if size >= self.batch_size:
+            self.wakeup.set()
+
+        return state
+
+    def flush(self):
+        """
+        Запись измененных состояний в БД
+        :return: None
+        """
+        with self.lock:
+            states = list(self.dirty.values())
+            self.dirty = {}
+
+        if len(states) == 0:
+            return
+
+        saved = 0
+        with app.app_context():
+            try:
+                for i in range(0, len(states), self.batch_size):
+                    save_conversations([state._asdict() for state in states[i:i + self.batch_size]])
+                    saved = i + self.batch_size
+            except Exception as e:
+                db.session.rollback()
+                app.logger.exception(e)
+                self.__restore(states[saved:])
+            finally:
+                db.session.remove()
+
+    def __restore(self, states):
+        """
+        Возврат незаписанных состояний для повторной записи при следующем flush.
+        Состояние, измененное после начала записи, не заменяется
+        """
+        with self.lock:
+            for state in states:
+                self.dirty.setdefault(state.user_id, state)
+
+    def stop(self):
+        """
+        Остановка фоновой записи с записью оставшихся состояний
+        :return: None
+        """
+        self.stopped = True
+        self.wakeup.set()
+        self.flush()
@@ -0,0 +1,114 @@
+import atexit
+import threading
+from datetime import datetime
+
+from database import save_subscribers
+from server import app, db
+
+
+class SubscriberRegistry(object):
+    """
+    Реестр подписчиков бота. События от пользователей накапливаются в памяти
+    и записываются в таблицу subscribers пачками из фонового потока
+    Attributes:
+        flush_interval: float - Как часто (в секундах) записывать накопленных подписчиков
+        batch_size: int - Количество накопленных подписчиков, при котором запись начинается досрочно
+        pending: {int: dict} - Накопленные подписчики по ID пользователя ВК
+    """
+    def __init__(self, flush_interval: float = 5, batch_size: int = 500):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.stopped = False
+
+        # Регистрируется при создании, чтобы при выходе записать подписчиков после обработки очереди событий бота
+        atexit.register(self.stop)
+
+    def __start(self):
+        with self.lock:
+            if self.thread is not None or self.stopped:
+                return
+
+            self.thread = threading.Thread(target=self.__run, name='subscribers-writer', daemon=True)
+            self.thread.start()
+
+    def __run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def touch(self, user_id: int, joined: bool = False):
+        """
+        Отметка события от пользователя
+        :param user_id: int - ID пользователя ВК
+        :param joined: bool - Пользователь вступил в сообщество
+        :return: None
+        """
+        if self.thread is None:
+            self.__start()
+
+        now = datetime.utcnow()
+
+        with self.lock:
+            subscriber = self.pending.get(user_id)
+            if subscriber is None:
+                subscriber = {'user_id': user_id, 'joined_at': None, 'last_seen_at': now}
+                self.pending[user_id] = subscriber
+            subscriber['last_seen_at'] = now
+            if joined:
+                subscriber['joined_at'] = now
+
+            size = len(self.pending)
+
+        if size >= self.batch_size:
+            self.wakeup.set()
+
+    def flush(self):
+        """
+        Запись накопленных подписчиков в БД
+        :return: None
+        """
+        with self.lock:
+            subscribers = list(self.pending.values())
+            self.pending = {}
+
+        if len(subscribers) == 0:
+            return
+
+        saved = 0
+        with app.app_context():
+            try:
+                for i in range(0, len(subscribers), self.batch_size):
+                    save_subscribers(subscribers[i:i + self.batch_size])
+                    saved = i + self.batch_size
+            except Exception as e:
+                db.session.rollback()
+                app.logger.exception(e)
+                self.__restore(subscribers[saved:])
+            finally:
+                db.session.remove()
+
+    def __restore(self, subscribers):
+        """
+        Возврат незаписанных подписчиков для повторной записи при следующем flush.
+        Если от пользователя пришло новое событие во время записи, остается новая запись,
+        в которую переносится только дата вступления
+        """
+        with self.lock:
+            for subscriber in subscribers:
+                newer = self.pending.setdefault(subscriber['user_id'], subscriber)
+                if newer['joined_at'] is None:
+                    newer['joined_at'] = subscriber['joined_at']
+
+    def stop(self):
+        """
+        Остановка фоновой записи с записью оставшихся подписчиков
+        :return: None
+        """
+        self.stopped = True
+        self.wakeup.set()
+        self.flush()
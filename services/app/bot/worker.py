@@ -0,0 +1,122 @@
+import atexit
+import queue
+import threading
+import time
+
+from server import app, db, instrumentation
+from server.log import log_request_id
+
+
+class EventQueue(object):
+    """
+    Ограниченная очередь событий VK Callback API с пулом фоновых обработчиков.
+    Позволяет отвечать VK сразу, а маршрутизацию и отправку сообщений выполнять в фоне
+    Attributes:
+        router: Router - Маршрутизатор, которому передаются события
+        workers_count: int - Количество потоков-обработчиков. 0 - события обрабатываются синхронно
+        put_timeout: float - Сколько секунд ждать свободного места в очереди
+        drain_timeout: float - Сколько секунд ждать обработки оставшихся событий при остановке
+        events: queue.Queue - Очередь событий
+        workers: [threading.Thread] - Запущенные потоки-обработчики
+    """
+    def __init__(self, router, workers_count: int = 4, max_size: int = 1000, put_timeout: float = 0.05,
+                 drain_timeout: float = 10):
+        self.router = router
+        self.workers_count = workers_count
+        self.put_timeout = put_timeout
+        self.drain_timeout = drain_timeout
+        self.events = queue.Queue(maxsize=max_size)
+        self.workers = []
+        self.lock = threading.Lock()
+        self.stopped = False
+
+    def __start(self):
+        """
+        Запуск потоков-обработчиков. Потоки запускаются при первом событии, уже после форка воркера gunicorn
+        :return: None
+        """
+        with self.lock:
+            if len(self.workers) != 0 or self.stopped:
+                return
+
+            for i in range(self.workers_count):
+                worker = threading.Thread(target=self.__run, name='bot-worker-{}'.format(i), daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+            atexit.register(self.stop)
+
+    def __process(self, data):
+        with app.app_context(), log_request_id(data.get('event_id')), \
+                instrumentation.track('event {}'.format(data.get('type'))):
+            try:
+                self.router.route(data)
+            except Exception as e:
+                app.logger.exception(e)
+            finally:
+                db.session.remove()
+
+    def __run(self):
+        while True:
+            data = self.events.get()
+            try:
+                if data is None:
+                    return
+                self.__process(data)
+            finally:
+                self.events.task_done()
+
+    def put(self, data):
+        """
+        Постановка события в очередь
+        :param data: JSON - Данные, полученные в запросе к боту от Callback API
+        :return: bool - False, если очередь переполнена или остановлена и событие не принято
+        """
+        if self.workers_count <= 0:
+            self.router.route(data)
+            return True
+
+        if self.stopped:
+            return False
+
+        if len(self.workers) == 0:
+            self.__start()
+
+        try:
+            self.events.put(data, timeout=self.put_timeout)
+        except queue.Full:
+            app.logger.warning("Bot event queue is full, event rejected")
+            return False
+
+        return True
+
+    def size(self):
+        """
+        Количество событий, ожидающих обработки
+        :return: int
+        """
+        return self.events.qsize()
+
+    def stop(self):
+        """
+        Остановка очереди: новые события не принимаются, уже принятые обрабатываются
+        в течение drain_timeout секунд
+        :return: None
+        """
+        with self.lock:
+            if self.stopped:
+                return
+            self.stopped = True
+
+        deadline = time.monotonic() + self.drain_timeout
+
+        try:
+            for _ in self.workers:
+                # Сигнал остановки ставится после всех принятых событий
+                self.events.put(None, timeout=max(deadline - time.monotonic(), 0))
+        except queue.Full:
+            app.logger.warning("Bot event queue was not drained in %s seconds", self.drain_timeout)
+            return
+
+        for worker in self.workers:
+            worker.join(max(deadline - time.monotonic(), 0))
@@ -1,14 +1,64 @@
 from datetime import datetime
-from .models import Step, Button, User, Role
+from sqlalchemy import func, and_, exists, literal, tuple_
+from sqlalchemy.sql import text as sql_text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import joinedload, selectinload
+from .models import Step, Button, User, Role, ProcessedEvent, Subscriber, Broadcast, \
+    Conversation
+from .graph import get_graph, get_cached_graph, invalidate_graph, bump_graph_version, get_graph_version
+from .importer import GraphImporter, GraphImportError
+from .principals import Principal, get_principal, invalidate_principal
+from .notifications import publish_change, start_change_listener, change_listener
 from server import db
 
 
-def get_steps_list():
+# Поля, которые можно запросить в списке шагов
+STEPS_LIST_FIELDS = ('id', 'text', 'unreachable', 'is_root', 'created_at', 'updated_at')
+
+
+def _steps_list_columns():
+    return {
+        'id': Step.id,
+        'text': Step.text,
+        'unreachable': ~exists().where(Button.to_step_id == Step.id),
+        'is_root': Step.is_root,
+        'created_at': Step.created_at,
+        'updated_at': Step.updated_at
+    }
+
+
+def get_steps_list(fields=STEPS_LIST_FIELDS, limit: int = None, cursor: tuple = None, unreachable: bool = None,
+                   text_prefix: str = None):
     """
-    Получение списка шагов бота
-    :return: [Step]
+    Получение списка шагов бота, отсортированного по убыванию (created_at, id).
+    Загружаются только запрошенные столбцы, страница следующих шагов начинается после cursor
+    :param fields: [str] - Поля шагов из STEPS_LIST_FIELDS
+    :param limit: int - Максимальное количество шагов (None - все шаги)
+    :param cursor: (datetime, int) - (created_at, id) последнего шага предыдущей страницы
+    :param unreachable: bool - Только шаги, на которые не ведет (True) или ведет (False) кнопка
+    :param text_prefix: str - Только шаги, текст которых начинается с этой строки
+    :return: [Row] - Строки с запрошенными полями, а также created_at и id для курсора следующей страницы
     """
-    return Step.query.order_by(Step.created_at.desc()).all()
+    columns = _steps_list_columns()
+    selected = [columns[field].label(field) for field in fields if field in columns]
+    for field in ('created_at', 'id'):
+        if field not in fields:
+            selected.append(columns[field].label(field))
+
+    query = db.session.query(*selected)
+
+    if unreachable is not None:
+        query = query.filter(columns['unreachable'] if unreachable else ~columns['unreachable'])
+    if text_prefix:
+        query = query.filter(Step.text.startswith(text_prefix, autoescape=True))
+    if cursor is not None:
+        query = query.filter(tuple_(Step.created_at, Step.id) < tuple_(*cursor))
+
+    query = query.order_by(Step.created_at.desc(), Step.id.desc())
+    if limit is not None:
+        query = query.limit(limit)
+
+    return query.all()
 
 
 def get_step(step_id: int):
@@ -17,7 +67,38 @@ def get_step(step_id: int):
     :param step_id: int - ID шага
     :return: Step
     """
-    return Step.query.get(step_id)
+    return Step.query.options(selectinload(Step.buttons), selectinload(Step.from_button)).get(step_id)
+
+
+def get_step_revision(step_id: int):
+    """
+    Получение значений, от которых зависит сериализованный шаг, одним запросом без загрузки моделей:
+    дата изменения и отметка первого шага, количество и последняя дата изменения кнопок шага,
+    наличие кнопки, ведущей на шаг
+    :param step_id: int - ID шага
+    :return: tuple - None, если шага нет
+    """
+    return db.session.execute(sql_text("""
+        SELECT steps.updated_at, steps.is_root,
+               (SELECT count(*) FROM buttons WHERE buttons.step_id = steps.id),
+               (SELECT max(buttons.updated_at) FROM buttons WHERE buttons.step_id = steps.id),
+               EXISTS (SELECT 1 FROM buttons WHERE buttons.to_step_id = steps.id)
+        FROM steps
+        WHERE steps.id = :step_id
+    """), {'step_id': step_id}).first()
+
+
+def _commit_graph_change(entity: str, entity_id: int = None):
+    """
+    Фиксация транзакции, изменяющей шаги или кнопки: увеличение версии графа, уведомление остальных воркеров
+    и инвалидация графа этого воркера
+    :param entity: str - Тип измененной сущности: step или button
+    :param entity_id: int - ID сущности
+    :return: None
+    """
+    publish_change(entity, entity_id, bump_graph_version())
+    db.session.commit()
+    invalidate_graph()
 
 
 def create_step(text: str):
@@ -30,7 +111,8 @@ def create_step(text: str):
     new_step.created_at = datetime.utcnow()
     new_step.updated_at = datetime.utcnow()
     db.session.add(new_step)
-    db.session.commit()
+    db.session.flush()
+    _commit_graph_change('step', new_step.id)
 
     return new_step
 
@@ -42,7 +124,7 @@ def update_step(step):
     :return: None
     """
     step.updated_at = datetime.utcnow()
-    db.session.commit()
+    _commit_graph_change('step', step.id)
 
 
 def delete_step(step_id):
@@ -52,16 +134,47 @@ def delete_step(step_id):
     :return: None
     """
     Step.query.filter(Step.id == step_id).delete()
-    db.session.commit()
+    _commit_graph_change('step', step_id)
 
 
 def get_first_step():
     """
     Получение первого шага бота.
-    Первый шаг - шаг, на который не ведет кнопка
+    Первый шаг - шаг, отмеченный is_root. Если такого нет, то шаг, на который не ведет кнопка
     :return: Step
     """
-    return Step.query.filter(Step.from_button == None).first()
+    root_step = Step.query.filter(Step.is_root == True).first()
+    if root_step is not None:
+        return root_step
+
+    return Step.query.filter(Step.from_button == None).order_by(Step.id).first()
+
+
+def _mark_root_step(step_id: int, is_root: bool):
+    """
+    Отметка шага первым шагом бота без фиксации транзакции
+    :param step_id: int - ID шага
+    :param is_root: bool - False - снять отметку с шага
+    :return: None
+    """
+    steps = Step.__table__
+
+    # Снятие и установка отметки выполняются отдельными запросами, так как уникальный индекс проверяется построчно
+    other_steps = (steps.c.id != step_id) if is_root else (steps.c.id == step_id)
+    db.session.execute(steps.update().where(and_(steps.c.is_root == True, other_steps)).values(is_root=False))
+    if is_root:
+        db.session.execute(steps.update().where(steps.c.id == step_id).values(is_root=True))
+
+
+def set_root_step(step_id: int, is_root: bool = True):
+    """
+    Отметка шага первым шагом бота. Предыдущий первый шаг перестает быть первым
+    :param step_id: int - ID шага
+    :param is_root: bool - False - снять отметку с шага
+    :return: None
+    """
+    _mark_root_step(step_id, is_root)
+    _commit_graph_change('step', step_id)
 
 
 def create_button(button_type: str, label: str, color: str, row: int, column: int, step_id: int, to_step_id: int):
@@ -89,7 +202,8 @@ def create_button(button_type: str, label: str, color: str, row: int, column: in
     button.updated_at = datetime.utcnow()
 
     db.session.add(button)
-    db.session.commit()
+    db.session.flush()
+    _commit_graph_change('button', button.id)
 
     return button
 
@@ -110,7 +224,7 @@ def update_button(button):
     :return: None
     """
     button.updated_at = datetime.utcnow()
-    db.session.commit()
+    _commit_graph_change('button', button.id)
 
 
 def delete_button(button_id):
@@ -120,7 +234,216 @@ def delete_button(button_id):
     :return:
     """
     Button.query.filter(Button.id == button_id).delete()
-    db.session.commit()
+    _commit_graph_change('button', button_id)
+
+
+def get_graph_rows(root_id: int = None, depth: int = None, batch_size: int = 1000):
+    """
+    Получение шагов и кнопок графа диалога двумя запросами с потоковым чтением результатов.
+    Шаги отсортированы по id, кнопки - по step_id, поэтому их можно объединять по мере чтения
+    :param root_id: int - ID корня подграфа (None - весь граф)
+    :param depth: int - Максимальная глубина подграфа от корня (None - без ограничения)
+    :param batch_size: int - Сколько строк читать из курсора за раз
+    :return: (Query, Query) - Шаги (id, text, is_root, unreachable, created_at, updated_at)
+        и кнопки (id, step_id, type, color, label, row, column, to_step_id)
+    """
+    unreachable = ~exists().where(Button.to_step_id == Step.id)
+    steps = db.session.query(Step.id, Step.text, Step.is_root, unreachable.label('unreachable'), Step.created_at,
+                             Step.updated_at)
+    buttons = db.session.query(Button.id, Button.step_id, Button.type, Button.color, Button.label, Button.row,
+                               Button.column, Button.to_step_id)
+
+    if root_id is not None:
+        if depth is None:
+            # UNION по id останавливает обход на циклах
+            tree = db.session.query(Step.id.label('id')).filter(Step.id == root_id).cte('tree', recursive=True)
+            tree = tree.union(db.session.query(Button.to_step_id).join(tree, Button.step_id == tree.c.id)
+                              .filter(Button.to_step_id != None))
+        else:
+            tree = db.session.query(Step.id.label('id'), literal(0).label('depth')).filter(Step.id == root_id)\
+                .cte('tree', recursive=True)
+            tree = tree.union(db.session.query(Button.to_step_id, tree.c.depth + 1)
+                              .join(tree, Button.step_id == tree.c.id)
+                              .filter(Button.to_step_id != None, tree.c.depth < depth))
+
+        tree_ids = db.session.query(tree.c.id)
+        steps = steps.filter(Step.id.in_(tree_ids))
+        buttons = buttons.filter(Button.step_id.in_(tree_ids))
+    else:
+        buttons = buttons.filter(Button.step_id != None)
+
+    steps = steps.order_by(Step.id).yield_per(batch_size)
+    buttons = buttons.order_by(Button.step_id, Button.id).yield_per(batch_size)
+
+    return steps, buttons
+
+
+def _serialize_button(row):
+    """
+    Сериализация строки таблицы buttons так же, как Button.serialize
+    :param row: RowProxy - Строка, полученная из RETURNING
+    :return: dict
+    """
+    return {
+        'id': row['id'],
+        'type': row['type'],
+        'color': row['color'],
+        'label': row['label'],
+        'row': row['row'],
+        'column': row['column'],
+        'to_step_id': row['to_step_id']
+    }
+
+
+def _insert_buttons(step_id: int, buttons: list, now: datetime):
+    """
+    Добавление кнопок шага одним запросом INSERT ... RETURNING
+    :param step_id: int - ID шага
+    :param buttons: [dict] - Кнопки: type, color, label, row, column, to_step_id
+    :param now: datetime - Дата создания
+    :return: [dict] - Сериализованные кнопки
+    """
+    if len(buttons) == 0:
+        return []
+
+    table = Button.__table__
+    values = [{
+        'type': button['type'],
+        'color': button['color'],
+        'label': button['label'],
+        'row': button['row'],
+        'column': button['column'],
+        'to_step_id': button['to_step_id'],
+        'step_id': step_id,
+        'created_at': now,
+        'updated_at': now
+    } for button in buttons]
+
+    rows = db.session.execute(table.insert().values(values).returning(*table.c)).fetchall()
+
+    return [_serialize_button(row) for row in rows]
+
+
+def _update_buttons(step_id: int, buttons: list, now: datetime):
+    """
+    Обновление кнопок шага одним запросом UPDATE ... FROM (VALUES ...) RETURNING
+    :param step_id: int - ID шага
+    :param buttons: [dict] - Кнопки со всеми полями: id, type, color, label, row, column, to_step_id
+    :param now: datetime - Дата изменения
+    :return: [dict] - Сериализованные кнопки
+    """
+    if len(buttons) == 0:
+        return []
+
+    params = {'step_id': step_id, 'now': now}
+    values = []
+    for i, button in enumerate(buttons):
+        values.append('(CAST(:id_{0} AS integer), CAST(:type_{0} AS varchar), CAST(:color_{0} AS varchar), '
+                      'CAST(:label_{0} AS varchar), CAST(:row_{0} AS integer), CAST(:column_{0} AS integer), '
+                      'CAST(:to_step_id_{0} AS integer))'.format(i))
+        for key in ['id', 'type', 'color', 'label', 'row', 'column', 'to_step_id']:
+            params['{}_{}'.format(key, i)] = button[key]
+
+    statement = sql_text("""
+        UPDATE buttons SET type = v.type, color = v.color, label = v.label, row = v.row, "column" = v."column",
+            to_step_id = v.to_step_id, updated_at = :now
+        FROM (VALUES {}) AS v (id, type, color, label, row, "column", to_step_id)
+        WHERE buttons.id = v.id AND buttons.step_id = :step_id
+        RETURNING buttons.id, buttons.type, buttons.color, buttons.label, buttons.row, buttons."column",
+            buttons.to_step_id
+    """.format(', '.join(values)))
+
+    rows = db.session.execute(statement, params).fetchall()
+
+    return [_serialize_button(row) for row in rows]
+
+
+def create_step_with_buttons(text: str, buttons: list = None, is_root: bool = False):
+    """
+    Добавление шага вместе с кнопками одной транзакцией
+    :param text: str - Текст шага
+    :param buttons: [dict] - Кнопки: type, color, label, row, column, to_step_id
+    :param is_root: bool - Отметить шаг первым шагом бота
+    :return: dict - Сериализованный шаг (без повторной загрузки из БД)
+    """
+    now = datetime.utcnow()
+    steps = Step.__table__
+
+    try:
+        step = db.session.execute(steps.insert().values(text=text, is_root=False, created_at=now, updated_at=now)
+                                  .returning(*steps.c)).first()
+        if is_root:
+            _mark_root_step(step['id'], True)
+
+        serialized_buttons = _insert_buttons(step['id'], buttons or [], now)
+    except Exception:
+        db.session.rollback()
+        raise
+
+    _commit_graph_change('step', step['id'])
+
+    return {
+        'id': step['id'],
+        'text': step['text'],
+        'buttons': serialized_buttons,
+        'unreachable': True,
+        'is_root': is_root,
+        'created_at': step['created_at'],
+        'updated_at': step['updated_at']
+    }
+
+
+def update_step_with_buttons(step, text: str = None, is_root: bool = None, created_buttons: list = None,
+                             updated_buttons: list = None, deleted_button_ids: list = None):
+    """
+    Обновление шага и его кнопок одной транзакцией
+    :param step: Step - Шаг с загруженными кнопками (см. get_step)
+    :param text: str - Новый текст шага (None - не менять)
+    :param is_root: bool - Отметить шаг первым шагом бота (None - не менять)
+    :param created_buttons: [dict] - Новые кнопки: type, color, label, row, column, to_step_id
+    :param updated_buttons: [dict] - Измененные кнопки со всеми полями, включая id
+    :param deleted_button_ids: [int] - ID удаляемых кнопок шага
+    :return: dict - Сериализованный шаг (без повторной загрузки из БД)
+    """
+    now = datetime.utcnow()
+    steps = Step.__table__
+    buttons_table = Button.__table__
+
+    serialized = step.serialize()
+    buttons = {button['id']: button for button in serialized['buttons']}
+
+    try:
+        if deleted_button_ids:
+            db.session.execute(buttons_table.delete().where(and_(buttons_table.c.id.in_(deleted_button_ids),
+                                                                 buttons_table.c.step_id == step.id)))
+            for button_id in deleted_button_ids:
+                buttons.pop(button_id, None)
+
+        for button in _update_buttons(step.id, updated_buttons or [], now):
+            buttons[button['id']] = button
+
+        for button in _insert_buttons(step.id, created_buttons or [], now):
+            buttons[button['id']] = button
+
+        values = {'updated_at': now}
+        if text is not None:
+            values['text'] = text
+        db.session.execute(steps.update().where(steps.c.id == step.id).values(**values))
+
+        if is_root is not None:
+            _mark_root_step(step.id, is_root)
+    except Exception:
+        db.session.rollback()
+        raise
+
+    _commit_graph_change('step', step.id)
+
+    serialized.update(values)
+    serialized['buttons'] = [buttons[button_id] for button_id in sorted(buttons)]
+    if is_root is not None:
+        serialized['is_root'] = is_root
+
+    return serialized
 
 
 # Users
@@ -130,7 +453,7 @@ def find_user(email):
     :param email: str - Email адрес пользователя
     :return: User
     """
-    return User.query.filter(User.email == email).first()
+    return User.query.options(joinedload(User.role)).filter(User.email == email).first()
 
 
 def create_user(email, password, name, surname, role_id):
@@ -153,12 +476,51 @@ def create_user(email, password, name, surname, role_id):
     return new_user
 
 
-def get_users_list():
+# Поля, которые можно запросить в списке пользователей
+USERS_LIST_FIELDS = ('id', 'email', 'name', 'surname', 'role', 'created_at', 'updated_at')
+
+# У пользователей, созданных до появления столбца created_at, дата не заполнена
+_USERS_LIST_EPOCH = datetime(1970, 1, 1)
+
+
+def get_users_list(fields=USERS_LIST_FIELDS, limit: int = None, cursor: tuple = None, role: str = None,
+                   email_prefix: str = None):
     """
-    Получение списка пользователей админки
-    :return: [User]
+    Получение списка пользователей админки, отсортированного по убыванию (created_at, id).
+    Загружаются только запрошенные столбцы, страница следующих пользователей начинается после cursor
+    :param fields: [str] - Поля пользователей из USERS_LIST_FIELDS
+    :param limit: int - Максимальное количество пользователей (None - все пользователи)
+    :param cursor: (datetime, int) - (created_at, id) последнего пользователя предыдущей страницы
+    :param role: str - Только пользователи с этой ролью (название роли без учета регистра)
+    :param email_prefix: str - Только пользователи, email которых начинается с этой строки
+    :return: [Row] - Строки с запрошенными полями (role - role_id и role_name),
+        а также sort_key и id для курсора следующей страницы
     """
-    return User.query.order_by(User.created_at.desc()).all()
+    sort_key = func.coalesce(User.created_at, literal(_USERS_LIST_EPOCH))
+
+    selected = [sort_key.label('sort_key'), User.id.label('id')]
+    for field in fields:
+        if field == 'role':
+            selected += [Role.id.label('role_id'), Role.name.label('role_name')]
+        elif field != 'id' and field in USERS_LIST_FIELDS:
+            selected.append(getattr(User, field).label(field))
+
+    query = db.session.query(*selected).select_from(User)
+    if 'role' in fields or role is not None:
+        query = query.outerjoin(Role, User.role_id == Role.id)
+
+    if role is not None:
+        query = query.filter(func.lower(Role.name) == role.lower())
+    if email_prefix:
+        query = query.filter(User.email.startswith(email_prefix, autoescape=True))
+    if cursor is not None:
+        query = query.filter(tuple_(sort_key, User.id) < tuple_(*cursor))
+
+    query = query.order_by(sort_key.desc(), User.id.desc())
+    if limit is not None:
+        query = query.limit(limit)
+
+    return query.all()
 
 
 def get_user(user_id):
@@ -167,7 +529,25 @@ def get_user(user_id):
     :param user_id: int - ID пользователя
     :return: User
     """
-    return User.query.get(user_id)
+    return User.query.options(joinedload(User.role)).get(user_id)
+
+
+def get_user_revision(user_id: int):
+    """
+    Получение значений, от которых зависит сериализованный пользователь, без загрузки модели
+    :param user_id: int - ID пользователя
+    :return: tuple - (updated_at, role_id) или None, если пользователя нет
+    """
+    return db.session.query(User.updated_at, User.role_id).filter(User.id == user_id).first()
+
+
+def get_users_revision():
+    """
+    Получение значений, от которых зависит список пользователей: количество,
+    последняя дата изменения и наибольший ID (меняется при удалении и добавлении одновременно)
+    :return: tuple
+    """
+    return db.session.query(func.count(User.id), func.max(User.updated_at), func.max(User.id)).one()
 
 
 def delete_user(user_id):
@@ -177,7 +557,9 @@ def delete_user(user_id):
     :return: None
     """
     User.query.filter(User.id == user_id).delete()
+    publish_change('user', user_id)
     db.session.commit()
+    invalidate_principal(user_id)
 
 
 def update_user(user):
@@ -187,6 +569,19 @@ def update_user(user):
     :return: None
     """
     user.updated_at = datetime.utcnow()
+    publish_change('user', user.id)
+    db.session.commit()
+    invalidate_principal(user.id)
+
+
+def set_user_password(user_id: int, password: str):
+    """
+    Замена хеша пароля пользователя без изменения даты обновления (пересчет хеша с новой стоимостью)
+    :param user_id: int - ID пользователя
+    :param password: str - Hash пароль пользователя
+    :return: None
+    """
+    User.query.filter(User.id == user_id).update({User.password: password}, synchronize_session=False)
     db.session.commit()
 
 
@@ -198,3 +593,160 @@ def get_role(role_id):
     :return: Role
     """
     return Role.query.get(role_id)
+
+
+# Processed events
+def register_event(event_id: str):
+    """
+    Регистрация события VK Callback API как обработанного
+    :param event_id: str - ID события
+    :return: bool - True, если событие зарегистрировано впервые
+    """
+    statement = insert(ProcessedEvent.__table__).values(event_id=event_id, created_at=datetime.utcnow())\
+        .on_conflict_do_nothing(index_elements=['event_id']).returning(ProcessedEvent.event_id)
+    inserted = db.session.execute(statement).first()
+    db.session.commit()
+
+    return inserted is not None
+
+
+def forget_event(event_id: str):
+    """
+    Удаление отметки об обработке события, чтобы повторная доставка была обработана
+    :param event_id: str - ID события
+    :return: None
+    """
+    ProcessedEvent.query.filter(ProcessedEvent.event_id == event_id).delete()
+    db.session.commit()
+
+
+def delete_processed_events(before: datetime):
+    """
+    Удаление устаревших отметок об обработанных событиях
+    :param before: datetime - Удаляются события, полученные раньше этой даты
+    :return: None
+    """
+    ProcessedEvent.query.filter(ProcessedEvent.created_at < before).delete()
+    db.session.commit()
+
+
+# Subscribers
+def save_subscribers(subscribers: list):
+    """
+    Добавление и обновление подписчиков одним запросом
+    :param subscribers: [dict] - Подписчики: user_id, joined_at (может быть None), last_seen_at
+    :return: None
+    """
+    if len(subscribers) == 0:
+        return
+
+    now = datetime.utcnow()
+    statement = insert(Subscriber.__table__).values([dict(subscriber, created_at=now) for subscriber in subscribers])
+    statement = statement.on_conflict_do_update(index_elements=['user_id'], set_={
+        'joined_at': func.coalesce(statement.excluded.joined_at, Subscriber.joined_at),
+        'last_seen_at': func.greatest(statement.excluded.last_seen_at, Subscriber.last_seen_at)
+    })
+    db.session.execute(statement)
+    db.session.commit()
+
+
+def _filter_subscribers(query, joined_after: datetime = None, active_after: datetime = None):
+    if joined_after is not None:
+        query = query.filter(Subscriber.joined_at >= joined_after)
+    if active_after is not None:
+        query = query.filter(Subscriber.last_seen_at >= active_after)
+    return query
+
+
+def count_subscribers(joined_after: datetime = None, active_after: datetime = None):
+    """
+    Количество подписчиков, подходящих под фильтры
+    :param joined_after: datetime - Вступившие в сообщество не раньше этой даты
+    :param active_after: datetime - Писавшие боту не раньше этой даты
+    :return: int
+    """
+    query = _filter_subscribers(db.session.query(func.count(Subscriber.user_id)), joined_after, active_after)
+    return query.scalar()
+
+
+def get_subscriber_ids(after_user_id: int = None, limit: int = 1000, joined_after: datetime = None,
+                       active_after: datetime = None):
+    """
+    Получение страницы ID подписчиков, отсортированных по возрастанию
+    :param after_user_id: int - ID последнего подписчика предыдущей страницы
+    :param limit: int - Размер страницы
+    :param joined_after: datetime - Вступившие в сообщество не раньше этой даты
+    :param active_after: datetime - Писавшие боту не раньше этой даты
+    :return: [int]
+    """
+    query = _filter_subscribers(db.session.query(Subscriber.user_id), joined_after, active_after)
+    if after_user_id is not None:
+        query = query.filter(Subscriber.user_id > after_user_id)
+
+    return [row[0] for row in query.order_by(Subscriber.user_id).limit(limit).all()]
+
+
+# Broadcasts
+def create_broadcast(step_id: int, total: int):
+    """
+    Создание рассылки
+    :param step_id: int - ID рассылаемого шага
+    :param total: int - Количество подписчиков в рассылке
+    :return: Broadcast
+    """
+    broadcast = Broadcast(step_id=step_id, status='running', total=total, sent=0, failed=0)
+    broadcast.created_at = datetime.utcnow()
+    broadcast.updated_at = datetime.utcnow()
+
+    db.session.add(broadcast)
+    db.session.commit()
+
+    return broadcast
+
+
+def get_broadcast(broadcast_id: int):
+    """
+    Получение рассылки по id
+    :param broadcast_id: int - ID рассылки
+    :return: Broadcast
+    """
+    return Broadcast.query.get(broadcast_id)
+
+
+def update_broadcast(broadcast):
+    """
+    Обновление прогресса рассылки
+    :param broadcast: Broadcast - Рассылка с обновленными полями
+    :return: None
+    """
+    broadcast.updated_at = datetime.utcnow()
+    db.session.commit()
+
+
+# Conversations
+def get_conversation(user_id: int):
+    """
+    Получение состояния диалога пользователя
+    :param user_id: int - ID пользователя ВК
+    :return: Conversation
+    """
+    return Conversation.query.get(user_id)
+
+
+def save_conversations(conversations: list):
+    """
+    Добавление и обновление состояний диалогов одним запросом
+    :param conversations: [dict] - Состояния: user_id, step_id, keyboard, created_at, updated_at
+    :return: None
+    """
+    if len(conversations) == 0:
+        return
+
+    statement = insert(Conversation.__table__).values(conversations)
+    statement = statement.on_conflict_do_update(index_elements=['user_id'], set_={
+        'step_id': statement.excluded.step_id,
+        'keyboard': statement.excluded.keyboard,
+        'updated_at': statement.excluded.updated_at
+    }, where=Conversation.updated_at <= statement.excluded.updated_at)
+    db.session.execute(statement)
+    db.session.commit()
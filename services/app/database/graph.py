@@ -0,0 +1,232 @@
+import threading
+from collections import namedtuple
+
+from sqlalchemy.sql import text as sql_text
+
+from .models import Step, Button
+from server import db
+
+
+# Кнопка скомпилированного графа диалога (поля соответствуют колонкам таблицы buttons)
+ButtonNode = namedtuple('ButtonNode', ['id', 'type', 'label', 'color', 'row', 'column', 'step_id', 'to_step_id'])
+
+# Шаг скомпилированного графа диалога
+# rows - кнопки шага по строкам, отсортированные по колонкам (только кнопки, ведущие на существующий шаг)
+# parent_id - ID шага, с которого идет переход на данный шаг (None - на шаг не ведет ни одна кнопка)
+StepNode = namedtuple('StepNode', ['id', 'text', 'rows', 'parent_id'])
+
+
+class DialogGraph(object):
+    """
+    Неизменяемый граф диалога бота, скомпилированный из таблиц steps и buttons
+    Attributes:
+        version: int - Номер сборки графа
+        steps: {int: StepNode} - Шаги по ID
+        buttons: {int: ButtonNode} - Кнопки по ID
+        root_id: int - ID первого шага бота
+    """
+    def __init__(self, version: int, steps: dict, buttons: dict, root_id):
+        self.version = version
+        self.steps = steps
+        self.buttons = buttons
+        self.root_id = root_id
+
+    def get_step(self, step_id):
+        """
+        Получение шага по id
+        :param step_id: int - ID шага
+        :return: StepNode
+        """
+        return self.steps.get(step_id)
+
+    def get_button(self, button_id):
+        """
+        Получение кнопки по id
+        :param button_id: int - ID кнопки
+        :return: ButtonNode
+        """
+        return self.buttons.get(button_id)
+
+    def get_first_step(self):
+        """
+        Получение первого шага бота
+        :return: StepNode
+        """
+        return self.steps.get(self.root_id)
+
+    def get_next_step(self, button_id):
+        """
+        Получение шага, на который ведет кнопка
+        :param button_id: int - ID кнопки
+        :return: StepNode
+        """
+        button = self.buttons.get(button_id)
+        if button is None:
+            return None
+        return self.steps.get(button.to_step_id)
+
+    def get_prev_step(self, step_id):
+        """
+        Получение шага, с которого идет переход на данный шаг
+        :param step_id: int - ID шага
+        :return: StepNode
+        """
+        step = self.steps.get(step_id)
+        if step is None or step.parent_id is None:
+            return None
+        return self.steps.get(step.parent_id)
+
+
+def compile_graph(version: int, steps: list, buttons: list):
+    """
+    Компиляция графа диалога из строк таблиц steps и buttons
+    :param version: int - Номер сборки графа
+    :param steps: [(id, text, is_root)] - Шаги
+    :param buttons: [ButtonNode] - Кнопки
+    :return: DialogGraph
+    """
+    step_texts = {step_id: text for step_id, text, _ in steps}
+    buttons_by_id = {button.id: button for button in buttons}
+
+    step_buttons = {}
+    parents = {}
+    for button in sorted(buttons, key=lambda btn: (btn.row, btn.column, btn.id)):
+        # Как и в Step.from_button, родителем считается шаг первой кнопки, ведущей на шаг
+        if button.to_step_id in step_texts and button.step_id in step_texts:
+            parent = parents.get(button.to_step_id)
+            if parent is None or parent.id > button.id:
+                parents[button.to_step_id] = button
+
+        if button.to_step_id not in step_texts:
+            continue
+
+        rows = step_buttons.setdefault(button.step_id, [])
+        if len(rows) == 0 or rows[-1][-1].row != button.row:
+            rows.append([])
+        rows[-1].append(button)
+
+    nodes = {}
+    for step_id, text in step_texts.items():
+        parent = parents.get(step_id)
+        nodes[step_id] = StepNode(id=step_id, text=text,
+                                  rows=tuple(tuple(row) for row in step_buttons.get(step_id, [])),
+                                  parent_id=None if parent is None else parent.step_id)
+
+    # Первый шаг - шаг, отмеченный is_root. Если такого нет, то шаг с наименьшим ID, на который не ведет кнопка
+    roots = [step_id for step_id, _, is_root in steps if is_root]
+    if len(roots) == 0:
+        roots = [step_id for step_id in step_texts if step_id not in parents]
+    root_id = min(roots) if len(roots) != 0 else None
+
+    return DialogGraph(version, nodes, buttons_by_id, root_id)
+
+
+def _load_graph(version: int):
+    """
+    Загрузка графа диалога из БД двумя запросами
+    :param version: int - Номер сборки графа
+    :return: DialogGraph
+    """
+    steps = db.session.query(Step.id, Step.text, Step.is_root).all()
+    buttons = [ButtonNode(*row) for row in db.session.query(Button.id, Button.type, Button.label, Button.color,
+                                                               Button.row, Button.column, Button.step_id,
+                                                               Button.to_step_id).all()]
+    return compile_graph(version, steps, buttons)
+
+
+_build_lock = threading.Lock()
+_version_lock = threading.Lock()
+_graph = None
+_version = 0
+# Версия графа в БД, прочитанная перед сборкой текущего графа
+_graph_db_version = None
+
+
+def get_cached_graph():
+    """
+    Получение актуального графа диалога без обращения к БД
+    :return: DialogGraph - None, если граф еще не собран или инвалидирован
+    """
+    graph = _graph
+    if graph is not None and graph.version == _version:
+        return graph
+
+    return None
+
+
+def get_graph():
+    """
+    Получение актуального графа диалога. Граф собирается при первом обращении и после инвалидации
+    :return: DialogGraph
+    """
+    graph = get_cached_graph()
+    if graph is not None:
+        return graph
+
+    return _rebuild_graph()
+
+
+def _rebuild_graph():
+    """
+    Сборка графа и атомарная замена текущего графа новым
+    :return: DialogGraph
+    """
+    global _graph, _graph_db_version
+
+    with _build_lock:
+        version = _version
+        graph = _graph
+        if graph is not None and graph.version == version:
+            return graph
+
+        # Версия читается до загрузки: изменение, зафиксированное во время загрузки, даст лишнюю пересборку,
+        # но не будет пропущено проверкой версии
+        db_version = get_graph_version()
+
+        # Если во время сборки граф будет инвалидирован, он пересоберется при следующем обращении
+        graph = _load_graph(version)
+        _graph = graph
+        _graph_db_version = db_version
+
+    return graph
+
+
+def invalidate_graph():
+    """
+    Инвалидация графа диалога. Вызывается после изменения шагов или кнопок в БД
+    :return: None
+    """
+    global _version
+
+    with _version_lock:
+        _version += 1
+
+
+def check_graph_version(db_version: int):
+    """
+    Инвалидация графа, собранного до изменения версии графа в БД
+    :param db_version: int - Текущая версия графа в БД
+    :return: bool - True, если граф инвалидирован
+    """
+    if _graph is None or _graph_db_version == db_version:
+        return False
+
+    invalidate_graph()
+    return True
+
+
+def bump_graph_version():
+    """
+    Увеличение версии графа диалога в БД. Вызывается последним запросом транзакции, изменяющей шаги или кнопки:
+    строка версии блокируется до фиксации, а читатели видят новую версию только вместе с изменениями
+    :return: int - Новая версия
+    """
+    return db.session.execute(sql_text("UPDATE graph_version SET version = version + 1 RETURNING version")).scalar()
+
+
+def get_graph_version():
+    """
+    Получение текущей версии графа диалога в БД. Версия общая для всех процессов и только растет
+    :return: int
+    """
+    return db.session.execute(sql_text("SELECT version FROM graph_version")).scalar()
@@ -0,0 +1,144 @@
+from datetime import datetime
+from sqlalchemy.sql import text as sql_text
+
+from .models import Step, Button
+from .graph import invalidate_graph, bump_graph_version
+from .notifications import publish_change
+from server import db
+
+
+class GraphImportError(ValueError):
+    """
+    Ошибка импорта графа диалога: неверные ссылки между шагами, повторяющиеся ID и т.п.
+    """
+    pass
+
+
+class GraphImporter(object):
+    """
+    Загрузка графа диалога одной транзакцией.
+    Шаги добавляются пачками по мере разбора документа, ID шагов выделяются из последовательности заранее,
+    поэтому временные ID клиента сопоставляются с ID в БД без повторных запросов.
+    Кнопки добавляются в конце, когда известны ID всех шагов
+    Attributes:
+        replace: bool - Удалить все существующие шаги перед загрузкой
+        batch_size: int - Количество шагов или кнопок в одном INSERT
+        ids: {str: int} - Соответствие временных ID клиента и ID шагов в БД
+        buttons: [tuple] - Кнопки, ожидающие добавления
+        root_id: int - ID шага, отмеченного первым
+    """
+    def __init__(self, replace: bool = False, batch_size: int = 1000):
+        self.replace = replace
+        self.batch_size = batch_size
+        self.ids = {}
+        self.pending_ids = set()
+        self.steps = []
+        self.buttons = []
+        self.root_id = None
+        self.steps_count = 0
+        self.buttons_count = 0
+        self.now = datetime.utcnow()
+
+    def __flush_steps(self):
+        if len(self.steps) == 0:
+            return
+
+        step_ids = [row[0] for row in db.session.execute(
+            sql_text("SELECT nextval(pg_get_serial_sequence('steps', 'id')) FROM generate_series(1, :count)"),
+            {'count': len(self.steps)}).fetchall()]
+
+        values = []
+        for step_id, (client_id, text) in zip(step_ids, self.steps):
+            self.ids[client_id] = step_id
+            values.append({'id': step_id, 'text': text, 'is_root': False, 'created_at': self.now,
+                           'updated_at': self.now})
+
+        db.session.execute(Step.__table__.insert().values(values))
+        self.steps_count += len(values)
+        self.steps = []
+        self.pending_ids = set()
+
+    def add_step(self, step: dict):
+        """
+        Добавление шага документа
+        :param step: dict - Шаг: id (временный ID клиента), text, is_root, buttons
+        :return: None
+        """
+        client_id = str(step['id'])
+
+        # Существующие шаги удаляются только после получения первого шага: пустой документ не стирает граф
+        if self.replace and self.steps_count == 0 and len(self.steps) == 0:
+            Step.query.delete(synchronize_session=False)
+
+        if client_id in self.ids or client_id in self.pending_ids:
+            raise GraphImportError("Duplicate step id '{}'".format(client_id))
+
+        if step.get('is_root', False):
+            if self.root_id is not None:
+                raise GraphImportError("Only one step can be root")
+            self.root_id = client_id
+
+        self.steps.append((client_id, step['text']))
+        self.pending_ids.add(client_id)
+
+        for button in step.get('buttons') or []:
+            to_step_id = button.get('to_step_id')
+            self.buttons.append((client_id, button['type'], button['color'], button['label'], button['row'],
+                                 button['column'], None if to_step_id is None else str(to_step_id)))
+
+        if len(self.steps) >= self.batch_size:
+            self.__flush_steps()
+
+    def __insert_buttons(self):
+        for i in range(0, len(self.buttons), self.batch_size):
+            values = []
+            for client_id, button_type, color, label, row, column, to_step_id in self.buttons[i:i + self.batch_size]:
+                if to_step_id is not None and to_step_id not in self.ids:
+                    raise GraphImportError("Button '{}' of step '{}' refers to unknown step '{}'"
+                                           .format(label, client_id, to_step_id))
+
+                values.append({'type': button_type, 'color': color, 'label': label, 'row': row, 'column': column,
+                               'step_id': self.ids[client_id],
+                               'to_step_id': None if to_step_id is None else self.ids[to_step_id],
+                               'created_at': self.now, 'updated_at': self.now})
+
+            db.session.execute(Button.__table__.insert().values(values))
+            self.buttons_count += len(values)
+
+    def finish(self):
+        """
+        Добавление оставшихся шагов и кнопок и фиксация транзакции
+        :return: dict - Количество добавленных шагов и кнопок и соответствие временных ID и ID в БД
+        """
+        try:
+            if self.steps_count == 0 and len(self.steps) == 0:
+                raise GraphImportError("Document contains no steps")
+
+            self.__flush_steps()
+            self.__insert_buttons()
+
+            if self.root_id is not None:
+                steps = Step.__table__
+                db.session.execute(steps.update().where(steps.c.is_root == True).values(is_root=False))
+                db.session.execute(steps.update().where(steps.c.id == self.ids[self.root_id]).values(is_root=True))
+
+            publish_change('graph', None, bump_graph_version())
+        except Exception:
+            self.abort()
+            raise
+
+        db.session.commit()
+        invalidate_graph()
+
+        return {
+            'steps': self.steps_count,
+            'buttons': self.buttons_count,
+            'ids': self.ids
+        }
+
+    def abort(self):
+        """
+        Отмена импорта
+        :return: None
+        """
+        db.session.rollback()
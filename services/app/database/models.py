@@ -10,17 +10,24 @@ class Step(db.Model):
         text: str - Текст, который послыается вместе с кнопками шага
         buttons: [Button] - Кнопки клавиатуры данного шага
         from_button: Button - Кнопка с которой идкт переход на данный шаг
+        is_root: bool - Первый шаг бота. Первым может быть отмечен только один шаг
         created_at: datetime - Дата создания шага
         updated_at: datetime - Дата последнего изменения шага
     """
     __tablename__ = 'steps'
+    __table_args__ = (
+        db.Index('ix_steps_is_root', 'is_root', unique=True, postgresql_where=db.text('is_root')),
+        # Постраничная выдача списка шагов по ключу (created_at, id)
+        db.Index('ix_steps_created_at_id', 'created_at', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     text = db.Column(db.String())
+    is_root = db.Column(db.Boolean, nullable=False, default=False, server_default=db.text('false'))
 
     buttons = db.relationship('Button', backref='step', lazy=True, foreign_keys='Button.step_id', passive_deletes=True)
     from_button = db.relationship('Button', backref='next_step', uselist=False, foreign_keys='Button.to_step_id',
-                                  lazy=False, passive_deletes=True)
+                                  lazy=True, passive_deletes=True)
 
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
@@ -36,6 +43,7 @@ class Step(db.Model):
             'id': self.id,
             'text': self.text,
             'unreachable': self.from_button is None,
+            'is_root': self.is_root,
             'created_at': self.created_at,
             'updated_at': self.updated_at
         }
@@ -46,6 +54,7 @@ class Step(db.Model):
             'text': self.text,
             'buttons': list(map(lambda btn: btn.serialize(), self.buttons)),
             'unreachable': self.from_button is None,
+            'is_root': self.is_root,
             'created_at': self.created_at,
             'updated_at': self.updated_at
         }
@@ -78,8 +87,8 @@ class Button(db.Model):
     row = db.Column(db.Integer, nullable=False)
     column = db.Column(db.Integer, nullable=False)
 
-    to_step_id = db.Column(db.Integer, db.ForeignKey('steps.id', ondelete='CASCADE'))
-    step_id = db.Column(db.Integer, db.ForeignKey('steps.id', ondelete='CASCADE'))
+    to_step_id = db.Column(db.Integer, db.ForeignKey('steps.id', ondelete='CASCADE'), index=True)
+    step_id = db.Column(db.Integer, db.ForeignKey('steps.id', ondelete='CASCADE'), index=True)
 
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -178,3 +187,125 @@ class User(db.Model):
             'created_at': self.created_at,
             'updated_at': self.updated_at
         }
+
+
+class ProcessedEvent(db.Model):
+    """
+    Модель обработанного события VK Callback API, используется для отбрасывания повторных доставок
+    Attributes:
+        event_id: str - ID события из VK Callback API
+        created_at: datetime - Дата получения события
+    """
+    __tablename__ = 'processed_events'
+
+    event_id = db.Column(db.String(), primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return "<processed_events {}>".format(self.event_id)
+
+
+class Subscriber(db.Model):
+    """
+    Модель подписчика бота - пользователя ВК, который вступил в сообщество или писал боту
+    Attributes:
+        user_id: int - ID пользователя ВК
+        joined_at: datetime - Дата вступления в сообщество (None - вступление не зафиксировано)
+        last_seen_at: datetime - Дата последнего события от пользователя
+        created_at: datetime - Дата добавления подписчика
+    """
+    __tablename__ = 'subscribers'
+
+    user_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    joined_at = db.Column(db.DateTime, nullable=True)
+    last_seen_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<subscribers {}>".format(self.user_id)
+
+
+class Broadcast(db.Model):
+    """
+    Модель рассылки шага подписчикам
+    Attributes:
+        id: int - ID рассылки
+        step_id: int - ID рассылаемого шага
+        status: str - Статус рассылки: running, finished, failed
+        total: int - Количество подписчиков, попавших в рассылку
+        sent: int - Количество подписчиков, которым отправлено сообщение
+        failed: int - Количество подписчиков, которым не удалось отправить сообщение
+        created_at: datetime - Дата создания рассылки
+        updated_at: datetime - Дата последнего обновления прогресса
+    """
+    __tablename__ = 'broadcasts'
+
+    id = db.Column(db.Integer, primary_key=True)
+    step_id = db.Column(db.Integer, db.ForeignKey('steps.id', ondelete='SET NULL'), nullable=True)
+    status = db.Column(db.String(), nullable=False)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    sent = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<broadcasts {}>".format(self.id)
+
+    def serialize(self):
+        return {
+            'id': self.id,
+            'step_id': self.step_id,
+            'status': self.status,
+            'total': self.total,
+            'sent': self.sent,
+            'failed': self.failed,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
+        }
+
+
+class Conversation(db.Model):
+    """
+    Модель состояния диалога пользователя ВК с ботом
+    Attributes:
+        user_id: int - ID пользователя ВК
+        step_id: int - ID текущего шага пользователя
+        keyboard: str - JSON последней отправленной пользователю клавиатуры
+        created_at: datetime - Дата начала диалога
+        updated_at: datetime - Дата последнего перехода
+    """
+    __tablename__ = 'conversations'
+
+    user_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    # Без внешнего ключа: состояние записывается с задержкой и может ссылаться на уже удаленный шаг
+    step_id = db.Column(db.Integer, nullable=True)
+    keyboard = db.Column(db.String(), nullable=True)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<conversations {}>".format(self.user_id)
+
+
+class GraphVersion(db.Model):
+    """
+    Версия графа диалога: единственная строка, которая увеличивается в каждой транзакции, изменяющей шаги или кнопки
+    (см. database.graph.bump_graph_version). Новая версия видна другим транзакциям только после фиксации изменений
+    Attributes:
+        id: int - Всегда 1
+        version: int - Текущая версия
+    """
+    __tablename__ = 'graph_version'
+    __table_args__ = (
+        db.CheckConstraint('id = 1', name='ck_graph_version_single_row'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False, default=1)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<graph_version {}>".format(self.version)
@@ -0,0 +1,251 @@
+import os
+import select
+import socket
+import threading
+import time
+
+from sqlalchemy.sql import text as sql_text
+
+from .graph import invalidate_graph, check_graph_version, get_graph_version
+from .principals import invalidate_principal
+from server import app, db
+from server.serialization import dumps, loads
+
+
+# Канал Postgres, в который публикуются изменения шагов, кнопок и пользователей
+CHANNEL = 'profbot_changes'
+
+# Сущности, изменение которых требует пересборки графа диалога
+GRAPH_ENTITIES = ('step', 'button', 'graph')
+
+
+def _origin():
+    # PID вычисляется при каждом вызове: после форка воркера gunicorn он меняется
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def publish_change(entity: str, entity_id: int = None, version: int = None):
+    """
+    Публикация изменения в канал Postgres. Вызывается в изменяющей транзакции:
+    Postgres доставляет уведомление остальным воркерам только после ее фиксации и не доставляет при откате
+    :param entity: str - Тип сущности: step, button, graph (весь граф) или user
+    :param entity_id: int - ID сущности (None - все сущности типа)
+    :param version: int - Новая версия графа диалога
+    :return: None
+    """
+    if not app.config['CHANGE_NOTIFICATIONS']:
+        return
+
+    payload = dumps({'entity': entity, 'id': entity_id, 'version': version, 'origin': _origin()})
+    db.session.execute(sql_text("SELECT pg_notify(:channel, :payload)"), {'channel': CHANNEL, 'payload': payload})
+
+
+class ChangeListener(object):
+    """
+    Прием уведомлений об изменениях из других воркеров и инвалидация кэшей этого воркера.
+    Слушает канал отдельным соединением в фоновом потоке. Уведомления, пришедшие в течение coalesce_window
+    после первого, применяются вместе, поэтому массовое редактирование приводит к одной пересборке графа.
+    После каждого подключения, включая первое, кэши инвалидируются полностью: изменения, зафиксированные
+    до LISTEN (например, между сборкой графа и запуском потока), уведомлениями не доставляются
+    Attributes:
+        dsn: str - URL базы данных
+        coalesce_window: float - Время накопления уведомлений в секундах
+        max_users: int - Количество измененных пользователей, сверх которого кэш пользователей очищается целиком
+        max_reconnect_delay: float - Максимальная задержка переподключения в секундах
+        origin: str - Отправитель уведомлений этого воркера (его изменения уже применены локально)
+        counters: dict - Количество полученных уведомлений, пересборок графа и переподключений
+    """
+    def __init__(self, dsn: str, coalesce_window: float = 0.2, max_users: int = 100,
+                 max_reconnect_delay: float = 30):
+        self.dsn = (dsn or '').replace('postgresql+psycopg2://', 'postgresql://', 1)
+        self.coalesce_window = coalesce_window
+        self.max_users = max_users
+        self.max_reconnect_delay = max_reconnect_delay
+        self.origin = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.counters = {'received': 0, 'skipped': 0, 'graph_invalidations': 0, 'user_invalidations': 0,
+                         'reconnects': 0}
+
+    def start(self):
+        """
+        Запуск потока. Поток запускается при первом запросе, уже после форка воркера gunicorn
+        :return: None
+        """
+        if self.thread is not None:
+            return
+
+        with self.lock:
+            if self.thread is not None:
+                return
+
+            self.origin = _origin()
+            self.thread = threading.Thread(target=self.__run, name='change-listener', daemon=True)
+            self.thread.start()
+
+    def __connect(self):
+        import psycopg2
+        import psycopg2.extensions
+
+        connection = psycopg2.connect(self.dsn)
+        connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with connection.cursor() as cursor:
+            cursor.execute('LISTEN {}'.format(CHANNEL))
+        return connection
+
+    def __run(self):
+        delay = 1
+        connected_before = False
+        while True:
+            connection = None
+            try:
+                connection = self.__connect()
+                # Изменения, сделанные до подписки на канал, неизвестны
+                self.__apply({'graph'}, None)
+                if connected_before:
+                    self.counters['reconnects'] += 1
+                connected_before = True
+                delay = 1
+                self.__listen(connection)
+            except Exception as e:
+                app.logger.warning("Change listener disconnected: %s", e)
+            finally:
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    @staticmethod
+    def __poll(connection, timeout):
+        if select.select([connection], [], [], timeout) == ([], [], []):
+            return []
+
+        connection.poll()
+        notifies = connection.notifies[:]
+        del connection.notifies[:]
+        return notifies
+
+    def __listen(self, connection):
+        while True:
+            notifies = self.__poll(connection, 60)
+            if len(notifies) == 0:
+                continue
+
+            deadline = time.monotonic() + self.coalesce_window
+            remaining = self.coalesce_window
+            while remaining > 0:
+                notifies += self.__poll(connection, remaining)
+                remaining = deadline - time.monotonic()
+
+            self.__collect(notifies)
+
+    def __collect(self, notifies):
+        entities = set()
+        users = set()
+        for notify in notifies:
+            self.counters['received'] += 1
+            try:
+                change = loads(notify.payload)
+            except (ValueError, TypeError):
+                continue
+
+            if change.get('origin') == self.origin:
+                self.counters['skipped'] += 1
+                continue
+
+            entities.add(change.get('entity'))
+            if change.get('entity') == 'user':
+                # None - изменены все пользователи
+                users.add(change.get('id'))
+
+        self.__apply(entities, users)
+
+    def __apply(self, entities, users):
+        """
+        Инвалидация кэшей по накопленным изменениям
+        :param entities: {str} - Измененные типы сущностей
+        :param users: {int} - ID измененных пользователей (None - все пользователи)
+        :return: None
+        """
+        if entities & set(GRAPH_ENTITIES):
+            invalidate_graph()
+            self.counters['graph_invalidations'] += 1
+
+        if users is None or None in users or len(users) > self.max_users:
+            invalidate_principal()
+            self.counters['user_invalidations'] += 1
+            return
+
+        for user_id in users:
+            invalidate_principal(user_id)
+            self.counters['user_invalidations'] += 1
+
+    def stats(self):
+        """
+        Счетчики уведомлений
+        :return: dict
+        """
+        return dict(self.counters, running=self.thread is not None and self.thread.is_alive())
+
+
+class GraphVersionChecker(object):
+    """
+    Периодическое сравнение версии графа в БД с версией, из которой собран граф воркера.
+    Обновляет граф, если уведомления выключены или уведомление было потеряно
+    Attributes:
+        interval: float - Интервал проверки в секундах
+    """
+    def __init__(self, interval: float = 30):
+        self.interval = interval
+        self.thread = None
+        self.lock = threading.Lock()
+        self.invalidations = 0
+
+    def start(self):
+        """
+        Запуск потока проверки. Поток запускается при первом запросе, уже после форка воркера gunicorn
+        :return: None
+        """
+        if self.thread is not None or self.interval <= 0:
+            return
+
+        with self.lock:
+            if self.thread is not None:
+                return
+
+            self.thread = threading.Thread(target=self.__run, name='graph-version-checker', daemon=True)
+            self.thread.start()
+
+    def __run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with app.app_context():
+                    try:
+                        if check_graph_version(get_graph_version()):
+                            self.invalidations += 1
+                    finally:
+                        db.session.remove()
+            except Exception as e:
+                app.logger.warning("Graph version check failed: %s", e)
+
+
+change_listener = ChangeListener(app.config['SQLALCHEMY_DATABASE_URI'],
+                                 coalesce_window=app.config['CHANGE_COALESCE_WINDOW'])
+
+graph_version_checker = GraphVersionChecker(app.config['GRAPH_VERSION_CHECK_INTERVAL'])
+
+
+def start_change_listener():
+    """
+    Запуск приема уведомлений об изменениях в этом процессе, если уведомления включены,
+    и периодической проверки версии графа
+    :return: None
+    """
+    if app.config['CHANGE_NOTIFICATIONS']:
+        change_listener.start()
+    graph_version_checker.start()
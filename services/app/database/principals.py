@@ -0,0 +1,125 @@
+import threading
+import time
+from collections import namedtuple
+
+from flask import g, has_app_context
+
+from .models import User, Role
+from server import app, db
+
+
+class Principal(namedtuple('Principal', ['user_id', 'role_id', 'role_name', 'updated_at'])):
+    """
+    Аутентифицированный пользователь админки: только то, что нужно для проверки прав
+    Attributes:
+        user_id: int - ID пользователя
+        role_id: int - ID роли пользователя
+        role_name: str - Название роли
+        updated_at: datetime - Дата последнего изменения пользователя (None, если пользователь получен из JWT)
+    """
+    __slots__ = ()
+
+    @property
+    def is_admin(self):
+        return self.role_name is not None and self.role_name.lower() == 'admin'
+
+
+class PrincipalCache(object):
+    """
+    Кэш пользователей админки в памяти воркера с коротким временем жизни.
+    Изменения и удаление пользователя в этом воркере удаляют его из кэша сразу, в остальных - по уведомлению
+    из БД (см. notifications) или по истечении ttl
+    Attributes:
+        ttl: float - Время жизни записи в секундах (0 - кэш отключен)
+        principals: {int: (Principal, float)} - Пользователи и время истечения записи
+        generation: int - Номер инвалидации
+    """
+    def __init__(self, ttl: float = 30):
+        self.ttl = ttl
+        self.principals = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, user_id: int):
+        """
+        Получение пользователя из кэша или из БД
+        :param user_id: int - ID пользователя
+        :return: Principal - None, если пользователя нет
+        """
+        now = time.monotonic()
+
+        cached = self.principals.get(user_id)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+        generation = self.generation
+        principal = load_principal(user_id)
+        if principal is not None and self.ttl > 0:
+            with self.lock:
+                # Пользователь, инвалидированный во время загрузки, не кэшируется: загруженные данные могли устареть
+                if generation == self.generation:
+                    self.principals[user_id] = (principal, now + self.ttl)
+
+        return principal
+
+    def invalidate(self, user_id: int = None):
+        """
+        Удаление пользователя из кэша
+        :param user_id: int - ID пользователя (None - очистить кэш)
+        :return: None
+        """
+        with self.lock:
+            self.generation += 1
+            if user_id is None:
+                self.principals = {}
+            else:
+                self.principals.pop(user_id, None)
+
+
+def load_principal(user_id: int):
+    """
+    Загрузка пользователя и его роли из БД одним запросом без загрузки моделей
+    :param user_id: int - ID пользователя
+    :return: Principal - None, если пользователя нет
+    """
+    row = db.session.query(User.id, User.role_id, Role.name, User.updated_at) \
+        .outerjoin(Role, User.role_id == Role.id).filter(User.id == user_id).first()
+    if row is None:
+        return None
+
+    return Principal(*row)
+
+
+_cache = PrincipalCache(app.config['ADMIN_PRINCIPAL_TTL'])
+
+
+def get_principal(user_id: int):
+    """
+    Получение пользователя админки для проверки прав.
+    В рамках одного запроса пользователь загружается один раз, между запросами - берется из кэша воркера
+    :param user_id: int - ID пользователя
+    :return: Principal - None, если пользователя нет
+    """
+    if not has_app_context():
+        return _cache.get(user_id)
+
+    principals = g.setdefault('principals', {})
+    if user_id not in principals:
+        principals[user_id] = _cache.get(user_id)
+
+    return principals[user_id]
+
+
+def invalidate_principal(user_id: int = None):
+    """
+    Инвалидация пользователя после изменения или удаления
+    :param user_id: int - ID пользователя (None - все пользователи)
+    :return: None
+    """
+    _cache.invalidate(user_id)
+
+    if has_app_context() and 'principals' in g:
+        if user_id is None:
+            g.principals = {}
+        else:
+            g.principals.pop(user_id, None)
@@ -0,0 +1,26 @@
+import os
+import shutil
+
+# Метрики воркеров объединяются через файлы в общем каталоге (prometheus_client multiprocess).
+# Переменная задается до загрузки приложения в воркерах
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/profbot-metrics')
+
+# Многопоточные воркеры: пока поток ждет хеширования пароля (server/admin/passwords.py), VK API или БД,
+# остальные потоки воркера обрабатывают события бота. С синхронным воркером ограничения BCRYPT_WORKERS
+# и BCRYPT_QUEUE_SIZE не действуют: в процессе выполняется не больше одного запроса
+workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+
+def on_starting(server):
+    # Файлы метрик предыдущего запуска удаляются, иначе счетчики продолжатся с прошлых значений
+    path = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,24 @@
+"""graph version sequence
+
+Revision ID: 45a9a6e66e36
+Revises: a825712a7f54
+Create Date: 2026-10-18 15:48:12.604318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '45a9a6e66e36'
+down_revision = 'a825712a7f54'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(sa.schema.CreateSequence(sa.Sequence('graph_version_seq')))
+
+
+def downgrade():
+    op.execute(sa.schema.DropSequence(sa.Sequence('graph_version_seq')))
@@ -0,0 +1,30 @@
+"""processed events
+
+Revision ID: 4f43d5d50982
+Revises: b22764e3fbfa
+Create Date: 2026-10-18 10:12:41.503117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4f43d5d50982'
+down_revision = 'b22764e3fbfa'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('processed_events',
+    sa.Column('event_id', sa.String(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('event_id')
+    )
+    op.create_index(op.f('ix_processed_events_created_at'), 'processed_events', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_processed_events_created_at'), table_name='processed_events')
+    op.drop_table('processed_events')
@@ -0,0 +1,43 @@
+"""foreign key indexes and root step
+
+Revision ID: 968f215992f2
+Revises: df55733d7787
+Create Date: 2026-10-18 12:31:06.118452
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '968f215992f2'
+down_revision = 'df55733d7787'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_buttons_step_id'), 'buttons', ['step_id'], unique=False)
+    op.create_index(op.f('ix_buttons_to_step_id'), 'buttons', ['to_step_id'], unique=False)
+    op.create_index(op.f('ix_steps_created_at'), 'steps', ['created_at'], unique=False)
+
+    op.add_column('steps', sa.Column('is_root', sa.Boolean(), server_default=sa.text('false'), nullable=False))
+    op.create_index('ix_steps_is_root', 'steps', ['is_root'], unique=True, postgresql_where=sa.text('is_root'))
+
+    # Первым шагом становится шаг, который раньше возвращал get_first_step: шаг, на который не ведет кнопка
+    op.execute("""
+        UPDATE steps SET is_root = true
+        WHERE id = (
+            SELECT min(steps.id) FROM steps
+            WHERE NOT EXISTS (SELECT 1 FROM buttons WHERE buttons.to_step_id = steps.id)
+        )
+    """)
+
+
+def downgrade():
+    op.drop_index('ix_steps_is_root', table_name='steps')
+    op.drop_column('steps', 'is_root')
+
+    op.drop_index(op.f('ix_steps_created_at'), table_name='steps')
+    op.drop_index(op.f('ix_buttons_to_step_id'), table_name='buttons')
+    op.drop_index(op.f('ix_buttons_step_id'), table_name='buttons')
@@ -0,0 +1,27 @@
+"""steps keyset pagination index
+
+Revision ID: a825712a7f54
+Revises: 968f215992f2
+Create Date: 2026-10-18 15:02:44.310927
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a825712a7f54'
+down_revision = '968f215992f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Индекс по (created_at, id) покрывает и сортировку по created_at, поэтому одиночный индекс не нужен
+    op.create_index('ix_steps_created_at_id', 'steps', ['created_at', 'id'], unique=False)
+    op.drop_index(op.f('ix_steps_created_at'), table_name='steps')
+
+
+def downgrade():
+    op.create_index(op.f('ix_steps_created_at'), 'steps', ['created_at'], unique=False)
+    op.drop_index('ix_steps_created_at_id', table_name='steps')
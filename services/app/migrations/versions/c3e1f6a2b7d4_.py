@@ -0,0 +1,33 @@
+"""graph version row instead of sequence
+
+Revision ID: c3e1f6a2b7d4
+Revises: 45a9a6e66e36
+Create Date: 2026-10-18 18:21:37.114052
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3e1f6a2b7d4'
+down_revision = '45a9a6e66e36'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # nextval и last_value не учитывают транзакции: читатель мог получить новую версию до фиксации изменений
+    op.create_table('graph_version',
+                    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+                    sa.Column('version', sa.BigInteger(), nullable=False),
+                    sa.CheckConstraint('id = 1', name='ck_graph_version_single_row'),
+                    sa.PrimaryKeyConstraint('id'))
+    op.execute("INSERT INTO graph_version (id, version) SELECT 1, last_value FROM graph_version_seq")
+    op.execute(sa.schema.DropSequence(sa.Sequence('graph_version_seq')))
+
+
+def downgrade():
+    op.execute(sa.schema.CreateSequence(sa.Sequence('graph_version_seq')))
+    op.execute("SELECT setval('graph_version_seq', version) FROM graph_version")
+    op.drop_table('graph_version')
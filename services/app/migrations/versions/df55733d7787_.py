@@ -0,0 +1,31 @@
+"""conversations
+
+Revision ID: df55733d7787
+Revises: ef0ebb7393e6
+Create Date: 2026-10-18 11:48:52.617204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'df55733d7787'
+down_revision = 'ef0ebb7393e6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('conversations',
+    sa.Column('user_id', sa.BigInteger(), autoincrement=False, nullable=False),
+    sa.Column('step_id', sa.Integer(), nullable=True),
+    sa.Column('keyboard', sa.String(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+
+
+def downgrade():
+    op.drop_table('conversations')
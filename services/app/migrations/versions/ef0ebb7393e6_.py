@@ -0,0 +1,45 @@
+"""subscribers and broadcasts
+
+Revision ID: ef0ebb7393e6
+Revises: 4f43d5d50982
+Create Date: 2026-10-18 11:03:17.284530
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ef0ebb7393e6'
+down_revision = '4f43d5d50982'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('subscribers',
+    sa.Column('user_id', sa.BigInteger(), autoincrement=False, nullable=False),
+    sa.Column('joined_at', sa.DateTime(), nullable=True),
+    sa.Column('last_seen_at', sa.DateTime(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+    op.create_index(op.f('ix_subscribers_last_seen_at'), 'subscribers', ['last_seen_at'], unique=False)
+    op.create_table('broadcasts',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('step_id', sa.Integer(), nullable=True),
+    sa.Column('status', sa.String(), nullable=False),
+    sa.Column('total', sa.Integer(), nullable=False),
+    sa.Column('sent', sa.Integer(), nullable=False),
+    sa.Column('failed', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['step_id'], ['steps.id'], ondelete='SET NULL'),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('broadcasts')
+    op.drop_index(op.f('ix_subscribers_last_seen_at'), table_name='subscribers')
+    op.drop_table('subscribers')
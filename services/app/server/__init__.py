@@ -1,21 +1,16 @@
 import os
-import json
 from flask import Flask
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 import logging
-from logging.handlers import RotatingFileHandler
 
-
-class JSONEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, set):
-            return list(o)
-        if isinstance(o, datetime.datetime):
-            return str(o)
-        return json.JSONEncoder.default(self, o)
+from . import log
+from . import metrics
+from . import serialization
+from .compression import compress_response
+from .instrumentation import QueryInstrumentation
 
 
 # Setup app
@@ -24,21 +19,130 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DB_URL')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['JWT_SECRET_KEY'] = os.environ.get('SECRET')
 
+# Пул соединений с VK API: адрес методов API, количество keep-alive соединений и таймаут запроса в секундах
+app.config['VK_API_URL'] = os.environ.get('VK_API_URL', 'https://api.vk.com/method/')
+app.config['VK_POOL_SIZE'] = int(os.environ.get('VK_POOL_SIZE', 10))
+app.config['VK_TIMEOUT'] = float(os.environ.get('VK_TIMEOUT', 10))
+
+# Фоновая обработка событий бота: количество потоков (0 - синхронная обработка), размер очереди,
+# время ожидания места в очереди и время на обработку оставшихся событий при остановке в секундах
+app.config['BOT_WORKERS'] = int(os.environ.get('BOT_WORKERS', 4))
+app.config['BOT_QUEUE_SIZE'] = int(os.environ.get('BOT_QUEUE_SIZE', 1000))
+app.config['BOT_QUEUE_TIMEOUT'] = float(os.environ.get('BOT_QUEUE_TIMEOUT', 0.05))
+app.config['BOT_DRAIN_TIMEOUT'] = float(os.environ.get('BOT_DRAIN_TIMEOUT', 10))
+
+# Дедупликация событий по event_id: время жизни в секундах, размер LRU в памяти и
+# хранилище (memory - только память воркера, database - дополнительно общая таблица processed_events)
+app.config['BOT_DEDUP_TTL'] = float(os.environ.get('BOT_DEDUP_TTL', 600))
+app.config['BOT_DEDUP_SIZE'] = int(os.environ.get('BOT_DEDUP_SIZE', 100000))
+app.config['BOT_DEDUP_BACKEND'] = os.environ.get('BOT_DEDUP_BACKEND', 'memory').lower()
+
+# Отправка сообщений: лимит запросов в секунду на процесс (лимит сообщества VK, деленный на количество воркеров),
+# допустимый всплеск, количество потоков отправки, размер очереди, количество повторов и начальная задержка
+# повтора в секундах при ошибках VK о превышении лимита
+app.config['VK_RATE_LIMIT'] = float(os.environ.get('VK_RATE_LIMIT', 20))
+app.config['VK_RATE_BURST'] = float(os.environ.get('VK_RATE_BURST', app.config['VK_RATE_LIMIT']))
+app.config['VK_SENDER_THREADS'] = int(os.environ.get('VK_SENDER_THREADS', 2))
+app.config['VK_SEND_QUEUE_SIZE'] = int(os.environ.get('VK_SEND_QUEUE_SIZE', 10000))
+app.config['VK_SEND_RETRIES'] = int(os.environ.get('VK_SEND_RETRIES', 5))
+app.config['VK_SEND_RETRY_DELAY'] = float(os.environ.get('VK_SEND_RETRY_DELAY', 1))
+
+# Реестр подписчиков: интервал записи в БД в секундах и размер пачки
+app.config['SUBSCRIBERS_FLUSH_INTERVAL'] = float(os.environ.get('SUBSCRIBERS_FLUSH_INTERVAL', 5))
+app.config['SUBSCRIBERS_BATCH_SIZE'] = int(os.environ.get('SUBSCRIBERS_BATCH_SIZE', 500))
+
+# Рассылки: максимальное количество сообщений рассылки (по 100 получателей) в очереди отправки
+app.config['BROADCAST_MAX_IN_FLIGHT'] = int(os.environ.get('BROADCAST_MAX_IN_FLIGHT', 50))
+
+# Состояния диалогов: размер LRU в памяти воркера, интервал записи в БД в секундах и размер пачки.
+# LRU не синхронизируется между воркерами, см. bot/sessions.py
+app.config['CONVERSATIONS_CACHE_SIZE'] = int(os.environ.get('CONVERSATIONS_CACHE_SIZE', 100000))
+app.config['CONVERSATIONS_FLUSH_INTERVAL'] = float(os.environ.get('CONVERSATIONS_FLUSH_INTERVAL', 5))
+app.config['CONVERSATIONS_BATCH_SIZE'] = int(os.environ.get('CONVERSATIONS_BATCH_SIZE', 500))
+
+# Сжатие JSON ответов админки (gzip или brotli): включено ли и минимальный размер ответа в байтах
+app.config['JSON_COMPRESSION'] = os.environ.get('JSON_COMPRESSION', 'false').lower() == 'true'
+app.config['JSON_COMPRESSION_MIN_SIZE'] = int(os.environ.get('JSON_COMPRESSION_MIN_SIZE', 1024))
+app.config['JSON_COMPRESSION_LEVEL'] = int(os.environ.get('JSON_COMPRESSION_LEVEL', 5))
+
+# Пользователи админки: время жизни кэша пользователей и ролей в памяти воркера в секундах (0 - без кэша)
+# и передача роли в JWT (роль из токена используется без обращения к БД до истечения access токена)
+app.config['ADMIN_PRINCIPAL_TTL'] = float(os.environ.get('ADMIN_PRINCIPAL_TTL', 30))
+app.config['JWT_ROLE_CLAIMS'] = os.environ.get('JWT_ROLE_CLAIMS', 'false').lower() == 'true'
+
+# Хеширование паролей: стоимость bcrypt (хеши с другой стоимостью пересчитываются при входе), количество потоков,
+# количество ожидающих запросов сверх потоков и время ожидания в очереди в секундах.
+# Ограничения действуют в каждом процессе и только с многопоточными воркерами gunicorn (см. gunicorn.conf.py)
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['BCRYPT_WORKERS'] = int(os.environ.get('BCRYPT_WORKERS', 2))
+app.config['BCRYPT_QUEUE_SIZE'] = int(os.environ.get('BCRYPT_QUEUE_SIZE', 8))
+app.config['BCRYPT_QUEUE_TIMEOUT'] = float(os.environ.get('BCRYPT_QUEUE_TIMEOUT', 2))
+
+# Асинхронный прием событий (asgi.py): максимальное количество событий в обработке, количество соединений
+# с VK API и с БД
+app.config['ASGI_MAX_IN_FLIGHT'] = int(os.environ.get('ASGI_MAX_IN_FLIGHT', 5000))
+app.config['ASGI_VK_POOL_SIZE'] = int(os.environ.get('ASGI_VK_POOL_SIZE', 100))
+app.config['ASGI_DB_POOL_SIZE'] = int(os.environ.get('ASGI_DB_POOL_SIZE', 10))
+
+# Уведомления об изменениях через LISTEN/NOTIFY Postgres: включены ли и время накопления уведомлений
+# перед инвалидацией в секундах. Без уведомлений кэш пользователей других воркеров обновляется по истечении
+# ADMIN_PRINCIPAL_TTL, а граф диалога - только проверкой версии графа в БД.
+# Интервал проверки версии графа в секундах (0 - не проверять) страхует и от потерянных уведомлений
+app.config['CHANGE_NOTIFICATIONS'] = os.environ.get('CHANGE_NOTIFICATIONS', 'true').lower() == 'true'
+app.config['CHANGE_COALESCE_WINDOW'] = float(os.environ.get('CHANGE_COALESCE_WINDOW', 0.2))
+app.config['GRAPH_VERSION_CHECK_INTERVAL'] = float(os.environ.get('GRAPH_VERSION_CHECK_INTERVAL', 30))
+
+# Учет запросов к БД: строка журнала на каждый запрос и событие бота, заголовки X-DB-Queries и X-DB-Time,
+# порог медленного запроса в миллисекундах (0 - не отслеживать) и получение плана медленных запросов
+app.config['SQL_ACCESS_LOG'] = os.environ.get('SQL_ACCESS_LOG', 'true').lower() == 'true'
+app.config['SQL_DEBUG_HEADERS'] = os.environ.get('SQL_DEBUG_HEADERS',
+                                                os.environ.get('DEBUG', 'false')).lower() == 'true'
+app.config['SQL_SLOW_QUERY_MS'] = float(os.environ.get('SQL_SLOW_QUERY_MS', 200))
+app.config['SQL_SLOW_QUERY_EXPLAIN'] = os.environ.get('SQL_SLOW_QUERY_EXPLAIN', 'false').lower() == 'true'
+
+# Метрики Prometheus (/metrics): интервал чтения размеров очередей и пула соединений в секундах.
+# Под gunicorn метрики воркеров объединяются через каталог PROMETHEUS_MULTIPROC_DIR (см. gunicorn.conf.py)
+app.config['METRICS_SAMPLE_INTERVAL'] = float(os.environ.get('METRICS_SAMPLE_INTERVAL', 5))
+# Токен сборщика метрик: /metrics отвечает только на запросы с заголовком "Authorization: Bearer <токен>",
+# без токена метрики не отдаются
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+
+# Журнал: файл, формат (text или json), размер очереди записей (при переполнении записи отбрасываются)
+# и доля записываемых отладочных сообщений о событиях бота
+app.config['LOG_FILE'] = os.environ.get('LOG_FILE', 'app.log')
+app.config['LOG_FORMAT'] = os.environ.get('LOG_FORMAT', 'text').lower()
+app.config['LOG_QUEUE_SIZE'] = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+app.config['LOG_DEBUG_SAMPLE_RATE'] = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', 1))
+
 #cors = CORS(app)
 
 flask_bcrypt = Bcrypt(app)
 jwt = JWTManager(app)
 
-app.json_encoder = JSONEncoder
+serialization.init_app(app)
+
+if app.config['JSON_COMPRESSION']:
+    app.after_request(lambda response: compress_response(response, app.config['JSON_COMPRESSION_MIN_SIZE'],
+                                                         app.config['JSON_COMPRESSION_LEVEL']))
 
 # Setup logger
-handler = RotatingFileHandler('app.log', maxBytes=10 * 1024 * 1024, backupCount=1)
-formatter = logging.Formatter("[%(asctime)s] {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s")
-handler.setFormatter(formatter)
-handler.setLevel(logging.DEBUG if os.environ.get('DEBUG').lower() == 'true' else logging.INFO)
-app.logger.addHandler(handler)
+log_pipeline = log.init_app(app, path=app.config['LOG_FILE'],
+                            level=logging.DEBUG if os.environ.get('DEBUG', 'false').lower() == 'true'
+                            else logging.INFO,
+                            json_format=app.config['LOG_FORMAT'] == 'json', max_size=app.config['LOG_QUEUE_SIZE'],
+                            debug_sample_rate=app.config['LOG_DEBUG_SAMPLE_RATE'])
 
 # Setup database
 db = SQLAlchemy(app)
 
+instrumentation = QueryInstrumentation(slow_threshold=app.config['SQL_SLOW_QUERY_MS'] / 1000,
+                                       explain=app.config['SQL_SLOW_QUERY_EXPLAIN'], logger=app.logger)
+instrumentation.init_app(app, access_log=app.config['SQL_ACCESS_LOG'],
+                         debug_headers=app.config['SQL_DEBUG_HEADERS'])
+
+metrics_sampler = metrics.MetricsSampler(app.config['METRICS_SAMPLE_INTERVAL'])
+metrics.init_app(app, metrics_sampler)
+with app.app_context():
+    metrics_sampler.track_pool(db.engine)
+
 from .routes import *
@@ -0,0 +1,43 @@
+import hashlib
+from flask import Response
+
+
+def make_etag(*parts):
+    """
+    Получение ETag по значениям, от которых зависит ответ
+    :param parts: Значения с детерминированным repr (числа, строки, даты, None)
+    :return: str
+    """
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def is_not_modified(etags, etag: str):
+    """
+    Проверка, что у клиента уже есть актуальная версия ответа.
+    Используется слабое сравнение, так как сжатые ответы отдаются со слабым ETag
+    :param etags: ETags - Значение заголовка If-None-Match (None - заголовок не передан)
+    :param etag: str - ETag актуальной версии
+    :return: bool
+    """
+    return etags is not None and etags.contains_weak(etag)
+
+
+def with_etag(response: Response, etag: str):
+    """
+    Добавление ETag к ответу. Клиент должен проверять актуальность ответа при каждом запросе
+    :param response: Response - Ответ
+    :param etag: str - ETag
+    :return: Response
+    """
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def not_modified(etag: str):
+    """
+    Ответ 304 без тела
+    :param etag: str - ETag актуальной версии
+    :return: Response
+    """
+    return with_etag(Response(status=304), etag)
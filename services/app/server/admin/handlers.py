@@ -1,12 +1,52 @@
 import datetime
-from flask import jsonify
-from flask_bcrypt import Bcrypt
-from flask_jwt_extended import create_access_token, create_refresh_token
+import itertools
+from flask import jsonify, Response, stream_with_context, current_app
+from server.serialization import dumps
+from flask_jwt_extended import create_access_token, create_refresh_token, get_jwt_claims
 from .validators import LoginValidator, UserCreateValidator, UserUpdateValidator, StepCreateValidator,\
-    StepUpdateValidator, ButtonCreateValidator, ButtonUpdateValidator
+    StepUpdateValidator, BroadcastCreateValidator, StepImportValidator
+from .streaming import iter_items, StreamParseError
+from .passwords import password_hasher, PasswordHasherBusy
+from .conditional import make_etag, is_not_modified, with_etag, not_modified
+from .pagination import encode_cursor, decode_cursor, parse_fields, parse_limit, PaginationError
 import database
 
 
+def _role_claims(role_id, role_name):
+    """
+    Роль пользователя для передачи в JWT, если включен JWT_ROLE_CLAIMS
+    :return: dict
+    """
+    if not current_app.config['JWT_ROLE_CLAIMS']:
+        return None
+
+    return {'role_id': role_id, 'role': role_name}
+
+
+def _get_principal(user_id):
+    """
+    Получение пользователя, отправившего запрос, для проверки прав.
+    Если роль передана в JWT, БД не используется
+    :param user_id: int - ID пользователя из JWT
+    :return: Principal - None, если пользователя нет
+    """
+    if current_app.config['JWT_ROLE_CLAIMS']:
+        claims = get_jwt_claims()
+        if claims and 'role' in claims:
+            return database.Principal(user_id, claims.get('role_id'), claims['role'], None)
+
+    return database.get_principal(user_id)
+
+
+def _busy_response():
+    """
+    Ответ на запрос, для которого не нашлось свободного потока хеширования паролей
+    :return: JSON тело ответа, HTTP статус, заголовки
+    """
+    return jsonify({'error': 'Too many requests, try again later'}), 503, \
+        {'Retry-After': str(max(1, int(password_hasher.queue_timeout)))}
+
+
 def login_handler(json):
     """
     Обработчик запроса входа
@@ -25,10 +65,21 @@ def login_handler(json):
     if existed_user is None:
         return jsonify({'error': "Bad credentials"}), 401
 
-    if not Bcrypt().check_password_hash(existed_user.password, password):
-        return jsonify({'error': "Bad credentials"}), 401
-
-    access_token = create_access_token(identity=existed_user.id, expires_delta=datetime.timedelta(minutes=10))
+    try:
+        if not password_hasher.check(existed_user.password, password):
+            return jsonify({'error': "Bad credentials"}), 401
+    except PasswordHasherBusy:
+        return _busy_response()
+
+    # Хеш, посчитанный с прежней стоимостью, пересчитывается, пока известен пароль
+    if password_hasher.needs_rehash(existed_user.password):
+        hashed = password_hasher.rehash(password)
+        if hashed is not None:
+            database.set_user_password(existed_user.id, hashed)
+
+    access_token = create_access_token(identity=existed_user.id, expires_delta=datetime.timedelta(minutes=10),
+                                       user_claims=_role_claims(existed_user.role_id,
+                                                                existed_user.role and existed_user.role.name))
     refresh_token = create_refresh_token(identity=existed_user.id, expires_delta=datetime.timedelta(days=10))
 
     return jsonify(id=existed_user.id, access_token=access_token, refresh_token=refresh_token), 200
@@ -40,11 +91,13 @@ def refresh_handler(current_user_id):
     :param current_user_id: int - ID пользователя, отправившего запрос
     :return: JSON тело ответа, HTTP статус
     """
-    current_user = database.get_user(current_user_id)
+    # Роль берется из БД, а не из токена, чтобы новый токен получил актуальную роль
+    current_user = database.get_principal(current_user_id)
     if current_user is None:
         return jsonify({'error': 'Unauthorized'}), 401
 
-    access_token = create_access_token(identity=current_user_id, expires_delta=datetime.timedelta(minutes=10))
+    access_token = create_access_token(identity=current_user_id, expires_delta=datetime.timedelta(minutes=10),
+                                       user_claims=_role_claims(current_user.role_id, current_user.role_name))
     refresh_token = create_refresh_token(identity=current_user_id, expires_delta=datetime.timedelta(days=10))
 
     return jsonify(id=current_user_id, access_token=access_token, refresh_token=refresh_token), 200
@@ -57,10 +110,10 @@ def user_create_handler(json, current_user_id):
     :param current_user_id: int - ID пользователя, отправившего запрос
     :return: JSON тело ответа, HTTP статус
     """
-    current_user = database.get_user(current_user_id)
+    current_user = _get_principal(current_user_id)
     if current_user is None:
         return jsonify({'error': 'Unauthorized'}), 401
-    if current_user.role.name.lower() != 'admin':
+    if not current_user.is_admin:
         return jsonify({'error': 'Only admin can create users'}), 403
 
     is_valid, error = UserCreateValidator().is_valid(json)
@@ -81,48 +134,119 @@ def user_create_handler(json, current_user_id):
     if existed_role is None:
         return jsonify({'error': 'Role not found'}), 400
 
-    created_user = database.create_user(email, Bcrypt().generate_password_hash(password).decode('utf-8'), name,
-                                        surname, role_id)
+    try:
+        hashed = password_hasher.hash(password)
+    except PasswordHasherBusy:
+        return _busy_response()
+
+    created_user = database.create_user(email, hashed, name, surname, role_id)
 
     return jsonify(created_user.serialize()), 201
 
 
-def users_list_handler(current_user_id):
+def _list_page(rows, limit, key):
+    """
+    Отделение лишней строки, запрошенной для проверки наличия следующей страницы
+    :param rows: [Row] - Строки, загруженные с limit + 1
+    :param limit: int - Размер страницы (None - без постраничной выдачи)
+    :param key: function - Ключ (created_at, id) строки для курсора
+    :return: [Row], dict - Строки страницы, заголовки ответа с курсором следующей страницы
+    """
+    if limit is None or len(rows) <= limit:
+        return rows, {}
+
+    rows = rows[:limit]
+    return rows, {'X-Next-Cursor': encode_cursor(*key(rows[-1]))}
+
+
+def _parse_list_params(fields, allowed_fields, limit, cursor):
     """
-    Обработчик запроса получения списка пользователей
+    Разбор параметров постраничной выдачи списка.
+    Без limit отдается первая страница размера DEFAULT_PAGE_SIZE
+    :return: (fields, limit, cursor)
+    """
+    fields = parse_fields(fields, allowed_fields)
+    limit = parse_limit(limit)
+    if cursor is not None:
+        cursor = decode_cursor(cursor)
+
+    return fields, limit, cursor
+
+
+def users_list_handler(current_user_id, fields=None, limit=None, cursor=None, role=None, email_prefix=None,
+                       etags=None):
+    """
+    Обработчик запроса получения списка пользователей.
+    Курсор следующей страницы передается в заголовке X-Next-Cursor
     :param current_user_id: int - ID пользователя, отправившего запрос
-    :return: JSON тело ответа, HTTP статус
+    :param fields: str - Поля пользователей через запятую (None - все поля)
+    :param limit: str - Размер страницы (None - DEFAULT_PAGE_SIZE)
+    :param cursor: str - Курсор страницы из заголовка X-Next-Cursor предыдущего ответа
+    :param role: str - Только пользователи с этой ролью
+    :param email_prefix: str - Только пользователи, email которых начинается с этой строки
+    :param etags: ETags - Значение заголовка If-None-Match
+    :return: JSON тело ответа, HTTP статус, заголовки
     """
-    current_user = database.get_user(current_user_id)
+    current_user = _get_principal(current_user_id)
     if current_user is None:
         return jsonify({'error': 'Unauthorized'}), 401
-    if current_user.role.name.lower() != 'admin':
+    if not current_user.is_admin:
         return jsonify({'error': 'Only admin can get users list'}), 403
 
-    return jsonify(list(map(lambda user: user.serialize_list(), database.get_users_list()))), 200
+    try:
+        fields, limit, cursor = _parse_list_params(fields, database.USERS_LIST_FIELDS, limit, cursor)
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
+
+    etag = make_etag('users', fields, limit, cursor, role, email_prefix, *database.get_users_revision())
+    if is_not_modified(etags, etag):
+        return not_modified(etag), 304
+
+    rows = database.get_users_list(fields=fields, limit=None if limit is None else limit + 1, cursor=cursor,
+                                   role=role, email_prefix=email_prefix)
+    rows, headers = _list_page(rows, limit, lambda row: (row.sort_key, row.id))
+
+    users = []
+    for row in rows:
+        user = {}
+        for field in fields:
+            if field == 'role':
+                user['role'] = None if row.role_id is None else {'id': row.role_id, 'name': row.role_name}
+            else:
+                user[field] = getattr(row, field)
+        users.append(user)
 
+    return with_etag(jsonify(users), etag), 200, headers
 
-def users_retrieve_handler(user_id, current_user_id):
+
+def users_retrieve_handler(user_id, current_user_id, etags=None):
     """
     Обработчик запроса получения пользователя по id
     :param user_id: int - ID пользователя
     :param current_user_id: int - ID пользователя, отправившего запрос
+    :param etags: ETags - Значение заголовка If-None-Match
     :return: JSON тело ответа, HTTP статус
     """
-    current_user = database.get_user(current_user_id)
+    current_user = _get_principal(current_user_id)
     if current_user is None:
         return jsonify({'error': 'Unauthorized'}), 401
-    if current_user.role.name.lower() != 'admin' and current_user_id != user_id:
+    if not current_user.is_admin and current_user_id != user_id:
         return jsonify({'error': 'Only admin can get user info'}), 403
 
-    if user_id == current_user_id:
-        existed_user = current_user
-    else:
-        existed_user = database.get_user(user_id)
-        if existed_user is None:
-            return jsonify(error='User not found'), 404
+    # Ревизия читается из БД и для самого пользователя: пользователь из кэша может быть изменен другим воркером
+    revision = database.get_user_revision(user_id)
+    if revision is None:
+        return jsonify(error='User not found'), 404
+
+    etag = make_etag('user', user_id, *revision)
+    if is_not_modified(etags, etag):
+        return not_modified(etag), 304
 
-    return jsonify(existed_user.serialize()), 200
+    existed_user = database.get_user(user_id)
+    if existed_user is None:
+        return jsonify(error='User not found'), 404
+
+    return with_etag(jsonify(existed_user.serialize()), etag), 200
 
 
 def users_delete_handler(user_id, current_user_id):
@@ -132,10 +256,10 @@ def users_delete_handler(user_id, current_user_id):
     :param current_user_id: int - ID пользователя, отправившего запрос
     :return: JSON тело ответа, HTTP статус
     """
-    current_user = database.get_user(current_user_id)
+    current_user = _get_principal(current_user_id)
     if current_user is None:
         return jsonify({'error': 'Unauthorized'}), 401
-    if current_user.role.name.lower() != 'admin' and current_user_id != user_id:
+    if not current_user.is_admin and current_user_id != user_id:
         return jsonify({'error': 'Only admin can delete users'}), 403
 
     existed_user = database.get_user(user_id)
@@ -155,19 +279,16 @@ def users_update_handler(user_id, current_user_id, user_data):
     :param user_data: dict - JSON новые данные пользователя
     :return: JSON тело ответа, HTTP статус
     """
-    current_user = database.get_user(current_user_id)
-    is_admin = current_user.role.name.lower() == 'admin'
+    current_user = _get_principal(current_user_id)
     if current_user is None:
         return jsonify({'error': 'Unauthorized'}), 401
+    is_admin = current_user.is_admin
     if not is_admin and current_user_id != user_id:
         return jsonify({'error': 'Only admin can update user info'}), 403
 
-    if user_id == current_user_id:
-        existed_user = current_user
-    else:
-        existed_user = database.get_user(user_id)
-        if existed_user is None:
-            return jsonify(error='User not found'), 404
+    existed_user = database.get_user(user_id)
+    if existed_user is None:
+        return jsonify(error='User not found'), 404
 
     is_valid, error = UserUpdateValidator().is_valid(user_data, is_admin=is_admin)
     if not is_valid:
@@ -181,7 +302,7 @@ def users_update_handler(user_id, current_user_id, user_data):
     new_role_id = user_data.get('role_id')
 
     if new_role_id is not None:
-        if current_user.role.name.lower() != 'admin':
+        if not current_user.is_admin:
             return jsonify({'error': 'Only admin can update user role'}), 400
         existed_role = database.get_role(new_role_id)
         if existed_role is None:
@@ -193,10 +314,13 @@ def users_update_handler(user_id, current_user_id, user_data):
     existed_user.role_id = existed_user.role_id if new_role_id is None else new_role_id
 
     if old_password is not None and new_password is not None:
-        if not Bcrypt().check_password_hash(existed_user.password, old_password):
-            return jsonify({'error': "Wrong old password"}), 400
+        try:
+            if not password_hasher.check(existed_user.password, old_password):
+                return jsonify({'error': "Wrong old password"}), 400
 
-        existed_user.password = Bcrypt().generate_password_hash(new_password).decode('utf-8')
+            existed_user.password = password_hasher.hash(new_password)
+        except PasswordHasherBusy:
+            return _busy_response()
 
     database.update_user(existed_user)
 
@@ -210,7 +334,7 @@ def steps_create_handler(json, user_id):
     :param user_id: int - ID пользователя
     :return: JSON тело ответа, HTTP статус
     """
-    current_user = database.get_user(user_id)
+    current_user = _get_principal(user_id)
     if current_user is None:
         return jsonify({'error': 'Unauthorized'}), 401
 
@@ -218,48 +342,72 @@ def steps_create_handler(json, user_id):
     if not is_valid:
         return jsonify({'error': error}), 400
 
-    new_step = database.create_step(text=json.get('text'))
-
-    buttons = json.get('buttons')
-
-    if buttons is not None:
-        for button in buttons:
-            database.create_button(button_type=button['type'], label=button['label'],
-                                   color=button['color'], row=button['row'], column=button['column'],
-                                   step_id=new_step.id, to_step_id=button['to_step_id'])
+    new_step = database.create_step_with_buttons(text=json.get('text'), buttons=json.get('buttons'),
+                                                 is_root=json.get('is_root', False))
 
-    return jsonify(new_step.serialize()), 201
+    return jsonify(new_step), 201
 
 
-def steps_list_handler(user_id):
+def steps_list_handler(user_id, fields=None, limit=None, cursor=None, unreachable=None, text_prefix=None,
+                       etags=None):
     """
-    Обработчик запроса получения списка шагов
+    Обработчик запроса получения списка шагов.
+    Курсор следующей страницы передается в заголовке X-Next-Cursor
     :param user_id: int - ID пользователя
-    :return: JSON тело ответа, HTTP статус
+    :param fields: str - Поля шагов через запятую (None - все поля)
+    :param limit: str - Размер страницы (None - DEFAULT_PAGE_SIZE)
+    :param cursor: str - Курсор страницы из заголовка X-Next-Cursor предыдущего ответа
+    :param unreachable: bool - Только шаги, на которые не ведет (True) или ведет (False) кнопка
+    :param text_prefix: str - Только шаги, текст которых начинается с этой строки
+    :param etags: ETags - Значение заголовка If-None-Match
+    :return: JSON тело ответа, HTTP статус, заголовки
     """
-    current_user = database.get_user(user_id)
+    current_user = _get_principal(user_id)
     if current_user is None:
         return jsonify({'error': 'Unauthorized'}), 401
 
-    return jsonify(list(map(lambda step: step.serialize_list(), database.get_steps_list()))), 200
+    try:
+        fields, limit, cursor = _parse_list_params(fields, database.STEPS_LIST_FIELDS, limit, cursor)
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Список зависит от всех шагов и кнопок, поэтому ETag строится по версии графа
+    etag = make_etag('steps', database.get_graph_version(), fields, limit, cursor, unreachable, text_prefix)
+    if is_not_modified(etags, etag):
+        return not_modified(etag), 304
 
+    rows = database.get_steps_list(fields=fields, limit=None if limit is None else limit + 1, cursor=cursor,
+                                   unreachable=unreachable, text_prefix=text_prefix)
+    rows, headers = _list_page(rows, limit, lambda row: (row.created_at, row.id))
 
-def steps_retrieve_handler(step_id, user_id):
+    return with_etag(jsonify([{field: getattr(row, field) for field in fields} for row in rows]), etag), 200, headers
+
+
+def steps_retrieve_handler(step_id, user_id, etags=None):
     """
     Обработчик запроса получения шага по ID
     :param step_id: int - ID шага
     :param user_id: int - ID пользователя
+    :param etags: ETags - Значение заголовка If-None-Match
     :return: JSON тело ответа, HTTP статус
     """
-    current_user = database.get_user(user_id)
+    current_user = _get_principal(user_id)
     if current_user is None:
         return jsonify({'error': 'Unauthorized'}), 401
 
+    revision = database.get_step_revision(step_id)
+    if revision is None:
+        return jsonify(error='Step not found'), 404
+
+    etag = make_etag('step', step_id, *revision)
+    if is_not_modified(etags, etag):
+        return not_modified(etag), 304
+
     existed_step = database.get_step(step_id)
     if existed_step is None:
         return jsonify(error='Step not found'), 404
 
-    return jsonify(existed_step.serialize()), 200
+    return with_etag(jsonify(existed_step.serialize()), etag), 200
 
 
 def steps_delete_handler(step_id, user_id):
@@ -269,7 +417,7 @@ def steps_delete_handler(step_id, user_id):
     :param user_id: int - ID пользователя
     :return: JSON тело ответа, HTTP статус
     """
-    current_user = database.get_user(user_id)
+    current_user = _get_principal(user_id)
     if current_user is None:
         return jsonify({'error': 'Unauthorized'}), 401
 
@@ -290,7 +438,7 @@ def steps_update_handler(step_id, user_id, json):
     :param json: dict - JSON данные запроса
     :return: JSON тело ответа, HTTP статус
     """
-    current_user = database.get_user(user_id)
+    current_user = _get_principal(user_id)
     if current_user is None:
         return jsonify({'error': 'Unauthorized'}), 401
 
@@ -304,46 +452,40 @@ def steps_update_handler(step_id, user_id, json):
 
     buttons = json.get('buttons')
 
-    to_delete_buttons = list(map(lambda btn: btn.id, existed_step.buttons))
+    # Все кнопки проверяются до начала записи, чтобы ошибка не оставила шаг измененным наполовину
+    existed_buttons = {btn.id: btn for btn in existed_step.buttons}
+    to_delete_buttons = set(existed_buttons.keys())
+    created_buttons = []
+    updated_buttons = []
 
+    # Схема кнопок проверена StepUpdateValidator: кнопки с ID - по схеме обновления, остальные - по схеме создания
     if buttons is not None:
         for button in buttons:
             button_id = button.get('id')
             if button_id is None:
-                is_valid, error = ButtonCreateValidator().is_valid(button)
-                if not is_valid:
-                    return jsonify({'error': error}), 400
-
-                database.create_button(button_type=button['type'], label=button['label'],
-                                       color=button['color'], row=button['row'], column=button['column'],
-                                       step_id=step_id, to_step_id=button['to_step_id'])
+                created_buttons.append(button)
             else:
-                to_delete_buttons.remove(button_id)
-                existed_button = database.get_button(button_id)
+                existed_button = existed_buttons.get(button_id)
                 if existed_button is None:
                     return jsonify(error='Button not found'), 404
 
-                is_valid, error = ButtonUpdateValidator().is_valid(button)
-                if not is_valid:
-                    return jsonify({'error': error}), 400
-
-                existed_button.type = button.get('type', existed_button.type)
-                existed_button.color = button.get('color', existed_button.color)
-                existed_button.label = button.get('label', existed_button.label)
-                existed_button.row = button.get('row', existed_button.row)
-                existed_button.column = button.get('column', existed_button.column)
-                existed_button.to_step_id = button.get('to_step_id', existed_button.to_step_id)
-
-                database.update_button(existed_button)
-
-    existed_step.text = json.get('text', existed_step.text)
-
-    for button_id in to_delete_buttons:
-        database.delete_button(button_id)
+                to_delete_buttons.discard(button_id)
+                updated_buttons.append({
+                    'id': button_id,
+                    'type': button.get('type', existed_button.type),
+                    'color': button.get('color', existed_button.color),
+                    'label': button.get('label', existed_button.label),
+                    'row': button.get('row', existed_button.row),
+                    'column': button.get('column', existed_button.column),
+                    'to_step_id': button.get('to_step_id', existed_button.to_step_id)
+                })
 
-    database.update_step(existed_step)
+    updated_step = database.update_step_with_buttons(existed_step, text=json.get('text'),
+                                                     is_root=json.get('is_root'), created_buttons=created_buttons,
+                                                     updated_buttons=updated_buttons,
+                                                     deleted_button_ids=list(to_delete_buttons))
 
-    return jsonify(existed_step.serialize()), 200
+    return jsonify(updated_step), 200
 
 
 def buttons_delete_handler(button_id, user_id):
@@ -353,7 +495,7 @@ def buttons_delete_handler(button_id, user_id):
     :param user_id: int - ID пользователя
     :return: JSON тело ответа, HTTP статус
     """
-    current_user = database.get_user(user_id)
+    current_user = _get_principal(user_id)
     if current_user is None:
         return jsonify({'error': 'Unauthorized'}), 401
 
@@ -364,3 +506,184 @@ def buttons_delete_handler(button_id, user_id):
     database.delete_button(button_id)
 
     return jsonify(None), 204
+
+
+def broadcast_create_handler(step_id, user_id, json, broadcaster):
+    """
+    Обработчик запроса рассылки шага подписчикам
+    :param step_id: int - ID шага
+    :param user_id: int - ID пользователя
+    :param json: dict - JSON данные запроса (фильтры подписчиков)
+    :param broadcaster: Broadcaster - Рассылка шагов подписчикам
+    :return: JSON тело ответа, HTTP статус
+    """
+    current_user = _get_principal(user_id)
+    if current_user is None:
+        return jsonify({'error': 'Unauthorized'}), 401
+    if not current_user.is_admin:
+        return jsonify({'error': 'Only admin can broadcast steps'}), 403
+
+    is_valid, error = BroadcastCreateValidator().is_valid(json)
+    if not is_valid:
+        return jsonify({'error': error}), 400
+
+    filters = {}
+    for key in ['joined_after', 'active_after']:
+        if json.get(key) is not None:
+            try:
+                value = datetime.datetime.fromisoformat(json[key].replace('Z', '+00:00'))
+            except ValueError:
+                return jsonify({'error': "'{}' is not a valid date-time".format(json[key])}), 400
+
+            # Даты в БД хранятся в UTC без часового пояса
+            if value.tzinfo is not None:
+                value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            filters[key] = value
+
+    existed_step = database.get_step(step_id)
+    if existed_step is None:
+        return jsonify(error='Step not found'), 404
+
+    new_broadcast = database.create_broadcast(step_id, database.count_subscribers(**filters))
+
+    broadcaster.start(new_broadcast.id, step_id, filters)
+
+    return jsonify(new_broadcast.serialize()), 202
+
+
+def broadcast_retrieve_handler(broadcast_id, user_id):
+    """
+    Обработчик запроса получения прогресса рассылки
+    :param broadcast_id: int - ID рассылки
+    :param user_id: int - ID пользователя
+    :return: JSON тело ответа, HTTP статус
+    """
+    current_user = _get_principal(user_id)
+    if current_user is None:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    existed_broadcast = database.get_broadcast(broadcast_id)
+    if existed_broadcast is None:
+        return jsonify(error='Broadcast not found'), 404
+
+    return jsonify(existed_broadcast.serialize()), 200
+
+
+def graph_import_handler(stream, user_id, replace):
+    """
+    Обработчик запроса импорта графа диалога.
+    Документ {"steps": [{"id", "text", "is_root", "buttons": [{..., "to_step_id"}]}]} разбирается потоково,
+    id шагов и to_step_id кнопок - временные ID клиента, которые заменяются на ID в БД
+    :param stream: file - Поток тела запроса
+    :param user_id: int - ID пользователя
+    :param replace: bool - Заменить все существующие шаги
+    :return: JSON тело ответа, HTTP статус
+    """
+    current_user = _get_principal(user_id)
+    if current_user is None:
+        return jsonify({'error': 'Unauthorized'}), 401
+    if replace and not current_user.is_admin:
+        return jsonify({'error': 'Only admin can replace steps'}), 403
+
+    validator = StepImportValidator()
+    importer = database.GraphImporter(replace=replace)
+
+    try:
+        for step in iter_items(stream, 'steps.item'):
+            is_valid, error = validator.is_valid(step)
+            if not is_valid:
+                importer.abort()
+                return jsonify({'error': error}), 400
+
+            importer.add_step(step)
+
+        result = importer.finish()
+    except (StreamParseError, database.GraphImportError) as e:
+        importer.abort()
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify(result), 201
+
+
+def _stream_graph(steps, buttons, chunk_size=100):
+    """
+    Генератор JSON документа графа диалога {"steps": [...]}.
+    Кнопки присоединяются к шагам по мере чтения: оба запроса отсортированы по ID шага
+    :param steps: Query - Шаги, отсортированные по id
+    :param buttons: Query - Кнопки, отсортированные по step_id
+    :param chunk_size: int - Сколько шагов отдавать клиенту за раз
+    :return: generator - Части JSON документа
+    """
+    yield '{"steps": ['
+
+    buttons_iter = iter(buttons)
+    button = next(buttons_iter, None)
+    chunk = []
+    is_first = True
+
+    for step in steps:
+        # Кнопки шагов, не попавших в выборку, пропускаются
+        while button is not None and button.step_id < step.id:
+            button = next(buttons_iter, None)
+
+        step_buttons = []
+        while button is not None and button.step_id == step.id:
+            step_buttons.append({
+                'id': button.id,
+                'type': button.type,
+                'color': button.color,
+                'label': button.label,
+                'row': button.row,
+                'column': button.column,
+                'to_step_id': button.to_step_id
+            })
+            button = next(buttons_iter, None)
+
+        chunk.append(dumps({
+            'id': step.id,
+            'text': step.text,
+            'buttons': step_buttons,
+            'unreachable': step.unreachable,
+            'is_root': step.is_root,
+            'created_at': step.created_at,
+            'updated_at': step.updated_at
+        }))
+
+        if len(chunk) >= chunk_size:
+            yield ('' if is_first else ',') + ','.join(chunk)
+            is_first = False
+            chunk = []
+
+    if len(chunk) != 0:
+        yield ('' if is_first else ',') + ','.join(chunk)
+
+    yield ']}'
+
+
+def graph_retrieve_handler(user_id, root_id=None, depth=None):
+    """
+    Обработчик запроса получения графа диалога целиком или подграфа.
+    Шаги и кнопки загружаются двумя запросами, ответ отдается потоком
+    :param user_id: int - ID пользователя
+    :param root_id: int - ID корня подграфа (None - весь граф)
+    :param depth: int - Максимальная глубина подграфа от корня (None - без ограничения)
+    :return: Потоковый JSON ответ, HTTP статус
+    """
+    current_user = _get_principal(user_id)
+    if current_user is None:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    if depth is not None and depth < 0:
+        return jsonify({'error': 'Depth must be greater than or equal to 0'}), 400
+
+    steps, buttons = database.get_graph_rows(root_id=root_id, depth=depth)
+
+    if root_id is not None:
+        # Подграф содержит хотя бы корень, поэтому отсутствие шага видно по первой строке без отдельного запроса
+        steps = iter(steps)
+        first_step = next(steps, None)
+        if first_step is None:
+            return jsonify(error='Step not found'), 404
+        steps = itertools.chain([first_step], steps)
+
+    return Response(stream_with_context(_stream_graph(steps, buttons)), mimetype='application/json'), 200
@@ -0,0 +1,84 @@
+import base64
+import binascii
+import datetime
+import json
+
+# Максимальный размер страницы списка
+MAX_PAGE_SIZE = 500
+
+# Размер страницы, если limit не передан: список никогда не отдается целиком
+DEFAULT_PAGE_SIZE = 100
+
+
+class PaginationError(ValueError):
+    """
+    Ошибка параметров постраничной выдачи: неверный курсор, размер страницы или список полей
+    """
+    pass
+
+
+def encode_cursor(created_at: datetime.datetime, row_id: int):
+    """
+    Кодирование ключа (created_at, id) последней строки страницы в непрозрачный курсор
+    :param created_at: datetime - Дата создания строки
+    :param row_id: int - ID строки
+    :return: str
+    """
+    data = json.dumps([created_at.isoformat(), row_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str):
+    """
+    Декодирование курсора, полученного от encode_cursor
+    :param cursor: str - Курсор
+    :return: (datetime, int)
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, row_id = json.loads(data.decode())
+        if not isinstance(row_id, int):
+            raise ValueError
+        return datetime.datetime.fromisoformat(created_at), row_id
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+        raise PaginationError("'{}' is not a valid cursor".format(cursor))
+
+
+def parse_fields(fields: str, allowed: tuple):
+    """
+    Разбор параметра fields - списка полей через запятую
+    :param fields: str - Значение параметра (None - все поля)
+    :param allowed: (str) - Допустимые поля
+    :return: (str) - Поля в порядке allowed
+    """
+    if fields is None:
+        return allowed
+
+    requested = set(field.strip() for field in fields.split(',') if field.strip())
+    unknown = requested - set(allowed)
+    if len(unknown) > 0:
+        raise PaginationError("Unknown fields: {}".format(', '.join(sorted(unknown))))
+    if len(requested) == 0:
+        raise PaginationError("At least one field is required")
+
+    return tuple(field for field in allowed if field in requested)
+
+
+def parse_limit(limit: str):
+    """
+    Разбор и проверка размера страницы
+    :param limit: str - Значение параметра limit (None - размер по умолчанию)
+    :return: int
+    """
+    if limit is None:
+        return DEFAULT_PAGE_SIZE
+
+    try:
+        value = int(limit)
+    except ValueError:
+        raise PaginationError("'{}' is not a valid limit".format(limit))
+
+    if not 0 < value <= MAX_PAGE_SIZE:
+        raise PaginationError("Limit must be between 1 and {}".format(MAX_PAGE_SIZE))
+
+    return value
@@ -0,0 +1,107 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from server import app, flask_bcrypt
+from server.metrics import observe_password_hash, count_password_hash_rejected
+
+
+class PasswordHasherBusy(Exception):
+    """
+    Очередь хеширования паролей заполнена или запрос ждал в очереди дольше допустимого
+    """
+    pass
+
+
+class PasswordHasher(object):
+    """
+    Хеширование и проверка паролей bcrypt в отдельном ограниченном пуле потоков.
+    bcrypt освобождает GIL на время вычисления хеша, поэтому потоки пула не блокируют обработку остальных запросов,
+    а размер пула ограничивает количество ядер, занятых хешированием.
+    Запрос, ожидающий хеш, занимает свой поток воркера, поэтому пул и ограничение очереди имеют смысл только
+    с многопоточными воркерами gunicorn (gthread, см. gunicorn.conf.py): с синхронным воркером хеш ждет весь процесс.
+    Ограничения действуют на процесс, всего хешированием заняты до workers * workers_count ядер.
+    Время хеширования и отказы записываются в метрики Prometheus
+    Attributes:
+        bcrypt: Bcrypt - Настроенный flask_bcrypt
+        rounds: int - Стоимость хеширования (log2 количества раундов) для новых хешей
+        queue_size: int - Количество запросов, ожидающих свободного потока, сверх размера пула
+        queue_timeout: float - Максимальное время ожидания в очереди в секундах
+    """
+    def __init__(self, bcrypt, rounds: int = 12, workers_count: int = 2, queue_size: int = 8,
+                 queue_timeout: float = 2):
+        self.bcrypt = bcrypt
+        self.rounds = rounds
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers_count, thread_name_prefix='bcrypt')
+        self.slots = threading.BoundedSemaphore(workers_count + queue_size)
+
+    def __run(self, operation, function, *args):
+        if not self.slots.acquire(blocking=False):
+            count_password_hash_rejected(operation, 'full')
+            raise PasswordHasherBusy("Password hashing queue is full")
+
+        enqueued_at = time.monotonic()
+
+        def task():
+            if time.monotonic() - enqueued_at > self.queue_timeout:
+                raise PasswordHasherBusy("Password hashing queue timeout")
+            return function(*args)
+
+        try:
+            result = self.executor.submit(task).result()
+        except PasswordHasherBusy:
+            count_password_hash_rejected(operation, 'timeout')
+            raise
+        finally:
+            self.slots.release()
+
+        observe_password_hash(operation, time.monotonic() - enqueued_at)
+        return result
+
+    def hash(self, password: str):
+        """
+        Получение хеша пароля с текущей стоимостью
+        :param password: str - Пароль
+        :return: str
+        """
+        return self.__run('hash', self.bcrypt.generate_password_hash, password, self.rounds).decode('utf-8')
+
+    def check(self, hashed: str, password: str):
+        """
+        Проверка пароля
+        :param hashed: str - Хеш пароля из БД
+        :param password: str - Пароль
+        :return: bool
+        """
+        return self.__run('check', self.bcrypt.check_password_hash, hashed, password)
+
+    def needs_rehash(self, hashed: str):
+        """
+        Проверка, что хеш посчитан с другой стоимостью и его нужно пересчитать
+        :param hashed: str - Хеш пароля в формате $2b$<стоимость>$...
+        :return: bool
+        """
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def rehash(self, password: str):
+        """
+        Пересчет хеша с текущей стоимостью после успешной проверки пароля.
+        Не выполняется, если пул занят: пароль будет перехеширован при следующем входе
+        :param password: str - Проверенный пароль
+        :return: str - None, если пул занят
+        """
+        try:
+            return self.hash(password)
+        except PasswordHasherBusy:
+            return None
+
+
+password_hasher = PasswordHasher(flask_bcrypt, rounds=app.config['BCRYPT_LOG_ROUNDS'],
+                                 workers_count=app.config['BCRYPT_WORKERS'],
+                                 queue_size=app.config['BCRYPT_QUEUE_SIZE'],
+                                 queue_timeout=app.config['BCRYPT_QUEUE_TIMEOUT'])
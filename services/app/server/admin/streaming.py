@@ -0,0 +1,42 @@
+import json
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+class StreamParseError(ValueError):
+    """
+    Ошибка разбора JSON документа из тела запроса
+    """
+    pass
+
+
+def iter_items(stream, path: str):
+    """
+    Потоковый разбор массива из JSON документа.
+    Если установлен ijson, документ не загружается в память целиком
+    :param stream: file - Поток тела запроса
+    :param path: str - Путь к элементам массива в формате ijson, например 'steps.item'
+    :return: generator - Элементы массива
+    """
+    if ijson is not None:
+        try:
+            for item in ijson.items(stream, path, use_float=True):
+                yield item
+        except ijson.JSONError as e:
+            raise StreamParseError(str(e))
+        return
+
+    try:
+        document = json.load(stream)
+    except ValueError as e:
+        raise StreamParseError(str(e))
+
+    # Путь 'a.b.item' соответствует массиву document['a']['b']
+    items = document
+    for key in path.split('.')[:-1]:
+        items = items.get(key) if isinstance(items, dict) else None
+    for item in items or []:
+        yield item
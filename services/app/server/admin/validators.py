@@ -1,9 +1,84 @@
-from jsonschema import validate
-from jsonschema.exceptions import ValidationError
-from jsonschema.exceptions import SchemaError
+import threading
+import time
+from jsonschema import Draft7Validator
 
+# Скомпилированные валидаторы по имени класса. Заполняется при импорте модуля
+validators = {}
 
-class LoginValidator(object):
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def _format_error(error):
+    path = ''
+    for item in error.absolute_path:
+        path += '[{}]'.format(item) if isinstance(item, int) else ('.' if path else '') + str(item)
+
+    return '{}: {}'.format(path, error.message) if path else error.message
+
+
+def get_validation_stats():
+    """
+    Статистика валидации запросов по валидаторам
+    :return: {str: dict} - Количество проверок, количество невалидных запросов, суммарное и максимальное время в секундах
+    """
+    with _stats_lock:
+        return {name: dict(stats) for name, stats in _stats.items()}
+
+
+class SchemaValidator(object):
+    """
+    Базовый валидатор по JSON схеме.
+    Схема проверяется и компилируется один раз при объявлении класса-наследника,
+    при валидации собираются все ошибки, а не только первая
+    Attributes:
+        user_schema: dict - Словарь правил для валидации запроса
+        compiled: Draft7Validator - Скомпилированная схема
+    """
+    user_schema = None
+    compiled = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        Draft7Validator.check_schema(cls.user_schema)
+        cls.compiled = Draft7Validator(cls.user_schema)
+        validators[cls.__name__] = cls
+
+    def errors(self, data):
+        """
+        Получение всех ошибок валидации
+        :param data: dict - JSON данные запроса
+        :return: [str] - Описания ошибок с путем к невалидному полю
+        """
+        started_at = time.perf_counter()
+        errors = [_format_error(error) for error in self.compiled.iter_errors(data)]
+        elapsed = time.perf_counter() - started_at
+
+        name = type(self).__name__
+        with _stats_lock:
+            stats = _stats.get(name)
+            if stats is None:
+                stats = _stats[name] = {'calls': 0, 'invalid': 0, 'time_total': 0.0, 'time_max': 0.0}
+            stats['calls'] += 1
+            stats['invalid'] += 1 if len(errors) != 0 else 0
+            stats['time_total'] += elapsed
+            stats['time_max'] = max(stats['time_max'], elapsed)
+
+        return errors
+
+    def is_valid(self, data):
+        """
+        Метод для валидации запроса
+        :param data: dict - JSON данные запроса
+        :return: (bool, str) - (True - если данные валидные, Текстовое описание ошибок через '; ')
+        """
+        errors = self.errors(data)
+        if len(errors) != 0:
+            return False, '; '.join(errors)
+        return True, None
+
+
+class LoginValidator(SchemaValidator):
     """
     Валидатор запроса на вход в админку
     Attributes:
@@ -25,22 +100,8 @@ class LoginValidator(object):
         "additionalProperties": False
     }
 
-    def is_valid(self, data):
-        """
-        Метод для валидации запроса
-        :param data: dict - JSON данные запроса
-        :return: (bool, str) - (True - если данные валидные, Текстовое описание ошибки)
-        """
-        try:
-            validate(data, self.user_schema)
-        except ValidationError as e:
-            return False, e.message
-        except SchemaError as e:
-            return False, e.message
-        return True, None
-
 
-class UserCreateValidator(object):
+class UserCreateValidator(SchemaValidator):
     """
     Валидатор запроса на создание пользователя
     Attributes:
@@ -73,22 +134,8 @@ class UserCreateValidator(object):
         "additionalProperties": False
     }
 
-    def is_valid(self, data):
-        """
-        Метод для валидации запроса
-        :param data: dict - JSON данные запроса
-        :return: (bool, str) - (True - если данные валидные, Текстовое описание ошибки)
-        """
-        try:
-            validate(data, self.user_schema)
-        except ValidationError as e:
-            return False, e.message
-        except SchemaError as e:
-            return False, e.message
-        return True, None
 
-
-class UserUpdateValidator(object):
+class UserUpdateValidator(SchemaValidator):
     """
     Валидатор запроса на обновление данных пользователя
     Attributes:
@@ -132,12 +179,9 @@ class UserUpdateValidator(object):
         :param is_admin: boolean - Запрос от админа или нет
         :return: (bool, str) - (True - если данные валидные, Текстовое описание ошибки)
         """
-        try:
-            validate(data, self.user_schema)
-        except ValidationError as e:
-            return False, e.message
-        except SchemaError as e:
-            return False, e.message
+        is_valid, error = super().is_valid(data)
+        if not is_valid:
+            return False, error
 
         if data.get('new_password') is not None and (not is_admin and data.get('old_password') is None):
             return False, "Old password cannot be null"
@@ -148,7 +192,76 @@ class UserUpdateValidator(object):
         return True, None
 
 
-class StepCreateValidator(object):
+class ButtonCreateValidator(SchemaValidator):
+    """
+    Валидатор запроса на создание кнопки
+    Attributes:
+        user_schema: dict - Словарь правил для валидации запроса
+    """
+    user_schema = {
+        "type": "object",
+        "properties": {
+            "type": {
+                "type": "string"
+            },
+            "color": {
+                "type": "string"
+            },
+            "label": {
+                "type": "string"
+            },
+            "row": {
+                "type": "integer"
+            },
+            "column": {
+                "type": "integer"
+            },
+            "to_step_id": {
+                "type": ["integer", "null"]
+            }
+        },
+        "required": ["type", "color", "label", "row", "column", "to_step_id"],
+        "additionalProperties": False
+    }
+
+
+class ButtonUpdateValidator(SchemaValidator):
+    """
+    Валидатор запроса на обновление кнопки
+    Attributes:
+        user_schema: dict - Словарь правил для валидации запроса
+    """
+    user_schema = {
+        "type": "object",
+        "properties": {
+            "id": {
+                "type": "integer"
+            },
+            "type": {
+                "type": "string"
+            },
+            "color": {
+                "type": "string"
+            },
+            "label": {
+                "type": "string"
+            },
+            "row": {
+                "type": "integer"
+            },
+            "column": {
+                "type": "integer"
+            },
+            "to_step_id": {
+                "type": ["integer", "null"]
+            }
+        },
+        "required": ["id"],
+        "additionalProperties": False
+    }
+
+
+class StepCreateValidator(SchemaValidator):
     """
     Валидатор запроса на создание нового шага
     Attributes:
@@ -160,6 +273,9 @@ class StepCreateValidator(object):
             "text": {
                 "type": "string"
             },
+            "is_root": {
+                "type": "boolean"
+            },
             "buttons": {
                 "type": ["array", "null"],
                 "items": {
@@ -192,22 +308,8 @@ class StepCreateValidator(object):
         "additionalProperties": False
     }
 
-    def is_valid(self, data):
-        """
-        Метод для валидации запроса
-        :param data: dict - JSON данные запроса
-        :return: (bool, str) - (True - если данные валидные, Текстовое описание ошибки)
-        """
-        try:
-            validate(data, self.user_schema)
-        except ValidationError as e:
-            return False, e.message
-        except SchemaError as e:
-            return False, e.message
-        return True, None
-
 
-class StepUpdateValidator(object):
+class StepUpdateValidator(SchemaValidator):
     """
     Валидатор запроса на обновление шага
     Attributes:
@@ -219,34 +321,23 @@ class StepUpdateValidator(object):
             "text": {
                 "type": "string"
             },
+            "is_root": {
+                "type": "boolean"
+            },
             "buttons": {
                 "type": ["array", "null"],
+                # Кнопки с ID обновляются, остальные создаются. Все кнопки проверяются за один проход
                 "items": {
-                    "type": "object",
-                    "properties": {
-                        "id": {
-                            "type": ["integer", "null"]
+                    "if": {
+                        "properties": {
+                            "id": {
+                                "type": "integer"
+                            }
                         },
-                        "type": {
-                            "type": "string"
-                        },
-                        "color": {
-                            "type": "string"
-                        },
-                        "label": {
-                            "type": "string"
-                        },
-                        "row": {
-                            "type": "integer"
-                        },
-                        "column": {
-                            "type": "integer"
-                        },
-                        "to_step_id": {
-                            "type": ["integer", "null"]
-                        }
+                        "required": ["id"]
                     },
-                    "required": []
+                    "then": ButtonUpdateValidator.user_schema,
+                    "else": ButtonCreateValidator.user_schema
                 }
             }
         },
@@ -254,113 +345,77 @@ class StepUpdateValidator(object):
         "additionalProperties": False
     }
 
-    def is_valid(self, data):
-        """
-        Метод для валидации запроса
-        :param data: dict - JSON данные запроса
-        :return: (bool, str) - (True - если данные валидные, Текстовое описание ошибки)
-        """
-        try:
-            validate(data, self.user_schema)
-        except ValidationError as e:
-            return False, e.message
-        except SchemaError as e:
-            return False, e.message
-        return True, None
-
 
-class ButtonCreateValidator(object):
+class BroadcastCreateValidator(SchemaValidator):
     """
-    Валидатор запроса на создание кнопки
+    Валидатор запроса на рассылку шага подписчикам
     Attributes:
         user_schema: dict - Словарь правил для валидации запроса
     """
     user_schema = {
         "type": "object",
         "properties": {
-            "type": {
-                "type": "string"
-            },
-            "color": {
-                "type": "string"
-            },
-            "label": {
-                "type": "string"
-            },
-            "row": {
-                "type": "integer"
-            },
-            "column": {
-                "type": "integer"
+            "joined_after": {
+                "type": ["string", "null"],
+                "format": "date-time"
             },
-            "to_step_id": {
-                "type": ["integer", "null"]
+            "active_after": {
+                "type": ["string", "null"],
+                "format": "date-time"
             }
         },
-        "required": ["type", "color", "label", "row", "column", "to_step_id"],
+        "required": [],
         "additionalProperties": False
     }
 
-    def is_valid(self, data):
-        """
-        Метод для валидации запроса
-        :param data: dict - JSON данные запроса
-        :return: (bool, str) - (True - если данные валидные, Текстовое описание ошибки)
-        """
-        try:
-            validate(data, self.user_schema)
-        except ValidationError as e:
-            return False, e.message
-        except SchemaError as e:
-            return False, e.message
-        return True, None
-
 
-class ButtonUpdateValidator(object):
+class StepImportValidator(SchemaValidator):
     """
-    Валидатор запроса на обновление кнопки
+    Валидатор шага в документе импорта графа диалога
     Attributes:
-        user_schema: dict - Словарь правил для валидации запроса
+        user_schema: dict - Словарь правил для валидации шага
     """
     user_schema = {
         "type": "object",
         "properties": {
             "id": {
-                "type": "integer"
-            },
-            "type": {
-                "type": "string"
-            },
-            "color": {
-                "type": "string"
+                "type": ["string", "integer"]
             },
-            "label": {
+            "text": {
                 "type": "string"
             },
-            "row": {
-                "type": "integer"
-            },
-            "column": {
-                "type": "integer"
+            "is_root": {
+                "type": "boolean"
             },
-            "to_step_id": {
-                "type": ["integer", "null"]
+            "buttons": {
+                "type": ["array", "null"],
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "type": {
+                            "type": "string"
+                        },
+                        "color": {
+                            "type": "string"
+                        },
+                        "label": {
+                            "type": "string"
+                        },
+                        "row": {
+                            "type": "integer"
+                        },
+                        "column": {
+                            "type": "integer"
+                        },
+                        "to_step_id": {
+                            "type": ["string", "integer", "null"]
+                        }
+                    },
+                    "required": ["type", "color", "label", "row", "column", "to_step_id"],
+                    "additionalProperties": False
+                }
             }
         },
-        "required": ["id"],
+        "required": ["id", "text"],
         "additionalProperties": False
     }
-
-    def is_valid(self, data):
-        """
-        Метод для валидации запроса
-        :param data: dict - JSON данные запроса
-        :return: (bool, str) - (True - если данные валидные, Текстовое описание ошибки)
-        """
-        try:
-            validate(data, self.user_schema)
-        except ValidationError as e:
-            return False, e.message
-        except SchemaError as e:
-            return False, e.message
-        return True, None
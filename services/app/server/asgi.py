@@ -0,0 +1,114 @@
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    WsgiToAsgi = None
+
+from bot.aio.api import AsyncVkAPI
+from bot.aio.database import AsyncDatabase
+from bot.aio.ingress import CallbackIngress
+from bot.aio.sender import AsyncMessageSender
+from bot.dedup import EventDeduplicator
+from database import start_change_listener
+from server import app, metrics_sampler
+from .routes import router, token, confirmation_token
+
+
+class CallbackApplication(object):
+    """
+    ASGI приложение: POST / (VK Callback API) обрабатывается асинхронно,
+    остальные запросы передаются приложению Flask (если установлен asgiref)
+    Attributes:
+        ingress: CallbackIngress - Асинхронный прием событий
+        api: AsyncVkAPI - Асинхронный клиент VK API
+        database: AsyncDatabase - Асинхронный доступ к БД
+        fallback: ASGI приложение для остальных запросов (None - ответ 404)
+        drain_timeout: float - Время на обработку принятых событий при остановке в секундах
+    """
+    # Максимальный размер тела запроса VK Callback API в байтах
+    MAX_BODY_SIZE = 1024 * 1024
+
+    def __init__(self, ingress, api, database, fallback=None, drain_timeout: float = 10):
+        self.ingress = ingress
+        self.api = api
+        self.database = database
+        self.fallback = fallback
+        self.drain_timeout = drain_timeout
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.__lifespan(receive, send)
+        elif scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == '/':
+            await self.__callback(receive, send)
+        elif self.fallback is not None:
+            await self.fallback(scope, receive, send)
+        else:
+            await self.__respond(send, 404, 'Not Found')
+
+    async def __lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.api.start()
+                    await self.database.start()
+                    start_change_listener()
+                    metrics_sampler.start()
+                except Exception as e:
+                    app.logger.exception(e)
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.ingress.drain(self.drain_timeout)
+                await self.api.close()
+                await self.database.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def __callback(self, receive, send):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if len(body) > self.MAX_BODY_SIZE:
+                await self.__respond(send, 413, 'denied')
+                return
+            if not message.get('more_body', False):
+                break
+
+        text, status = await self.ingress.accept(body)
+        await self.__respond(send, status, text)
+
+    @staticmethod
+    async def __respond(send, status, text):
+        body = (text or '').encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'text/html; charset=utf-8'), (b'content-length', str(len(body)).encode())]
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+
+def create_asgi_app():
+    """
+    Создание ASGI приложения из настроек приложения Flask.
+    Реестр подписчиков, состояния диалогов и ограничитель частоты messages.send общие с синхронным роутером процесса
+    :return: CallbackApplication
+    """
+    api = AsyncVkAPI(token, pool_size=app.config['ASGI_VK_POOL_SIZE'], timeout=app.config['VK_TIMEOUT'],
+                     api_url=app.config['VK_API_URL'])
+    # Ограничитель частоты общий с синхронным MessageSender, через который идут рассылки админки
+    sender = AsyncMessageSender(api, router.sender.bucket, max_retries=app.config['VK_SEND_RETRIES'],
+                                retry_delay=app.config['VK_SEND_RETRY_DELAY'])
+    database = AsyncDatabase(app.config['SQLALCHEMY_DATABASE_URI'], max_size=app.config['ASGI_DB_POOL_SIZE'],
+                             events_ttl=app.config['BOT_DEDUP_TTL'])
+    deduplicator = EventDeduplicator(ttl=app.config['BOT_DEDUP_TTL'], max_size=app.config['BOT_DEDUP_SIZE'])
+
+    ingress = CallbackIngress(sender, database, deduplicator, router.subscribers, router.conversations,
+                              confirmation_token, max_in_flight=app.config['ASGI_MAX_IN_FLIGHT'],
+                              use_database_dedup=app.config['BOT_DEDUP_BACKEND'] == 'database')
+    metrics_sampler.track_queue('asgi_in_flight', lambda: len(ingress.tasks))
+
+    return CallbackApplication(ingress, api, database, fallback=None if WsgiToAsgi is None else WsgiToAsgi(app),
+                               drain_timeout=app.config['BOT_DRAIN_TIMEOUT'])
@@ -0,0 +1,92 @@
+import gzip
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from flask import request
+
+
+def _accepted_encoding():
+    encodings = request.accept_encodings
+    if brotli is not None and encodings['br']:
+        return 'br'
+    if encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def _gzip_stream(chunks, level: int):
+    """
+    Сжатие потокового тела ответа gzip по мере формирования частей
+    :param chunks: iterable - Части тела ответа (bytes или str)
+    :param level: int - Уровень сжатия
+    :return: generator - Части сжатого тела
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        # Закрытие исходного генератора освобождает контекст запроса stream_with_context
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def _weaken_etag(response):
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+
+
+def compress_response(response, min_size: int = 1024, level: int = 5):
+    """
+    Сжатие JSON ответа gzip или brotli (если установлен brotli и поддерживается клиентом).
+    Потоковые ответы (например, /graph) сжимаются gzip по частям независимо от размера,
+    остальные ответы меньше min_size не сжимаются. ETag сжатого ответа становится слабым,
+    так как байты ответа отличаются от несжатого
+    :param response: Response - Ответ
+    :param min_size: int - Минимальный размер тела ответа в байтах
+    :param level: int - Уровень сжатия (для brotli - quality)
+    :return: Response
+    """
+    if response.direct_passthrough or response.mimetype != 'application/json' \
+            or response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    if response.is_streamed:
+        if not request.accept_encodings['gzip']:
+            return response
+
+        response.response = _gzip_stream(response.response, level)
+        response.headers.pop('Content-Length', None)
+        response.headers['Content-Encoding'] = 'gzip'
+        _weaken_etag(response)
+        return response
+
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+
+    encoding = _accepted_encoding()
+    if encoding is None:
+        return response
+
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=level))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=level))
+    response.headers['Content-Encoding'] = encoding
+    _weaken_etag(response)
+
+    return response
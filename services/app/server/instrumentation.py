@@ -0,0 +1,236 @@
+import logging
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# Параметры, значения которых не попадают в журнал медленных запросов
+_SECRET_PARAMETER = re.compile(r'password|token|secret', re.IGNORECASE)
+
+# Запросы, для которых можно получить план выполнения
+_EXPLAINABLE = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', re.IGNORECASE)
+
+# Максимальная длина значения параметра в журнале медленных запросов
+_MAX_PARAMETER_LENGTH = 200
+
+
+def _format_value(name, value):
+    if name is not None and _SECRET_PARAMETER.search(str(name)):
+        return '***'
+
+    value = repr(value)
+    if len(value) > _MAX_PARAMETER_LENGTH:
+        value = value[:_MAX_PARAMETER_LENGTH] + '...'
+    return value
+
+
+def _format_parameters(parameters, executemany):
+    if executemany:
+        rows = list(parameters)
+        return [_format_parameters(row, False) for row in rows[:3]] + \
+            (['... {} rows'.format(len(rows))] if len(rows) > 3 else [])
+
+    if isinstance(parameters, dict):
+        return {name: _format_value(name, value) for name, value in parameters.items()}
+
+    if isinstance(parameters, (list, tuple)):
+        return [_format_value(None, value) for value in parameters]
+
+    return parameters
+
+
+class QueryInstrumentation(object):
+    """
+    Учет запросов к БД через события движка SQLAlchemy.
+    Для каждого запроса Flask и события бота считается количество запросов и время в БД, запросы дольше
+    slow_threshold записываются в журнал вместе с параметрами (секреты скрываются) и, если включено, планом EXPLAIN.
+    На каждый запрос к БД приходится два вызова time.perf_counter и обращение к threading.local
+    Attributes:
+        slow_threshold: float - Порог медленного запроса в секундах (0 - не отслеживать)
+        explain: bool - Получать план медленных запросов
+        slow_queries: deque - Последние медленные запросы
+        logger: Logger - Журнал медленных запросов
+        access_logger: Logger - Журнал запросов приложения и событий бота (None - не записывать)
+    """
+    def __init__(self, slow_threshold: float = 0.2, explain: bool = False, max_slow_queries: int = 100,
+                 logger=None):
+        self.slow_threshold = slow_threshold
+        self.explain = explain
+        self.slow_queries = deque(maxlen=max_slow_queries)
+        self.logger = logger or logging.getLogger(__name__)
+        self.access_logger = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.counters = {'queries': 0, 'time': 0.0, 'slow': 0}
+
+    def install(self):
+        """
+        Подключение к событиям всех движков SQLAlchemy процесса
+        :return: None
+        """
+        event.listen(Engine, 'before_cursor_execute', self.__before_execute)
+        event.listen(Engine, 'after_cursor_execute', self.__after_execute)
+
+    @staticmethod
+    def __before_execute(conn, cursor, statement, parameters, context, executemany):
+        # Время начала хранится в контексте выполнения запроса и пропадает вместе с ним, если запрос завершился ошибкой
+        if context is not None:
+            context._profbot_started_at = time.perf_counter()
+
+    def __after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started_at = getattr(context, '_profbot_started_at', None)
+        if started_at is None:
+            return
+        elapsed = time.perf_counter() - started_at
+
+        local = self.local
+        if getattr(local, 'active', False):
+            local.queries += 1
+            local.time += elapsed
+
+        with self.lock:
+            self.counters['queries'] += 1
+            self.counters['time'] += elapsed
+
+        if 0 < self.slow_threshold <= elapsed:
+            self.__capture(conn, statement, parameters, executemany, elapsed)
+
+    def __capture(self, conn, statement, parameters, executemany, elapsed):
+        plan = None
+        if self.explain and not executemany and _EXPLAINABLE.match(statement):
+            plan = self.__explain(conn, statement, parameters)
+
+        query = {
+            'statement': statement,
+            'parameters': _format_parameters(parameters, executemany),
+            'time': elapsed,
+            'plan': plan,
+            'request': getattr(self.local, 'name', None),
+            'captured_at': time.time()
+        }
+        with self.lock:
+            self.counters['slow'] += 1
+            self.slow_queries.append(query)
+
+        self.logger.warning("Slow query %.1fms (%s): %s; parameters: %s%s", elapsed * 1000, query['request'],
+                            statement, query['parameters'], '' if plan is None else '\n' + plan)
+
+    def __explain(self, conn, statement, parameters):
+        """
+        Получение плана запроса без выполнения (EXPLAIN без ANALYZE) в точке сохранения текущей транзакции,
+        чтобы ошибка EXPLAIN не прервала транзакцию приложения
+        """
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute('SAVEPOINT query_explain')
+            try:
+                cursor.execute('EXPLAIN ' + statement, parameters)
+                plan = '\n'.join(str(row[0]) for row in cursor.fetchall())
+                cursor.execute('RELEASE SAVEPOINT query_explain')
+                return plan
+            except Exception:
+                cursor.execute('ROLLBACK TO SAVEPOINT query_explain')
+                raise
+        except Exception as e:
+            self.logger.debug("EXPLAIN failed: %s", e)
+            return None
+        finally:
+            cursor.close()
+
+    def begin(self, name: str = None):
+        """
+        Начало учета запросов текущего потока
+        :param name: str - Название запроса или события для журнала
+        :return: None
+        """
+        local = self.local
+        local.active = True
+        local.name = name
+        local.queries = 0
+        local.time = 0.0
+        local.started_at = time.perf_counter()
+
+    def end(self):
+        """
+        Окончание учета запросов текущего потока
+        :return: (int, float, float) - Количество запросов, время в БД и общее время в секундах
+        """
+        local = self.local
+        if not getattr(local, 'active', False):
+            return 0, 0.0, 0.0
+
+        local.active = False
+        return local.queries, local.time, time.perf_counter() - local.started_at
+
+    @contextmanager
+    def track(self, name: str):
+        """
+        Учет запросов фоновой операции (например, обработки события бота) с записью в журнал запросов
+        :param name: str - Название операции
+        :return: None
+        """
+        self.begin(name)
+        try:
+            yield
+        finally:
+            queries, db_time, total = self.end()
+            if self.access_logger is not None:
+                self.access_logger.info("%s %.1fms queries=%d db=%.1fms", name, total * 1000, queries, db_time * 1000)
+
+    def stats(self):
+        """
+        Общие счетчики запросов процесса
+        :return: dict - Количество запросов, суммарное время в секундах и количество медленных запросов
+        """
+        with self.lock:
+            return dict(self.counters)
+
+    def init_app(self, app, access_log: bool = True, debug_headers: bool = False):
+        """
+        Учет запросов к БД для каждого запроса приложения
+        :param app: Flask - Приложение
+        :param access_log: bool - Записывать строку журнала на каждый запрос
+        :param debug_headers: bool - Добавлять к ответу заголовки X-DB-Queries и X-DB-Time (мс).
+            Потоковые ответы учитываются при закрытии ответа, уже после отправки заголовков, поэтому заголовков
+            у них нет
+        :return: None
+        """
+        self.install()
+        if access_log:
+            # Уровень задается явно: у логгера приложения без режима отладки уровень WARNING
+            self.access_logger = logging.getLogger(app.logger.name + '.access')
+            self.access_logger.setLevel(logging.INFO)
+
+        @app.before_request
+        def begin_request():
+            self.begin('{} {}'.format(request.method, request.path))
+
+        def log_request(method, path, status_code, queries, db_time, total):
+            if self.access_logger is not None:
+                self.access_logger.info("%s %s %s %.1fms queries=%d db=%.1fms", method, path, status_code,
+                                        total * 1000, queries, db_time * 1000)
+
+        @app.after_request
+        def end_request(response):
+            if response.is_streamed:
+                # Тело потокового ответа (например, /graph) формируется после after_request в том же потоке,
+                # поэтому учет завершается при закрытии ответа
+                method, path, status_code = request.method, request.path, response.status_code
+                response.call_on_close(lambda: log_request(method, path, status_code, *self.end()))
+                return response
+
+            queries, db_time, total = self.end()
+
+            if debug_headers:
+                response.headers['X-DB-Queries'] = str(queries)
+                response.headers['X-DB-Time'] = '{:.1f}'.format(db_time * 1000)
+
+            log_request(request.method, request.path, response.status_code, queries, db_time, total)
+
+            return response
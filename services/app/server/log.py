@@ -0,0 +1,210 @@
+import atexit
+import datetime
+import logging
+import os
+import queue
+import random
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from flask import request
+from flask.logging import default_handler
+
+from .serialization import dumps
+
+
+# ID запроса Flask или события бота, к которому относятся записи журнала текущего потока или задачи asyncio
+_request_id = ContextVar('request_id', default=None)
+
+# Максимальная длина ID запроса из заголовка X-Request-Id
+_MAX_REQUEST_ID_LENGTH = 64
+
+TEXT_FORMAT = "[%(asctime)s] {%(pathname)s:%(lineno)d} %(levelname)s [%(request_id)s] - %(message)s"
+
+# Стандартные атрибуты LogRecord, не попадающие в JSON запись как дополнительные поля
+_RECORD_ATTRIBUTES = set(logging.LogRecord('', 0, '', 0, '', None, None).__dict__) | {'message', 'asctime',
+                                                                                      'request_id'}
+
+
+@contextmanager
+def log_request_id(request_id):
+    """
+    Привязка записей журнала к запросу или событию бота на время обработки
+    :param request_id: str - ID запроса или event_id события
+    :return: None
+    """
+    token = _request_id.set(request_id)
+    try:
+        yield
+    finally:
+        _request_id.reset(token)
+
+
+class RequestIdFilter(logging.Filter):
+    """
+    Добавление ID текущего запроса в запись журнала (request_id, '-' вне запроса)
+    """
+    def filter(self, record):
+        record.request_id = _request_id.get() or '-'
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Запись только части отладочных сообщений логгера. Сообщения уровня INFO и выше записываются всегда
+    Attributes:
+        rate: float - Доля записываемых отладочных сообщений (1 - все)
+    """
+    def __init__(self, rate: float = 1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Запись журнала одной строкой JSON: время, уровень, логгер, место вызова, ID запроса, сообщение,
+    трассировка исключения и дополнительные поля, переданные через extra
+    """
+    def format(self, record):
+        data = {
+            'time': datetime.datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'location': '{}:{}'.format(record.pathname, record.lineno),
+            'thread': record.threadName,
+            'request_id': getattr(record, 'request_id', None),
+            'message': record.getMessage()
+        }
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+
+        for name, value in record.__dict__.items():
+            if name not in _RECORD_ATTRIBUTES:
+                data[name] = value
+
+        try:
+            return dumps(data)
+        except TypeError:
+            # Дополнительные поля, которые не сериализуются в JSON, записываются строкой
+            return dumps({name: value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+                          for name, value in data.items()})
+
+
+class BufferedQueueHandler(QueueHandler):
+    """
+    Постановка записей журнала в ограниченную очередь без ожидания.
+    В потоке, создавшем запись, только подставляются аргументы сообщения, форматирование и запись выполняет
+    фоновый поток. Если очередь заполнена, запись отбрасывается: ввод-вывод журнала не задерживает запросы
+    Attributes:
+        dropped: int - Количество отброшенных записей
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Аргументы подставляются сразу: изменяемые объекты могут измениться до записи
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline(object):
+    """
+    Журнал приложения: обработчики логгеров ставят записи в очередь, один фоновый поток записывает их в файл.
+    После форка воркера поток записи запускается заново
+    Attributes:
+        handler: BufferedQueueHandler - Обработчик, добавляемый к логгерам
+        targets: [Handler] - Обработчики, выполняющие запись
+        listener: QueueListener - Поток записи
+    """
+    def __init__(self, targets: list, max_size: int = 10000):
+        self.targets = targets
+        self.max_size = max_size
+        self.handler = BufferedQueueHandler(queue.Queue(maxsize=max_size))
+        self.handler.addFilter(RequestIdFilter())
+        self.listener = None
+
+        self.start()
+        atexit.register(self.stop)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.__restart)
+
+    def start(self):
+        """
+        Запуск потока записи
+        :return: None
+        """
+        self.listener = QueueListener(self.handler.queue, *self.targets, respect_handler_level=True)
+        self.listener.start()
+
+    def __restart(self):
+        # Блокировки очереди могли быть захвачены потоком записи родительского процесса в момент форка
+        self.handler.queue = queue.Queue(maxsize=self.max_size)
+        self.start()
+
+    def stop(self):
+        """
+        Запись оставшихся записей и остановка потока
+        :return: None
+        """
+        if self.listener is not None and self.listener._thread is not None:
+            self.listener.stop()
+
+
+def init_app(app, path: str = 'app.log', level: int = logging.INFO, json_format: bool = False,
+             max_size: int = 10000, debug_sample_rate: float = 1.0):
+    """
+    Настройка журнала приложения
+    :param app: Flask - Приложение
+    :param path: str - Файл журнала
+    :param level: int - Минимальный уровень записей
+    :param json_format: bool - Записывать JSON строки вместо текста
+    :param max_size: int - Размер очереди записей
+    :param debug_sample_rate: float - Доля записываемых отладочных сообщений о событиях бота
+    :return: LogPipeline
+    """
+    formatter = JSONFormatter() if json_format else logging.Formatter(TEXT_FORMAT)
+
+    file_handler = RotatingFileHandler(path, maxBytes=10 * 1024 * 1024, backupCount=1)
+    file_handler.setFormatter(formatter)
+    file_handler.setLevel(level)
+
+    # Вывод в stderr, который Flask делает по умолчанию, тоже выполняется фоновым потоком
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    stream_handler.setLevel(logging.WARNING)
+
+    pipeline = LogPipeline([file_handler, stream_handler], max_size=max_size)
+
+    # Уровень логгера задается явно, иначе отключенные уровни отсекаются только обработчиком, после создания записи
+    app.logger.setLevel(level)
+    app.logger.removeHandler(default_handler)
+    app.logger.addHandler(pipeline.handler)
+    logging.getLogger(app.logger.name + '.events').addFilter(SamplingFilter(debug_sample_rate))
+
+    @app.before_request
+    def bind_request_id():
+        request_id = request.headers.get('X-Request-Id', '')[:_MAX_REQUEST_ID_LENGTH] or uuid.uuid4().hex
+        _request_id.set(request_id)
+
+    @app.after_request
+    def add_request_id(response):
+        response.headers.setdefault('X-Request-Id', _request_id.get() or '')
+        return response
+
+    return pipeline
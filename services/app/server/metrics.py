@@ -0,0 +1,225 @@
+import hmac
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import request, g
+from prometheus_client import Histogram, Counter, Gauge, CollectorRegistry, REGISTRY, generate_latest, \
+    CONTENT_TYPE_LATEST, multiprocess
+
+
+REQUEST_LATENCY = Histogram('profbot_http_request_duration_seconds', 'Время обработки запроса Flask',
+                            ['method', 'route', 'status'])
+
+BOT_EVENT_LATENCY = Histogram('profbot_bot_event_duration_seconds', 'Время обработки события бота',
+                              ['event_type'])
+
+BOT_EVENT_ERRORS = Counter('profbot_bot_event_errors_total', 'Ошибки обработки событий бота', ['event_type'])
+
+VK_LATENCY = Histogram('profbot_vk_request_duration_seconds', 'Время вызова метода VK API', ['method'])
+
+VK_ERRORS = Counter('profbot_vk_errors_total', 'Ошибки вызовов VK API по коду ошибки VK (network - ошибка сети)',
+                    ['method', 'code'])
+
+PASSWORD_HASH_LATENCY = Histogram('profbot_password_hash_duration_seconds',
+                                  'Время хеширования или проверки пароля bcrypt, включая ожидание в очереди',
+                                  ['operation'], buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10))
+
+PASSWORD_HASH_REJECTED = Counter('profbot_password_hash_rejected_total',
+                                 'Отказы в хешировании пароля (full - очередь заполнена, timeout - время ожидания)',
+                                 ['operation', 'reason'])
+
+# Значения воркеров суммируются, значения завершившихся воркеров не учитываются
+DB_POOL = Gauge('profbot_db_pool_connections', 'Соединения пула SQLAlchemy (in_use, idle, overflow)', ['state'],
+                multiprocess_mode='livesum')
+
+QUEUE_DEPTH = Gauge('profbot_queue_depth', 'Количество элементов в очереди', ['queue'], multiprocess_mode='livesum')
+
+
+def _registry():
+    """
+    Реестр метрик для ответа /metrics. Под gunicorn (задан PROMETHEUS_MULTIPROC_DIR) метрики всех воркеров
+    читаются из файлов каталога, иначе используются метрики процесса
+    :return: CollectorRegistry
+    """
+    if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        return REGISTRY
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+_render_registry = _registry()
+
+
+def render():
+    """
+    Метрики в текстовом формате Prometheus
+    :return: (bytes, int, dict) - Тело, HTTP статус и заголовки ответа
+    """
+    return generate_latest(_render_registry), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+
+
+def is_scrape_authorized(authorization: str, token: str):
+    """
+    Проверка токена сборщика метрик
+    :param authorization: str - Значение заголовка Authorization
+    :param token: str - Токен сборщика (пустой - метрики не отдаются)
+    :return: bool
+    """
+    if not token or not authorization:
+        return False
+
+    return hmac.compare_digest(authorization.encode('utf-8'), 'Bearer {}'.format(token).encode('utf-8'))
+
+
+@contextmanager
+def track_bot_event(event_type: str):
+    """
+    Учет времени обработки и ошибок события бота
+    :param event_type: str - Тип события (BotEventType.value)
+    :return: None
+    """
+    started_at = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        BOT_EVENT_ERRORS.labels(event_type).inc()
+        raise
+    finally:
+        BOT_EVENT_LATENCY.labels(event_type).observe(time.perf_counter() - started_at)
+
+
+def observe_vk_call(method: str, seconds: float, error_code=None):
+    """
+    Учет вызова метода VK API
+    :param method: str - Метод VK API
+    :param seconds: float - Время вызова в секундах
+    :param error_code: int - Код ошибки VK или 'network' (None - вызов успешен)
+    :return: None
+    """
+    VK_LATENCY.labels(method).observe(seconds)
+    if error_code is not None:
+        VK_ERRORS.labels(method, str(error_code)).inc()
+
+
+def observe_password_hash(operation: str, seconds: float):
+    """
+    Учет хеширования или проверки пароля
+    :param operation: str - hash или check
+    :param seconds: float - Время с постановки в очередь до получения результата в секундах
+    :return: None
+    """
+    PASSWORD_HASH_LATENCY.labels(operation).observe(seconds)
+
+
+def count_password_hash_rejected(operation: str, reason: str):
+    """
+    Учет отказа в хешировании или проверке пароля
+    :param operation: str - hash или check
+    :param reason: str - full или timeout
+    :return: None
+    """
+    PASSWORD_HASH_REJECTED.labels(operation, reason).inc()
+
+
+class MetricsSampler(object):
+    """
+    Периодическое чтение размеров очередей и пула соединений воркера в метрики.
+    Значения записываются самим воркером, поэтому /metrics любого воркера показывает сумму по всем воркерам
+    Attributes:
+        interval: float - Интервал чтения в секундах
+        queues: {str: function} - Функции, возвращающие размер очереди, по названию очереди
+        engines: [Engine] - Движки SQLAlchemy, пулы которых учитываются
+    """
+    def __init__(self, interval: float = 5):
+        self.interval = interval
+        self.queues = {}
+        self.engines = []
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def track_queue(self, name: str, size):
+        """
+        Учет размера очереди
+        :param name: str - Название очереди (значение метки queue)
+        :param size: function - Функция без аргументов, возвращающая размер очереди
+        :return: None
+        """
+        self.queues[name] = size
+
+    def track_pool(self, engine):
+        """
+        Учет соединений пула движка SQLAlchemy
+        :param engine: Engine - Движок
+        :return: None
+        """
+        self.engines.append(engine)
+
+    def start(self):
+        """
+        Запуск потока. Поток запускается при первом запросе, уже после форка воркера gunicorn
+        :return: None
+        """
+        if self.thread is not None:
+            return
+
+        with self.lock:
+            if self.thread is not None:
+                return
+
+            self.thread = threading.Thread(target=self.__run, name='metrics-sampler', daemon=True)
+            self.thread.start()
+
+    def __run(self):
+        while True:
+            try:
+                self.sample()
+            except Exception:
+                pass
+            time.sleep(self.interval)
+
+    def sample(self):
+        """
+        Чтение текущих значений
+        :return: None
+        """
+        for name, size in self.queues.items():
+            QUEUE_DEPTH.labels(name).set(size())
+
+        in_use = idle = overflow = 0
+        for engine in self.engines:
+            pool = engine.pool
+            # У пулов без ограничения размера (NullPool, StaticPool) этих счетчиков нет
+            if hasattr(pool, 'checkedout'):
+                in_use += pool.checkedout()
+                idle += pool.checkedin()
+                overflow += max(pool.overflow(), 0)
+
+        DB_POOL.labels('in_use').set(in_use)
+        DB_POOL.labels('idle').set(idle)
+        DB_POOL.labels('overflow').set(overflow)
+
+
+def init_app(app, sampler):
+    """
+    Учет времени обработки запросов приложения по маршрутам и запуск чтения очередей при первом запросе
+    :param app: Flask - Приложение
+    :param sampler: MetricsSampler - Чтение размеров очередей и пула соединений
+    :return: None
+    """
+    @app.before_request
+    def start_request_timer():
+        sampler.start()
+        g.request_started_at = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        started_at = g.get('request_started_at')
+        if started_at is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            REQUEST_LATENCY.labels(request.method, route, response.status_code) \
+                .observe(time.perf_counter() - started_at)
+        return response
@@ -1,9 +1,14 @@
 import os
-from flask import request, json, jsonify
+from flask import request, jsonify
 from flask_jwt_extended import jwt_required, jwt_refresh_token_required, get_jwt_identity
 
-from server import app
+from server import app, metrics_sampler
+from . import metrics
+from .serialization import loads
 from bot.router import Router
+from bot.worker import EventQueue
+from bot.dedup import EventDeduplicator
+from database import start_change_listener
 from .admin.handlers import *
 
 # Access токен, полученный в сообществе ВК
@@ -12,13 +17,46 @@ token = os.environ.get("VK_TOKEN")
 # Код подтверждения сервера, полученный в сообществе ВК
 confirmation_token = os.environ.get("CONFIRMATION_TOKEN")
 
-router = Router(token)
+router = Router(token, pool_size=app.config['VK_POOL_SIZE'], timeout=app.config['VK_TIMEOUT'],
+                api_url=app.config['VK_API_URL'], sender_options={
+    'rate': app.config['VK_RATE_LIMIT'],
+    'burst': app.config['VK_RATE_BURST'],
+    'threads_count': app.config['VK_SENDER_THREADS'],
+    'max_size': app.config['VK_SEND_QUEUE_SIZE'],
+    'max_retries': app.config['VK_SEND_RETRIES'],
+    'retry_delay': app.config['VK_SEND_RETRY_DELAY'],
+    'drain_timeout': app.config['BOT_DRAIN_TIMEOUT']
+}, subscribers_options={
+    'flush_interval': app.config['SUBSCRIBERS_FLUSH_INTERVAL'],
+    'batch_size': app.config['SUBSCRIBERS_BATCH_SIZE']
+}, broadcast_options={
+    'max_in_flight': app.config['BROADCAST_MAX_IN_FLIGHT']
+}, conversations_options={
+    'max_size': app.config['CONVERSATIONS_CACHE_SIZE'],
+    'flush_interval': app.config['CONVERSATIONS_FLUSH_INTERVAL'],
+    'batch_size': app.config['CONVERSATIONS_BATCH_SIZE']
+})
+
+event_queue = EventQueue(router, workers_count=app.config['BOT_WORKERS'], max_size=app.config['BOT_QUEUE_SIZE'],
+                         put_timeout=app.config['BOT_QUEUE_TIMEOUT'], drain_timeout=app.config['BOT_DRAIN_TIMEOUT'])
+
+deduplicator = EventDeduplicator(ttl=app.config['BOT_DEDUP_TTL'], max_size=app.config['BOT_DEDUP_SIZE'],
+                                 use_database=app.config['BOT_DEDUP_BACKEND'] == 'database')
+
+metrics_sampler.track_queue('bot_events', event_queue.size)
+metrics_sampler.track_queue('vk_send', router.sender.size)
+metrics_sampler.track_queue('conversations_unsaved', lambda: len(router.conversations.dirty))
+metrics_sampler.track_queue('subscribers_unsaved', lambda: len(router.subscribers.pending))
+
+
+# Прием уведомлений об изменениях запускается при первом запросе, уже после форка воркера gunicorn
+app.before_request(start_change_listener)
 
 
 @app.route('/', methods=['POST'])
 def processing():
     try:
-        data = json.loads(request.data)
+        data = loads(request.data)
     except ValueError:
         return 'denied'
     except TypeError:
@@ -32,8 +70,16 @@ def processing():
     if data['type'] == 'confirmation':
         return confirmation_token
 
-    # Передаем запрос для обработки в роутер бота
-    router.route(data)
+    # Повторно доставленное VK событие уже принято в обработку
+    event_id = data.get('event_id')
+    if deduplicator.is_duplicate(event_id):
+        return 'ok'
+
+    # Передаем запрос в очередь на обработку роутером бота. Если очередь переполнена,
+    # не подтверждаем событие - VK доставит его повторно
+    if not event_queue.put(data):
+        deduplicator.forget(event_id)
+        return 'busy', 503
 
     return 'ok'
 
@@ -63,7 +109,10 @@ def users():
 
         return user_create_handler(request.json, current_user_id)
     elif request.method == 'GET':
-        return users_list_handler(current_user_id)
+        return users_list_handler(current_user_id, fields=request.args.get('fields'),
+                                  limit=request.args.get('limit'), cursor=request.args.get('cursor'),
+                                  role=request.args.get('role'), email_prefix=request.args.get('email'),
+                                  etags=request.if_none_match)
 
 
 @app.route('/users/<int:user_id>', methods=['GET', 'PUT', 'DELETE'])
@@ -71,7 +120,7 @@ def users():
 def user(user_id):
     current_user_id = get_jwt_identity()
     if request.method == 'GET':
-        return users_retrieve_handler(user_id, current_user_id)
+        return users_retrieve_handler(user_id, current_user_id, etags=request.if_none_match)
 
     elif request.method == 'PUT':
         if not request.is_json:
@@ -88,7 +137,14 @@ def steps():
     current_user_id = get_jwt_identity()
 
     if request.method == 'GET':
-        return steps_list_handler(current_user_id)
+        unreachable = request.args.get('unreachable')
+        if unreachable is not None:
+            unreachable = unreachable.lower() == 'true'
+
+        return steps_list_handler(current_user_id, fields=request.args.get('fields'),
+                                  limit=request.args.get('limit'), cursor=request.args.get('cursor'),
+                                  unreachable=unreachable, text_prefix=request.args.get('text'),
+                                  etags=request.if_none_match)
     elif request.method == 'POST':
         if not request.is_json:
             return jsonify({"error": "Missing JSON in request"}), 400
@@ -100,7 +156,7 @@ def steps():
 def step(step_id):
     current_user_id = get_jwt_identity()
     if request.method == 'GET':
-        return steps_retrieve_handler(step_id, current_user_id)
+        return steps_retrieve_handler(step_id, current_user_id, etags=request.if_none_match)
     elif request.method == 'PUT':
         if not request.is_json:
             return jsonify({"error": "Missing JSON in request"}), 400
@@ -114,3 +170,45 @@ def step(step_id):
 def button(button_id):
     current_user_id = get_jwt_identity()
     return buttons_delete_handler(button_id, current_user_id)
+
+
+@app.route('/steps/<int:step_id>/broadcast', methods=['POST'])
+@jwt_required
+def step_broadcast(step_id):
+    current_user_id = get_jwt_identity()
+    if not request.is_json:
+        return jsonify({"error": "Missing JSON in request"}), 400
+    return broadcast_create_handler(step_id, current_user_id, request.json, router.broadcaster)
+
+
+@app.route('/broadcasts/<int:broadcast_id>', methods=['GET'])
+@jwt_required
+def broadcast(broadcast_id):
+    current_user_id = get_jwt_identity()
+    return broadcast_retrieve_handler(broadcast_id, current_user_id)
+
+
+@app.route('/graph', methods=['GET'])
+@jwt_required
+def graph():
+    current_user_id = get_jwt_identity()
+    root_id = request.args.get('root', type=int)
+    depth = request.args.get('depth', type=int)
+    return graph_retrieve_handler(current_user_id, root_id=root_id, depth=depth)
+
+
+@app.route('/graph/import', methods=['POST'])
+@jwt_required
+def graph_import():
+    current_user_id = get_jwt_identity()
+    if not request.is_json:
+        return jsonify({"error": "Missing JSON in request"}), 400
+    replace = request.args.get('replace', 'false').lower() == 'true'
+    return graph_import_handler(request.stream, current_user_id, replace)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_export():
+    if not metrics.is_scrape_authorized(request.headers.get('Authorization'), app.config['METRICS_TOKEN']):
+        return jsonify({'error': 'Not found'}), 404
+    return metrics.render()
@@ -0,0 +1,107 @@
+import datetime
+import json
+from decimal import Decimal
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from flask.json.provider import DefaultJSONProvider
+except ImportError:
+    DefaultJSONProvider = None
+
+
+def _default(o):
+    """
+    Сериализация типов, которые не поддерживаются JSON напрямую.
+    Даты сериализуются в ISO 8601, как это делает orjson
+    """
+    if isinstance(o, (set, frozenset)):
+        return list(o)
+    if isinstance(o, (datetime.datetime, datetime.date, datetime.time)):
+        return o.isoformat()
+    if isinstance(o, Decimal):
+        return float(o)
+    raise TypeError("Object of type '{}' is not JSON serializable".format(type(o).__name__))
+
+
+def _stdlib_dumps(obj, sort_keys=False):
+    return json.dumps(obj, default=_default, ensure_ascii=False, separators=(',', ':'), sort_keys=sort_keys)
+
+
+def dumps(obj, sort_keys: bool = False):
+    """
+    Сериализация в компактную JSON строку. Если установлен orjson, используется он
+    :param obj: Сериализуемый объект
+    :param sort_keys: bool - Сортировать ключи словарей
+    :return: str
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=_default,
+                                option=orjson.OPT_SORT_KEYS if sort_keys else 0).decode()
+        except TypeError:
+            # Например, целые числа больше 64 бит, которые orjson не поддерживает
+            pass
+
+    return _stdlib_dumps(obj, sort_keys)
+
+
+def loads(s):
+    """
+    Разбор JSON строки
+    :param s: str | bytes
+    :return: Разобранный объект
+    """
+    if orjson is not None:
+        return orjson.loads(s)
+
+    return json.loads(s)
+
+
+class JSONEncoder(json.JSONEncoder):
+    """
+    Кодировщик JSON ответов Flask (app.json_encoder в Flask до 2.2).
+    Компактный вывод без отступов выполняется через dumps, форматированный - стандартной библиотекой
+    """
+    def default(self, o):
+        return _default(o)
+
+    def encode(self, o):
+        if self.indent is None:
+            return dumps(o, sort_keys=self.sort_keys)
+
+        return super().encode(o)
+
+
+if DefaultJSONProvider is not None:
+    class JSONProvider(DefaultJSONProvider):
+        """
+        JSON провайдер Flask 2.2+ с быстрым путем через dumps
+        """
+        default = staticmethod(_default)
+
+        def dumps(self, obj, **kwargs):
+            if kwargs.get('indent') is None:
+                return dumps(obj, sort_keys=kwargs.get('sort_keys', self.sort_keys))
+
+            return super().dumps(obj, **kwargs)
+
+        def loads(self, s, **kwargs):
+            return loads(s)
+else:
+    JSONProvider = None
+
+
+def init_app(app):
+    """
+    Подключение сериализации к jsonify и request.json приложения
+    :param app: Flask
+    :return: None
+    """
+    if JSONProvider is not None:
+        app.json = JSONProvider(app)
+    else:
+        app.json_encoder = JSONEncoder
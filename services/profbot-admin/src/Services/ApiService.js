@@ -36,21 +36,33 @@ class ApiService {
     }
 
     getStepsList(onSuccess, onError) {
+        this.getAllPages('/steps', onSuccess, onError);
+    }
+
+    // Список загружается по страницам, пока сервер возвращает курсор следующей страницы в X-Next-Cursor
+    getAllPages(path, onSuccess, onError, cursor = null, items = []) {
         const access = this.auth.getAccessToken();
         const refresh = this.auth.getRefreshToken();
 
-        axios.get(this.baseUrl + '/steps', {
+        axios.get(this.baseUrl + path, {
+            params: cursor === null ? {} : { cursor: cursor },
             headers: {
                 Authorization: 'Bearer ' + access,
             }
         }).then(response => {
-            onSuccess(response)
+            const loaded = items.concat(response.data);
+            const next = response.headers['x-next-cursor'];
+            if (next) {
+                this.getAllPages(path, onSuccess, onError, next, loaded);
+            } else {
+                onSuccess({ ...response, data: loaded });
+            }
         }).catch(error => {
             const status = error.response.status;
             if (status === 401) {
                 this.refreshTokens(refresh, (response) => {
                     this.auth.signin(response.data.id, response.data.access_token, response.data.refresh_token)
-                    this.getStepsList(onSuccess, onError)
+                    this.getAllPages(path, onSuccess, onError, cursor, items)
                 }, onError)
             } else {
                 onError(error);
@@ -131,26 +143,7 @@ class ApiService {
     }
 
     getUsersList(onSuccess, onError) {
-        const access = this.auth.getAccessToken();
-        const refresh = this.auth.getRefreshToken();
-
-        axios.get(this.baseUrl + '/users', {
-            headers: {
-                Authorization: 'Bearer ' + access,
-            }
-        }).then(response => {
-            onSuccess(response)
-        }).catch(error => {
-            const status = error.response.status;
-            if (status === 401) {
-                this.refreshTokens(refresh, (response) => {
-                    this.auth.signin(response.data.id, response.data.access_token, response.data.refresh_token)
-                    this.getUsersList(onSuccess, onError)
-                }, onError)
-            } else {
-                onError(error);
-            }
-        });
+        this.getAllPages('/users', onSuccess, onError);
     }
 
     createUser(userData, onSuccess, onError) {